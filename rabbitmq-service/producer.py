@@ -1,4 +1,3 @@
-import json
 from kombu import Connection, Exchange, Queue
 from kombu.mixins import ConsumerMixin
 
@@ -15,7 +14,6 @@ class Worker(ConsumerMixin):
                          callbacks=[self.on_message])]
 
     def on_message(self, body, message):
-        body['id'] = json.dumps(body)
         print('Got message: {0}'.format(body))
         message.ack()
 
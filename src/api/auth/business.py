@@ -1,47 +1,62 @@
+import datetime
+import logging
 from src.models import db, UserModel, BlacklistToken
+from src.blacklist import token_blacklist
 from src.api.auth.serializers import token_status
+from src.api.auth.cache import token_cache, token_digest, token_expiry
+from src.api.auth.hashing import HashingBusy, password_hasher
+from flask_mail import Message
 from flask_restplus import marshal
+from src.mailer import mailer
+
+log = logging.getLogger(__name__)
 
 
 def create_user(data):
-    user = UserModel.query.filter_by(email=data.get('email')).first()
-    if not user:
-        try:
-            user = UserModel(
-                email=data.get('email'),
-                password=data.get('password')
-            )
-            db.session.add(user)
-            db.session.commit()
-            # generate the auth token
-            auth_token = user.encode_auth_token(user.id)
-            responseObject = {
-                'status': 'success',
-                'message': 'Successfully registered.',
-                'auth_token': auth_token.decode()
-            }
-            return responseObject, 201
-        except Exception as e:
-            responseObject = {
-                'status': 'fail',
-                'message': 'Some error occurred. Please try again.'
-            }
-            return responseObject, 401
-    else:
+    try:
+        password = password_hasher.hash(data.get('password'))
+        user_id = UserModel.insert_if_absent(data.get('email'), password)
+        db.session.commit()
+    except HashingBusy:
+        responseObject = {
+            'status': 'fail',
+            'message': 'Too many registrations in progress, try again shortly.'
+        }
+        return responseObject, 503
+    except Exception:
+        db.session.rollback()
+        responseObject = {
+            'status': 'fail',
+            'message': 'Some error occurred. Please try again.'
+        }
+        return responseObject, 401
+    if user_id is None:
         responseObject = {
             'status': 'fail',
             'message': 'User already exists. Please Log in.',
         }
         return responseObject, 202
+    mailer.send(Message('Welcome', recipients=[data.get('email')],
+                        body='Your account {} has been created.'.format(data.get('email'))))
+    # generate the auth token
+    auth_token = UserModel.encode_auth_token(user_id)
+    responseObject = {
+        'status': 'success',
+        'message': 'Successfully registered.',
+        'auth_token': auth_token.decode()
+    }
+    return responseObject, 201
 
 
 def login_user(data):
     try:
-        from src.app import bcrypt
         # fetch the user data
         user = UserModel.query.filter_by(email=data.get('email')).first()
-        if user and bcrypt.check_password_hash(user.password, data.get('password')
-                                               ):
+        # hand the connection back to the pool while the password is checked
+        db.session.close()
+        if user and password_hasher.verify(data.get('password'), user.password):
+            if password_hasher.needs_rehash(user.password):
+                password_hasher.rehash_later(user.id, data.get('password'), user.password)
             auth_token = user.encode_auth_token(user.id)
             if auth_token:
                 responseObject = {
@@ -56,8 +71,15 @@ def login_user(data):
                 'message': 'User does not exist.'
             }
             return responseObject, 401
-    except Exception as e:
-        print(e)
+    except HashingBusy:
+        responseObject = {
+            'status': 'fail',
+            'message': 'Too many login attempts in progress, try again shortly.'
+        }
+        return responseObject, 503
+    except Exception:
+        log.exception('Login failed')
+        db.session.rollback()
         responseObject = {
             'status': 'fail',
             'message': 'Try again'
@@ -71,20 +93,33 @@ def auth_status(auth_header):
     else:
         auth_token = ''
     if auth_token:
+        digest = token_digest(auth_token)
+        cached = token_cache.get(digest)
+        if cached is not None:
+            if not token_blacklist.might_contain(digest):
+                return cached, 200
+            # possibly logged out on another worker since it was cached
+            token_cache.delete(digest)
         resp = UserModel.decode_auth_token(auth_token)
         if not isinstance(resp, str):
             user = UserModel.query.filter_by(id=resp).first()
+            if not user:
+                responseObject = {
+                    'status': 'fail',
+                    'message': 'User does not exist.'
+                }
+                return responseObject, 401
             responseObject = {
                 'status': 'success',
                 'data': {
                     'user_id': user.id,
                     'email': user.email,
-                    'admin': user.admin,
-                    'registered_on': user.registered_on
+                    'admin': user.role == 'admin'
                 }
             }
-            # import pdb;pdb.set_trace()
-            return marshal(responseObject, token_status), 200
+            data = marshal(responseObject, token_status)
+            token_cache.set(digest, data, expires_at=token_expiry(auth_token))
+            return data, 200
         responseObject = {
             'status': 'fail',
             'message': resp
@@ -107,20 +142,25 @@ def logout(auth_header):
         resp = UserModel.decode_auth_token(auth_token)
         if not isinstance(resp, str):
             # mark the token as blacklisted
-            blacklist_token = BlacklistToken(token=auth_token)
+            exp = token_expiry(auth_token)
+            expires_on = datetime.datetime.utcfromtimestamp(exp) if exp else None
+            blacklist_token = BlacklistToken(token=auth_token, expires_on=expires_on)
             try:
                 # insert the token
                 db.session.add(blacklist_token)
                 db.session.commit()
+                token_blacklist.add(blacklist_token.token_hash)
+                token_cache.delete(blacklist_token.token_hash)
                 responseObject = {
                     'status': 'success',
                     'message': 'Successfully logged out.'
                 }
                 return responseObject, 200
             except Exception as e:
+                db.session.rollback()
                 responseObject = {
                     'status': 'fail',
-                    'message': e
+                    'message': str(e)
                 }
                 return responseObject, 200
         else:
@@ -0,0 +1,24 @@
+import jwt
+from src.cache import TTLCache
+from src.models import BlacklistToken
+
+# verified token digest -> marshalled auth_status payload
+token_cache = TTLCache()
+token_digest = BlacklistToken.hash_token
+
+
+def init_app(flask_app):
+    token_cache.maxsize = flask_app.config.get('AUTH_TOKEN_CACHE_SIZE', 1024)
+    # caps how long another worker may keep accepting a token blacklisted elsewhere
+    token_cache.ttl = flask_app.config.get('AUTH_TOKEN_CACHE_TTL')
+
+
+def token_expiry(auth_token):
+    """
+    Reads the exp claim of a token that has already been verified.
+    :return: epoch seconds|None
+    """
+    try:
+        return jwt.decode(auth_token, verify=False).get('exp')
+    except jwt.InvalidTokenError:
+        return None
@@ -0,0 +1,170 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+from src import metrics
+from src.instrumentation import bcrypt_seconds
+
+log = logging.getLogger(__name__)
+
+queue_seconds = metrics.histogram(
+    'password_hash_queue_seconds', 'Time password jobs waited for a hashing worker.')
+rejected = metrics.counter(
+    'password_hash_rejected_total', 'Password jobs refused because the queue was full.')
+pending = metrics.gauge(
+    'password_hash_pending', 'Password jobs queued or running.')
+
+
+class HashingBusy(Exception):
+    """
+    Raised when no hashing slot frees up within the queue timeout.
+    """
+
+
+def _hash(password, rounds):
+    started = time.perf_counter()
+    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+    return hashed, time.perf_counter() - started
+
+
+def _check(password, hashed):
+    started = time.perf_counter()
+    try:
+        valid = bcrypt.checkpw(password.encode(), hashed.encode())
+    except ValueError:
+        # not a bcrypt hash, e.g. a password stored before hashing was enforced
+        valid = False
+    return valid, time.perf_counter() - started
+
+
+def hash_rounds(hashed):
+    """
+    :return: the cost factor of a '$2b$12$...' hash, None if it is not bcrypt
+    """
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt in a bounded process pool so a burst of logins cannot tie up
+    every request worker on CPU.
+
+    At most `max_pending` jobs are queued or running; callers wait up to
+    `queue_timeout` seconds for a slot and get HashingBusy after that. With
+    `workers` set to 0 jobs run inline on the calling thread. Background
+    rehashes go through one thread and a queue of the same bound.
+    """
+
+    def __init__(self, workers=2, max_pending=32, queue_timeout=5, rounds=12):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.rounds = rounds
+        self._executor = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._rehash_queue = queue.Queue(max_pending)
+        self._rehash_pid = None
+        self._app = None
+        pending.set_function(lambda: self._pending)
+
+    def init_app(self, flask_app):
+        self.rounds = flask_app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = flask_app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_pending = flask_app.config.get('PASSWORD_HASH_MAX_PENDING', self.max_pending)
+        self.queue_timeout = flask_app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT',
+                                                  self.queue_timeout)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._rehash_queue = queue.Queue(self.max_pending)
+        self._app = flask_app
+
+    def _pool(self):
+        # created lazily, and again in forked server workers, which do not inherit pool processes
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    self._pid = os.getpid()
+                    atexit.register(self._executor.shutdown, False)
+        return self._executor
+
+    def _submit(self, operation, function, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            rejected.inc()
+            raise HashingBusy('Password hashing queue is full.')
+        with self._lock:
+            self._pending += 1
+        try:
+            started = time.perf_counter()
+            if self.workers:
+                result, elapsed = self._pool().submit(function, *args).result()
+            else:
+                result, elapsed = function(*args)
+            queue_seconds.observe(max(time.perf_counter() - started - elapsed, 0))
+            bcrypt_seconds.observe(elapsed, (operation,))
+            return result
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def hash(self, password):
+        return self._submit('hash', _hash, password, self.rounds)
+
+    def verify(self, password, hashed):
+        if not password or not hashed:
+            return False
+        return self._submit('check', _check, password, hashed)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def rehash_later(self, user_id, password, old_hash):
+        """
+        Re-hashes with the configured rounds in the background; the row is
+        only updated if its hash did not change in the meantime. When the
+        queue is full the rehash is skipped, a later login retries it.
+        """
+        try:
+            self._rehash_queue.put_nowait((user_id, password, old_hash))
+        except queue.Full:
+            log.warning('Rehash queue is full, skipping user %s', user_id)
+            return
+        self._start_rehasher()
+
+    def _start_rehasher(self):
+        # started lazily, and again in forked server workers, which do not inherit threads
+        if self._rehash_pid == os.getpid():
+            return
+        with self._lock:
+            if self._rehash_pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._rehash, name='password-rehash')
+            thread.daemon = True
+            thread.start()
+            self._rehash_pid = os.getpid()
+
+    def _rehash(self):
+        from src.models import db, UserModel
+        while True:
+            user_id, password, old_hash = self._rehash_queue.get()
+            try:
+                new_hash = self.hash(password)
+                with self._app.app_context():
+                    UserModel.query.filter_by(id=user_id, password=old_hash).update(
+                        {'password': new_hash}, synchronize_session=False)
+                    db.session.commit()
+            except Exception:
+                log.exception('Rehashing the password of user %s failed', user_id)
+
+
+password_hasher = PasswordHasher()
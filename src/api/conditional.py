@@ -0,0 +1,52 @@
+import hashlib
+from functools import wraps
+from flask import request, Response
+from werkzeug.http import http_date
+
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def unpack(response):
+    if not isinstance(response, tuple):
+        return response, 200, {}
+    if len(response) == 2:
+        return response[0], response[1], {}
+    return response[0], response[1], dict(response[2] or {})
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag) or request.if_none_match.star_tag
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def conditional_get(validator):
+    """
+    Adds ETag/Last-Modified and answers 304 before the resource is loaded.
+    :param validator: called with the view arguments, returns (etag, last_modified)
+        from a cheap version lookup, or None to let the view run (e.g. a 404)
+    """
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            version = validator(*args, **kwargs)
+            if version is None:
+                return fn(*args, **kwargs)
+            etag, last_modified = version
+            headers = {'ETag': '"{}"'.format(etag)}
+            if last_modified:
+                headers['Last-Modified'] = http_date(last_modified)
+            if not_modified(etag, last_modified):
+                return Response(status=304, headers=headers)
+            data, code, extra_headers = unpack(fn(*args, **kwargs))
+            if code == 200:
+                extra_headers.update(headers)
+            return data, code, extra_headers
+
+        return decorator
+
+    return wrapper
@@ -0,0 +1,53 @@
+import logging
+from functools import wraps
+from flask_restplus import Namespace, Resource
+from src.api.auth.cache import token_cache
+from src.api.productsCRUD.business import require_admin
+from src.api.restplus import auth_required
+from src.cache import product_cache
+from src.metrics import registry
+from src.pool import pool_status
+
+log = logging.getLogger(__name__)
+
+
+def admin_only(func):
+    @wraps(func)
+    @auth_required
+    def wrapper(*args, **kwargs):
+        require_admin()
+        return func(*args, **kwargs)
+    return wrapper
+
+
+# created unbound so app.initialize_app can leave it out (INTERNAL_ENDPOINTS_ENABLED)
+ns = Namespace('internal', description='Operational endpoints, not for public clients',
+               decorators=[admin_only])
+
+
+@ns.route('/cache')
+class CacheStats(Resource):
+    @ns.response(200, 'Cache counters.')
+    def get(self):
+        """
+        Hit and miss counters of the in-process caches.
+        """
+        return {
+            'product': product_cache.stats(),
+            'auth_token': token_cache.stats()
+        }, 200
+
+
+@ns.route('/pool')
+class PoolStats(Resource):
+    @ns.response(200, 'Connection pool usage and checkout metrics.')
+    def get(self):
+        """
+        Connection pool sizes, checkout latency histogram, overflow and timeouts.
+        """
+        snapshot = registry.snapshot()
+        return {
+            'pools': pool_status(),
+            'metrics': {name: samples for name, samples in snapshot.items()
+                        if name.startswith('db_pool_')}
+        }, 200
@@ -0,0 +1,171 @@
+import base64
+import binascii
+import json
+import threading
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from sqlalchemy import and_, event, or_, text
+from sqlalchemy.orm import Session, object_session
+from src.cache import TTLCache
+
+
+class KeysetPage(object):
+    """
+    A page of keyset (cursor) pagination results.
+    """
+
+    def __init__(self, items, per_page, next_cursor=None, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+        self.total = total
+        self.page = None
+        self.pages = None
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :raise ValueError: if the cursor was not produced by encode_cursor
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor.')
+    return values
+
+
+def _after(sort_keys, values):
+    # (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ... with > flipped for descending keys
+    clauses = []
+    for i, (column, descending) in enumerate(sort_keys):
+        equal = [c == v for (c, _), v in zip(sort_keys[:i], values[:i])]
+        past = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*(equal + [past])))
+    return or_(*clauses)
+
+
+def keyset_paginate(query, sort_keys, cursor, per_page, with_count=False):
+    """
+    Seeks past the cursor instead of using OFFSET, and skips COUNT(*) unless asked.
+    :param sort_keys: [(column, descending)], the last key must be unique (e.g. id)
+    :param cursor: next_cursor of the previous page, falsy for the first page
+    :return: KeysetPage
+    """
+    total = query.order_by(None).count() if with_count else None
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(sort_keys):
+            raise ValueError('Invalid cursor.')
+        query = query.filter(_after(sort_keys, values))
+    ordering = [column.desc() if descending else column.asc() for column, descending in sort_keys]
+    items = query.order_by(*ordering).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column, _ in sort_keys])
+    return KeysetPage(items, per_page, next_cursor, total)
+
+
+class CountCache(object):
+    """
+    Caches pagination totals per (namespace, key).
+
+    Models registered with `track` bump their namespace's generation once a
+    transaction writing them commits, which orphans every cached total of
+    that namespace. The ttl bounds how stale a total can get from writes
+    made by other processes.
+    """
+
+    def __init__(self, maxsize=4096, ttl=30):
+        self._cache = TTLCache(maxsize, ttl)
+        self._generations = {}
+        self._lock = threading.Lock()
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def init_app(self, flask_app):
+        self._cache.maxsize = flask_app.config.get('COUNT_CACHE_SIZE', self._cache.maxsize)
+        self._cache.ttl = flask_app.config.get('COUNT_CACHE_TTL', self._cache.ttl)
+
+    def track(self, model, namespace_of):
+        """
+        :param namespace_of: maps a written instance to the namespace it invalidates
+        """
+        def changed(mapper, connection, target):
+            session = object_session(target)
+            if session is not None:
+                session.info.setdefault('count_namespaces', set()).add(namespace_of(target))
+
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, name, changed)
+
+    def generation(self, namespace):
+        return self._generations.get(namespace, 0)
+
+    def invalidate(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def _after_commit(self, session):
+        for namespace in session.info.pop('count_namespaces', ()):
+            self.invalidate(namespace)
+
+    def _after_rollback(self, session):
+        session.info.pop('count_namespaces', None)
+
+    def count(self, namespace, key, query, estimate_table=None):
+        """
+        :param estimate_table: table whose planner estimate may stand in for an
+            unfiltered count when PAGINATION_COUNT_MODE is 'estimated'
+        """
+        cache_key = (namespace, self.generation(namespace), key)
+        total = self._cache.get(cache_key)
+        if total is None:
+            if estimate_table is not None and \
+                    current_app.config.get('PAGINATION_COUNT_MODE') == 'estimated':
+                total = estimate_count(query.session, estimate_table)
+            if total is None:
+                total = query.order_by(None).count()
+            self._cache.set(cache_key, total)
+        return total
+
+
+count_cache = CountCache()
+
+
+def estimate_count(session, table):
+    """
+    Reads the planner's row estimate on PostgreSQL
+    :return: integer|None when no estimate is available
+    """
+    if session.get_bind().dialect.name != 'postgresql':
+        return None
+    estimate = session.execute(
+        text('SELECT reltuples::bigint FROM pg_class WHERE relname = :table'),
+        {'table': table}).scalar()
+    return estimate if estimate is not None and estimate >= 0 else None
+
+
+def paginate(query, page, per_page, namespace, key=None, estimate_table=None):
+    """
+    Query.paginate(error_out=False) taking its total from the count cache,
+    or counting every time when namespace is None.
+    """
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    if page == 1 and len(items) < per_page:
+        total = len(items)
+    elif namespace is None:
+        total = query.order_by(None).count()
+    else:
+        total = count_cache.count(namespace, key, query, estimate_table)
+    return Pagination(query, page, per_page, total, items)
@@ -1,15 +1,31 @@
+import datetime
 from src.models import db
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
 from flask_restful import Resource, reqparse, inputs
 from flask_jwt import jwt_required
-from src.models import ProductModel, PurchaseLogModel
-from flask import abort, current_app, _app_ctx_stack
-from sqlalchemy import desc
+from src.models import ProductModel, PurchaseLogModel, ProductList as ProductListModel, \
+    ProductListItem, OutboxEvent, ProductSales, ProductSalesDaily, UserPurchaseTotals, record_sales
+from src.likes import like_buffer
+from src.events import LIKE, PURCHASE, event_bus, like_event, purchase_event
+from src.cache import product_cache
+from src.mailer import mailer
+from flask import abort, g, request
+from flask_mail import Message
 from math import ceil
+from urllib.parse import urlencode
 from functools import wraps
 from flask_jwt import current_identity
 from flask_restplus import marshal
 from src.api.productsCRUD.serializers import productlist as productlist_fields
 from src.api.productsCRUD.serializers import productlist_item_output
+from src.api.pagination import count_cache, keyset_paginate, paginate
+from src.api.conditional import conditional_get, make_etag
+from src.api.productsCRUD.search import SEARCH_MODES, search_filter, search_products
+
+count_cache.track(ProductModel, lambda product: 'products')
+count_cache.track(ProductListModel, lambda productlist: ('productlist', productlist.created_by))
+count_cache.track(ProductListItem, lambda item: ('productlistitem', item.productlist_id))
 
 
 def admin_required():
@@ -27,21 +43,6 @@ def admin_required():
     return wrapper
 
 
-def log_purchase():
-    def wrapper(fn):
-        @wraps(fn)
-        def decorator(*args, **kwargs):
-            fn_response = fn(*args, **kwargs)
-            if fn_response.get('successful_purchase'):
-                log = PurchaseLogModel(current_identity, *args)
-                log.save_to_db()
-            return fn_response
-
-        return decorator
-
-    return wrapper
-
-
 class ProductBuy(Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('quantity', type=inputs.positive, required=True)
@@ -49,7 +50,7 @@ class ProductBuy(Resource):
     @jwt_required()
     def patch(self, _id):
         kwargs = ProductBuy.parser.parse_args()
-        data = ProductService.buy_product(_id, kwargs.get('quantity'))
+        data = ProductService.buy_product(_id, kwargs.get('quantity'), current_identity.id)
 
         if data.get('not_found'):
             return data, 404
@@ -80,20 +81,28 @@ class ProductList(Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('orderBy', type=str, action='append')
     parser.add_argument('searchByName', type=str)
-    parser.add_argument('page', type=inputs.positive, required=True,
-                        help="page field cannot be left blank!")
+    parser.add_argument('searchMode', type=str, choices=SEARCH_MODES, default='exact')
+    parser.add_argument('page', type=inputs.positive, default=1)
     parser.add_argument('per_page', type=inputs.positive, required=True,
                         help="per_page field cannot be left blank!")
+    parser.add_argument('cursor', type=str)
+    parser.add_argument('withCount', type=inputs.boolean, default=False)
 
     def get(self):
         kwargs = ProductList.parser.parse_args()
         order_by = kwargs.get('orderBy')
         search_by = kwargs.get('searchByName')
+        search_mode = kwargs.get('searchMode')
         page = kwargs.get('page')
         per_page = kwargs.get('per_page')
+        cursor = kwargs.get('cursor')
+        with_count = kwargs.get('withCount')
+
+        data = ProductService.get_product_list(search_by, order_by, page, per_page,
+                                               cursor, with_count, search_mode)
+        if data.get('invalid_cursor'):
+            return data, 400
 
-        data = ProductService.get_product_list(search_by, order_by,
-                                               page, per_page)
         return data, 200
 
 
@@ -129,6 +138,7 @@ class Product(Resource):
 
         return data, 200
 
+    @conditional_get(lambda self, _id: ProductService.get_product_version(_id))
     def get(self, _id):
         data = ProductService.get_product(_id)
         if data.get('not_found'):
@@ -161,25 +171,37 @@ class Product(Resource):
 
 class ProductService:
 
+    SORT_KEYS = {
+        'item': (ProductModel.item, False),
+        'likes': (ProductModel.likes, True)
+    }
+
     @staticmethod
-    def get_product_list(search_by, order_by, page, per_page):
-        sorting = []
+    def get_product_list(search_by, order_by, page, per_page, cursor=None, with_count=False,
+                         search_mode='exact'):
+        sort_keys = []
 
         if order_by:
             for field in order_by:
-                if field == 'likes':
-                    field = desc(field)
-                    sorting.append(field)
+                if field in ProductService.SORT_KEYS:
+                    sort_keys.append(ProductService.SORT_KEYS[field])
         else:
-            sorting.append('item')  # default order only by item
-        order_by = sorting
+            sort_keys.append(ProductService.SORT_KEYS['item'])  # default order only by item
 
-        pagination = {'page': page, 'per_page': per_page}
+        if cursor is not None:
+            return ProductService.get_product_page_after(search_by, search_mode, order_by,
+                                                         sort_keys, cursor, per_page, with_count)
+
+        ordering = [column.desc() if descending else column for column, descending in sort_keys]
 
         if search_by:
-            products = ProductModel.find_by_name(search_by, *order_by, **pagination)
+            # without an explicit orderBy results are ranked by match quality
+            products = search_products(search_by, search_mode, ordering if order_by else None,
+                                       page, per_page)
         else:
-            products = ProductModel.all_items(*order_by, **pagination)
+            query = ProductModel.query.order_by(*ordering)
+            products = paginate(query, page, per_page, 'products',
+                                estimate_table=ProductModel.__tablename__)
 
         total_pages = ceil(products.total / per_page)
         link = '/products?page={}&per_page={}'
@@ -204,28 +226,69 @@ class ProductService:
         }
 
     @staticmethod
-    @log_purchase()
-    def buy_product(_id, quantity):
-        product = ProductModel.find_by_id(_id)
+    def get_product_page_after(search_by, search_mode, order_by, sort_keys, cursor, per_page,
+                               with_count):
+        query = ProductModel.query
+        if search_by:
+            query = query.filter(search_filter(search_by, search_mode))
 
-        if not product:
-            return {'not_found': 'Product not found'}
+        try:
+            products = keyset_paginate(query, sort_keys + [(ProductModel.id, False)],
+                                       cursor, per_page, with_count)
+        except ValueError as e:
+            return {'invalid_cursor': str(e)}
 
-        if product.stock < quantity:
-            return {'stock_not_enough': {'current_stock': product.stock}}
+        params = [('per_page', per_page)] + [('orderBy', field) for field in order_by or ()]
+        if search_by:
+            params += [('searchByName', search_by), ('searchMode', search_mode)]
+        link = '/products?' + urlencode(params) + '&cursor={}'
+        metadata = {
+            'per_page': per_page,
+            'links': {
+                'self': link.format(cursor),
+                'first': link.format(''),
+                'next': link.format(products.next_cursor) if products.has_next else None
+            }
+        }
+        if with_count:
+            metadata['total_products'] = products.total
 
-        product.stock -= quantity
+        return {
+            'metadata': metadata,
+            'products': tuple(map(ProductModel.to_dict, products.items))
+        }
 
+    @staticmethod
+    def buy_product(_id, quantity, user_id):
         try:
-            product.save_to_db()
+            product = ProductModel.reserve_stock(_id, quantity)
+            if not product:
+                db.session.rollback()
+                current_stock = ProductModel.current_stock(_id)
+                if current_stock is None:
+                    return {'not_found': 'Product not found'}
+                return {'stock_not_enough': {'current_stock': current_stock}}
+
+            if event_bus.enabled:
+                # the analytics worker writes the purchase log
+                OutboxEvent.add(PURCHASE, purchase_event(user_id, {_id: quantity}))
+            else:
+                now = datetime.datetime.utcnow()
+                db.session.bulk_insert_mappings(PurchaseLogModel, [
+                    {'user_id': user_id, 'product_id': _id, 'purchase_quantity': quantity,
+                     'datetime': now}])
+                record_sales([(user_id, _id, quantity, now)])
+            db.session.commit()
         except:
+            db.session.rollback()
             return {'error': 'An error occurred buying a product.'}
+        product_cache.invalidate(_id)
 
         return {
             'successful_purchase': {
                 'product': {
                     'id': product.id,
-                    'item': product.name,
+                    'item': product.item,
                     'npc': product.npc,
                     'current_stock': product.stock,
                     'price': product.price
@@ -236,22 +299,25 @@ class ProductService:
 
     @staticmethod
     def give_like_product(_id):
-        product = ProductModel.find_by_id(_id)
-        if not product:
-            return {'not_found': 'Product not found'}
-
-        product.likes += 1
-
-        try:
-            product.save_to_db()
-        except:
-            return {"error": "An error occurred giving a like to the product."}
+        product = ProductService.get_product(_id)
+        if product.get('not_found'):
+            return product
+
+        if event_bus.enabled:
+            try:
+                OutboxEvent.add(LIKE, like_event(_id))
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+                like_buffer.add(_id)
+        else:
+            like_buffer.add(_id)
 
-        return product.to_dict()
+        return dict(product, likes=product['likes'] + 1)
 
     @staticmethod
     def create_product(*args, **data):
-        product = ProductModel.find_by_name(data.get('item')).items
+        product = ProductModel.find_by_item(data.get('item'))
         if product:
             return {'exists':
                         "A product with item '{}' already exists."
@@ -303,13 +369,31 @@ class ProductService:
 
         return product.to_dict()
 
+    @staticmethod
+    def get_product_version(_id):
+        row = ProductModel.last_updated(_id)
+        if not row:
+            return None
+        last_update = row[0]
+        return make_etag('product', _id, last_update, like_buffer.pending(_id)), last_update
+
     @staticmethod
     def get_product(_id):
-        product = ProductModel.find_by_id(_id)
-        if not product:
+        def load():
+            product = ProductModel.find_by_id(_id)
+            return product.to_dict(pending_likes=False) if product else None
+
+        data = product_cache.get_or_load(_id, load)
+        if not data:
             return {'not_found': 'Product not found'}
 
-        return product.to_dict()
+        return dict(data, likes=data['likes'] + like_buffer.pending(_id))
+
+
+def require_admin():
+    user_data = g.user_data
+    if not user_data.get('admin'):
+        abort(403, 'User has not permission to perform this operation')
 
 
 def create_product_item(_id, data):
@@ -337,9 +421,8 @@ def update_item(id, item_id, data):
     if not name.strip():
         abort(400, {"message": "Input payload validation failed",
                     "field": "'item' is a required property"})
-    with current_app.app_context():
-        user_data = _app_ctx_stack.user_data
-        created_by = user_data['user_id']
+    user_data = g.user_data
+    created_by = user_data['user_id']
     try:
         item = ProductModel.query.filter_by(
             created_by=created_by, id=id).first().items.filter_by(id=item_id).first_or_404()
@@ -359,9 +442,8 @@ def update_item(id, item_id, data):
 
 
 def delete_item(id, item_id):
-    with current_app.app_context():
-        user_data = _app_ctx_stack.user_data
-        created_by = user_data['user_id']
+    user_data = g.user_data
+    created_by = user_data['user_id']
     item = ProductModel.query.filter_by(
         created_by=created_by, id=id).first().items.filter_by(id=item_id)
     if not item.count():
@@ -380,9 +462,8 @@ def create_productlist(data):
     if not name.strip():
         abort(400, {"message": "Input payload validation failed",
                     "field": "'item' is a required property"})
-    with current_app.app_context():
-        user_data = _app_ctx_stack.user_data
-        created_by = user_data['user_id']
+    user_data = g.user_data
+    created_by = user_data['user_id']
     products = ProductModel(name, created_by)
     db.session.add(products)
     db.session.commit()
@@ -399,9 +480,8 @@ def update_productlist(bucketlist_id, data):
     if not name.strip():
         abort(400, {"message": "Input payload validation failed",
                     "field": "'item' is a required property"})
-    with current_app.app_context():
-        user_data = _app_ctx_stack.user_data
-        created_by = user_data['user_id']
+    user_data = g.user_data
+    created_by = user_data['user_id']
     products = ProductModel.query.filter_by(created_by=created_by, id=bucketlist_id).first_or_404()
     products.name = name
     db.session.add(products)
@@ -415,9 +495,8 @@ def update_productlist(bucketlist_id, data):
 
 
 def delete_productlist(b_id):
-    with current_app.app_context():
-        user_data = _app_ctx_stack.user_data
-        created_by = user_data['user_id']
+    user_data = g.user_data
+    created_by = user_data['user_id']
     products = ProductModel.query.filter_by(created_by=created_by, id=b_id)
     if not products.count():
         abort(403)
@@ -428,3 +507,161 @@ def delete_productlist(b_id):
         'message': 'Product item successfully deleted.'
     }
     return responseObject
+
+
+def checkout(data):
+    user_data = g.user_data
+    user_id = user_data['user_id']
+    quantities = {}
+    for line in data.get('items'):
+        product_id = line['product_id']
+        quantities[product_id] = quantities.get(product_id, 0) + line['quantity']
+    try:
+        stocks = ProductModel.reserve_stock_bulk(quantities)
+        if stocks is None:
+            db.session.rollback()
+            current_stocks = ProductModel.current_stocks(quantities)
+            responseObject = {
+                'status': 'fail',
+                'message': 'Not enough stock for some products.',
+                'stock_not_enough': [
+                    {'product_id': product_id, 'quantity': quantity,
+                     'current_stock': current_stocks.get(product_id)}
+                    for product_id, quantity in sorted(quantities.items())
+                    if current_stocks.get(product_id) is None or
+                    current_stocks[product_id] < quantity
+                ]
+            }
+            return responseObject, 409
+
+        if event_bus.enabled:
+            OutboxEvent.add(PURCHASE, purchase_event(user_id, quantities))
+        else:
+            now = datetime.datetime.utcnow()
+            db.session.bulk_insert_mappings(PurchaseLogModel, [
+                {'user_id': user_id, 'product_id': product_id, 'purchase_quantity': quantity,
+                 'datetime': now}
+                for product_id, quantity in quantities.items()
+            ])
+            record_sales((user_id, product_id, quantity, now)
+                         for product_id, quantity in quantities.items())
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        responseObject = {
+            'status': 'fail',
+            'message': 'An error occurred during checkout.'
+        }
+        return responseObject, 500
+    product_cache.invalidate(*quantities)
+    mailer.send(Message('Your order', recipients=[user_data['email']], body='\n'.join(
+        'product {}: {}'.format(product_id, quantity)
+        for product_id, quantity in sorted(quantities.items()))))
+
+    responseObject = {
+        'status': 'success',
+        'message': 'Checkout successful.',
+        'purchases': [
+            {'product_id': product_id, 'quantity': quantity,
+             'current_stock': stocks[product_id]}
+            for product_id, quantity in sorted(quantities.items())
+        ]
+    }
+    return responseObject, 201
+
+
+def productlist_version(productlist_id=None):
+    """
+    Version of the caller's productlists (or of one of them) and their items,
+    from a single aggregate query
+    :return: (etag, last_modified)|None when the productlist does not exist
+    """
+    user_data = g.user_data
+    created_by = user_data['user_id']
+    list_changed = func.coalesce(ProductListModel.date_modified, ProductListModel.date_created)
+    item_changed = func.coalesce(ProductListItem.date_modified, ProductListItem.date_created)
+    query = db.session.query(
+        func.count(func.distinct(ProductListModel.id)), func.max(list_changed),
+        func.count(ProductListItem.id), func.max(item_changed)
+    ).outerjoin(ProductListItem, ProductListItem.productlist_id == ProductListModel.id).filter(
+        ProductListModel.created_by == created_by)
+    if productlist_id is not None:
+        query = query.filter(ProductListModel.id == productlist_id)
+    lists, lists_changed, items, items_changed = query.one()
+    if productlist_id is not None and not lists:
+        return None
+    last_modified = max(filter(None, (lists_changed, items_changed)), default=None)
+    etag = make_etag('productlist', created_by, productlist_id, request.query_string.decode(),
+                     lists, lists_changed, items, items_changed)
+    return etag, last_modified
+
+
+def with_items(productlists):
+    """
+    Swaps the productlists of a page for dicts carrying their items, loaded in
+    one query; marshalling the dynamic `items` relationship directly costs one
+    query per item.
+    """
+    ids = [productlist.id for productlist in productlists.items]
+    items = {}
+    if ids:
+        for item in ProductListItem.query.filter(
+                ProductListItem.productlist_id.in_(ids)).order_by(ProductListItem.id):
+            items.setdefault(item.productlist_id, []).append(item)
+    productlists.items = [{
+        'id': productlist.id,
+        'name': productlist.name,
+        'date_created': productlist.date_created,
+        'date_modified': productlist.date_modified,
+        'created_by': productlist.created_by,
+        'items': items.get(productlist.id, [])
+    } for productlist in productlists.items]
+    return productlists
+
+
+def get_purchase_history(page, per_page, product_id=None):
+    """
+    Purchases of the caller, or of one product for admins
+    """
+    user_data = g.user_data
+    if product_id is None:
+        query = PurchaseLogModel.history(user_id=user_data['user_id'])
+    else:
+        require_admin()
+        query = PurchaseLogModel.history(product_id=product_id)
+    purchases = paginate(query, page, per_page, None)
+    purchases.items = [row._asdict() for row in purchases.items]
+    return purchases
+
+
+def get_top_sellers(limit, day=None):
+    """
+    Best selling products overall, or on one UTC day
+    """
+    rows = ProductSales.top(limit) if day is None else ProductSalesDaily.top(day, limit)
+    return {'day': day, 'products': [row._asdict() for row in rows]}
+
+
+def get_product_sales(product_id, days):
+    """
+    Totals of one product and its daily sales over the last `days` days
+    """
+    product = db.session.query(ProductModel.id, ProductModel.item).filter(
+        ProductModel.id == product_id).first()
+    if product is None:
+        abort(404, 'Product not found')
+    totals = ProductSales.query.get(product_id)
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)
+    return {
+        'product_id': product.id,
+        'item': product.item,
+        'units': totals.units if totals else 0,
+        'purchases': totals.purchases if totals else 0,
+        'last_purchase': totals.last_purchase if totals else None,
+        'daily': [row._asdict() for row in ProductSalesDaily.series(product_id, since)]
+    }
+
+
+def get_top_buyers(limit):
+    require_admin()
+    return {'users': [row._asdict() for row in UserPurchaseTotals.top(limit)]}
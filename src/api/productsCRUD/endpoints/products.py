@@ -1,30 +1,51 @@
 import logging
 
-from flask import request
+import codecs
+from flask import request, Response, stream_with_context
 from flask_restplus import Resource
 
 from src.api.productsCRUD.business import create_productlist, delete_productlist, \
     update_productlist
 from src.api.productsCRUD.serializers import productlist, \
     productlist_item, page_of_productlist, page_of_product_items, productlist_input
-from src.api.productsCRUD.business import create_product_item, update_item, delete_item
+from src.api.productsCRUD.serializers import checkout as checkout_input
+from src.api.productsCRUD.serializers import page_of_purchase_logs, top_sellers, \
+    product_sales_detail, top_buyers
+from src.api.productsCRUD.business import create_product_item, update_item, delete_item, \
+    checkout, productlist_version, get_purchase_history, require_admin, with_items, \
+    get_top_sellers, get_product_sales, get_top_buyers, ProductService
+from src.api.conditional import conditional_get
 from src.api.restplus import api
-from src.models import ProductList
-from src.api.productsCRUD.parsers import pagination_arguments, search_argument
+from src.models import ProductList as ProductListModel, ProductListItem
+from src.api.pagination import keyset_paginate, paginate
+from src.api.productsCRUD.parsers import pagination_arguments, search_argument, export_arguments, \
+    import_arguments, top_arguments, top_sellers_arguments, product_sales_arguments, \
+    buy_arguments, product_list_arguments
+from src.api.productsCRUD.importer import import_products
+from src.api.productsCRUD.export import MIMETYPES, product_rows, purchase_rows, stream_rows
 from src.api.restplus import auth_required
-from flask import abort, current_app, _app_ctx_stack
+from flask import abort, g
+from werkzeug.exceptions import HTTPException
 
 log = logging.getLogger(__name__)
 
 ns = api.namespace('productsCRUD', description='Operations related to Products')
 
 
+def paginate_after(query, id_column, cursor, per_page, with_count):
+    try:
+        return keyset_paginate(query, [(id_column, False)], cursor, per_page, with_count)
+    except ValueError as e:
+        abort(400, str(e))
+
+
 @ns.route('/')
 class ProductListCollection(Resource):
 
-    @api.expect(pagination_arguments, search_argument, productlist)
-    @api.marshal_with(page_of_productlist)
+    @api.expect(pagination_arguments, search_argument)
     @auth_required
+    @conditional_get(lambda self: productlist_version())
+    @api.marshal_with(page_of_productlist)
     def get(self):
         """
         List all the created items list.
@@ -33,21 +54,33 @@ class ProductListCollection(Resource):
         args = pagination_arguments.parse_args(request)
         page = args.get('page', 1)
         per_page = args.get('per_page', 10)
+        cursor = args.get('cursor')
         search_term = search_args.get('q')
-        with current_app.app_context():
-            user_data = _app_ctx_stack.user_data
+        user_data = g.user_data
         if search_term:
-            search_query = ProductList.query.filter_by(created_by=user_data[
+            search_query = ProductListModel.query.filter_by(created_by=user_data[
                 'user_id'], name=search_term)
 
-            if search_query.count():
-                productlists = search_query.paginate(page, per_page, error_out=False)
-                return productlists, 200
+            if cursor is not None:
+                productlists = paginate_after(search_query, ProductListModel.id, cursor, per_page,
+                                              args.get('with_count'))
+                if productlists.items:
+                    return with_items(productlists), 200
+            else:
+                productlists = paginate(search_query, page, per_page,
+                                        ('productlist', user_data['user_id']), search_term)
+                if productlists.total:
+                    return with_items(productlists), 200
             abort(404, 'productlist not found')
         else:
-            productlist_query = ProductList.query.filter_by(created_by=user_data['user_id'])
-            productlists = productlist_query.paginate(page, per_page, error_out=False)
-            return productlists, 200
+            productlist_query = ProductListModel.query.filter_by(created_by=user_data['user_id'])
+            if cursor is not None:
+                productlists = paginate_after(productlist_query, ProductListModel.id, cursor,
+                                              per_page, args.get('with_count'))
+            else:
+                productlists = paginate(productlist_query, page, per_page,
+                                        ('productlist', user_data['user_id']))
+            return with_items(productlists), 200
 
     @api.response(201, 'Productlist successfully created.')
     @api.expect(productlist_input, validate=True)
@@ -65,9 +98,10 @@ class ProductListCollection(Resource):
 @api.response(404, 'Productlist Item not found.')
 class ProductList(Resource):
 
-    @api.expect(pagination_arguments, productlist)
-    @api.marshal_with(page_of_product_items)
+    @api.expect(pagination_arguments)
     @auth_required
+    @conditional_get(lambda self, id: productlist_version(id))
+    @api.marshal_with(page_of_product_items)
     def get(self, id):
         """
         Get single bucket list.
@@ -75,21 +109,29 @@ class ProductList(Resource):
         args = pagination_arguments.parse_args(request)
         page = args.get('page', 1)
         per_page = args.get('per_page', 10)
-        with current_app.app_context():
-            user_data = _app_ctx_stack.user_data
-            created_by = user_data['user_id']
+        user_data = g.user_data
+        created_by = user_data['user_id']
+        cursor = args.get('cursor')
         try:
-            productlist_query = ProductList.query.filter_by(created_by=created_by, id=id)
-            if not productlist_query.count():
+            productlist = ProductListModel.query.filter_by(created_by=created_by, id=id).first()
+            if not productlist:
                 abort(404)
-            product_items = productlist_query[0].items
-            productlist_items_paginated = product_items.paginate(page, per_page, error_out=False)
-            productlist_items_paginated.date_modified = productlist_query[0].date_modified
-            productlist_items_paginated.created_by = productlist_query[0].created_by
-            productlist_items_paginated.id = productlist_query[0].id
-            productlist_items_paginated.date_created = productlist_query[0].date_created
-            productlist_items_paginated.name = productlist_query[0].name
+            product_items = productlist.items
+            if cursor is not None:
+                productlist_items_paginated = paginate_after(product_items, ProductListItem.id, cursor,
+                                                             per_page, args.get('with_count'))
+            else:
+                productlist_items_paginated = paginate(product_items, page, per_page,
+                                                       ('productlistitem', productlist.id))
+            productlist_items_paginated.date_modified = productlist.date_modified
+            productlist_items_paginated.created_by = productlist.created_by
+            productlist_items_paginated.id = productlist.id
+            productlist_items_paginated.date_created = productlist.date_created
+            productlist_items_paginated.name = productlist.name
             return productlist_items_paginated
+        except HTTPException:
+            # e.g. the 400 for an invalid cursor
+            raise
         except Exception as e:
             abort(404, str(e))
 
@@ -153,3 +195,225 @@ class ProductlistItem(Resource):
         """
 
         return delete_item(id, item_id), 204
+
+
+@ns.route('/products')
+class ProductCollection(Resource):
+
+    @api.expect(product_list_arguments)
+    @api.response(400, 'Invalid cursor.')
+    def get(self):
+        """
+        List the catalog, or search it by item name.
+        * Without orderBy, prefix and substring matches are ranked by match quality.
+        """
+        args = product_list_arguments.parse_args(request)
+        data = ProductService.get_product_list(
+            args.get('searchByName'), args.get('orderBy'), args.get('page'), args.get('per_page'),
+            args.get('cursor'), args.get('withCount'), args.get('searchMode'))
+        if data.get('invalid_cursor'):
+            return data, 400
+
+        return data, 200
+
+
+@ns.route('/products/<int:id>')
+@api.param('id', 'Product ID')
+class Product(Resource):
+
+    @api.response(200, 'Product found.')
+    @api.response(304, 'Product not modified.')
+    @api.response(404, 'Product not found.')
+    @conditional_get(lambda self, id: ProductService.get_product_version(id))
+    def get(self, id):
+        """
+        Get a product, with the likes not yet written back.
+        * Answers 304 to a matching If-None-Match or If-Modified-Since.
+        """
+        data = ProductService.get_product(id)
+        if data.get('not_found'):
+            return data, 404
+
+        return data, 200
+
+
+@ns.route('/products/<int:id>/buy')
+@api.param('id', 'Product ID')
+class ProductBuy(Resource):
+
+    @api.expect(buy_arguments)
+    @api.response(200, 'Product bought.')
+    @api.response(404, 'Product not found.')
+    @api.response(409, 'Not enough stock.')
+    @auth_required
+    def post(self, id):
+        """
+        Buy units of one product.
+        """
+        args = buy_arguments.parse_args(request)
+        data = ProductService.buy_product(id, args.get('quantity'), g.user_data['user_id'])
+        if data.get('not_found'):
+            return data, 404
+        elif data.get('stock_not_enough'):
+            return data, 409
+        elif data.get('error'):
+            return data, 500
+
+        return data, 200
+
+
+@ns.route('/products/<int:id>/like')
+@api.param('id', 'Product ID')
+class ProductLike(Resource):
+
+    @api.response(200, 'Product liked.')
+    @api.response(404, 'Product not found.')
+    @auth_required
+    def post(self, id):
+        """
+        Like a product.
+        * The like is buffered and written back in batches.
+        """
+        data = ProductService.give_like_product(id)
+        if data.get('not_found'):
+            return data, 404
+
+        return data, 200
+
+
+@ns.route('/checkout')
+class Checkout(Resource):
+
+    @api.expect(checkout_input, validate=True)
+    @api.response(201, 'Checkout successful.')
+    @api.response(409, 'Not enough stock for some products.')
+    @auth_required
+    def post(self):
+        """
+        Buy every line of a cart in a single transaction.
+        """
+        return checkout(request.json)
+
+
+@ns.route('/purchases')
+class PurchaseHistory(Resource):
+
+    @api.expect(pagination_arguments)
+    @api.marshal_with(page_of_purchase_logs)
+    @auth_required
+    def get(self):
+        """
+        List the purchases of the current user, newest first.
+        """
+        args = pagination_arguments.parse_args(request)
+        return get_purchase_history(args.get('page', 1), args.get('per_page', 10))
+
+
+@ns.route('/purchases/product/<int:product_id>')
+@api.param('product_id', 'Product ID')
+class ProductPurchaseHistory(Resource):
+
+    @api.expect(pagination_arguments)
+    @api.marshal_with(page_of_purchase_logs)
+    @auth_required
+    def get(self, product_id):
+        """
+        List the purchases of a product, newest first. Admin only.
+        """
+        args = pagination_arguments.parse_args(request)
+        return get_purchase_history(args.get('page', 1), args.get('per_page', 10), product_id)
+
+
+@ns.route('/sales/top')
+class TopSellers(Resource):
+
+    @api.expect(top_sellers_arguments)
+    @api.marshal_with(top_sellers)
+    @auth_required
+    def get(self):
+        """
+        Best selling products by units, overall or on one day.
+        * Read from the sales aggregates, not the purchase log.
+        """
+        args = top_sellers_arguments.parse_args(request)
+        return get_top_sellers(args.get('limit'), args.get('day') and args.get('day').date())
+
+
+@ns.route('/sales/product/<int:product_id>')
+@api.param('product_id', 'Product ID')
+class ProductSalesTotals(Resource):
+
+    @api.expect(product_sales_arguments)
+    @api.marshal_with(product_sales_detail)
+    @api.response(404, 'Product not found.')
+    @auth_required
+    def get(self, product_id):
+        """
+        Units sold of a product, in total and per day.
+        """
+        args = product_sales_arguments.parse_args(request)
+        return get_product_sales(product_id, args.get('days'))
+
+
+@ns.route('/sales/buyers/top')
+class TopBuyers(Resource):
+
+    @api.expect(top_arguments)
+    @api.marshal_with(top_buyers)
+    @auth_required
+    def get(self):
+        """
+        Users who bought the most units. Admin only.
+        """
+        args = top_arguments.parse_args(request)
+        return get_top_buyers(args.get('limit'))
+
+
+def export_response(query, name, fmt):
+    require_admin()
+    return Response(stream_with_context(stream_rows(query, fmt)), mimetype=MIMETYPES[fmt],
+                    headers={'Content-Disposition': 'attachment; filename={}.{}'.format(name, fmt)})
+
+
+@ns.route('/export/purchases')
+class PurchaseExport(Resource):
+
+    @api.expect(export_arguments)
+    @auth_required
+    def get(self):
+        """
+        Stream every purchase log as NDJSON or CSV. Admin only.
+        """
+        args = export_arguments.parse_args(request)
+        return export_response(purchase_rows(args.get('since'), args.get('until')),
+                               'purchases', args.get('format'))
+
+
+@ns.route('/export/products')
+class ProductExport(Resource):
+
+    @api.expect(export_arguments)
+    @auth_required
+    def get(self):
+        """
+        Stream the whole catalog as NDJSON or CSV. Admin only.
+        """
+        args = export_arguments.parse_args(request)
+        return export_response(product_rows(), 'products', args.get('format'))
+
+
+@ns.route('/import')
+class ProductImport(Resource):
+
+    @api.expect(import_arguments)
+    @api.response(201, 'Products imported.')
+    @auth_required
+    def post(self):
+        """
+        Bulk load products from a CSV or NDJSON request body. Admin only.
+        * Rows need item, npc, stock and price; items that already exist are skipped.
+        """
+        require_admin()
+        args = import_arguments.parse_args(request)
+        stream = codecs.getreader('utf-8')(request.stream)
+        return import_products(stream, args.get('format'), args.get('chunk_size')), 201
@@ -0,0 +1,53 @@
+import csv
+import io
+import json
+from src.models import ProductModel, PurchaseLogModel
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def purchase_rows(since=None, until=None):
+    query = PurchaseLogModel.query.with_entities(
+        PurchaseLogModel.id, PurchaseLogModel.user_id, PurchaseLogModel.product_id,
+        PurchaseLogModel.purchase_quantity, PurchaseLogModel.datetime)
+    if since is not None:
+        query = query.filter(PurchaseLogModel.datetime >= since)
+    if until is not None:
+        query = query.filter(PurchaseLogModel.datetime < until)
+    return query.order_by(PurchaseLogModel.id)
+
+
+def product_rows():
+    return ProductModel.query.with_entities(
+        ProductModel.id, ProductModel.item, ProductModel.npc, ProductModel.stock,
+        ProductModel.price, ProductModel.likes, ProductModel.last_update
+    ).order_by(ProductModel.id)
+
+
+def stream_rows(query, fmt, batch_size=1000):
+    """
+    Yields the rows of a column query as NDJSON or CSV text, batch_size rows
+    per chunk, reading them through a server side cursor so memory stays flat.
+    """
+    columns = [column['name'] for column in query.column_descriptions]
+    rows = query.execution_options(stream_results=True).yield_per(batch_size)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    pending = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row)), default=str))
+            buffer.write('\n')
+        pending += 1
+        if pending >= batch_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue()
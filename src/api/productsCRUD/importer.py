@@ -0,0 +1,122 @@
+import csv
+import datetime
+import io
+import json
+import time
+from itertools import islice
+from src.models import db, ProductModel
+from src.api.pagination import count_cache
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+COPY_COLUMNS = ('item', 'npc', 'stock', 'price', 'likes', 'last_update')
+# stays below SQLite's default limit of 999 bound parameters
+LOOKUP_BATCH = 500
+
+
+def read_rows(stream, fmt):
+    """
+    CSV rows as dicts; NDJSON lines are left unparsed so a malformed line
+    only counts as one invalid row (see parse_row)
+    """
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+    else:
+        for line in stream:
+            if line.strip():
+                yield line
+
+
+def parse_row(raw, fmt):
+    """
+    :raise ValueError: on a malformed NDJSON line
+    """
+    return json.loads(raw) if fmt == 'ndjson' else raw
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def normalise(row, now):
+    """
+    :raise KeyError|TypeError|ValueError: on a missing or malformed field
+    """
+    item = str(row['item']).strip()
+    if not item:
+        raise ValueError('item cannot be blank')
+    return {
+        'item': item,
+        'npc': row.get('npc'),
+        'stock': int(row['stock']),
+        'price': float(row['price']),
+        'likes': 0,
+        'last_update': now
+    }
+
+
+def existing_items(items):
+    found = set()
+    for batch in chunked(items, LOOKUP_BATCH):
+        found.update(item for item, in db.session.query(ProductModel.item).filter(
+            ProductModel.item.in_(batch)))
+    return found
+
+
+def copy_rows(rows):
+    # COPY runs on the session's connection, so it commits with the session
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in COPY_COLUMNS])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(
+            ProductModel.__tablename__, ', '.join(COPY_COLUMNS)), buffer)
+    finally:
+        cursor.close()
+
+
+def import_products(stream, fmt='csv', chunk_size=5000):
+    """
+    Inserts new products from a CSV/NDJSON text stream, one transaction per chunk.
+    Items that already exist, or repeat within the import, are skipped.
+    :return: dict of counters and throughput
+    """
+    stats = {'read': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0}
+    use_copy = db.engine.dialect.name == 'postgresql'
+    started = time.time()
+    for chunk in chunked(read_rows(stream, fmt), chunk_size):
+        now = datetime.datetime.utcnow()
+        rows = {}
+        for raw in chunk:
+            stats['read'] += 1
+            try:
+                row = normalise(parse_row(raw, fmt), now)
+            except (KeyError, TypeError, ValueError):
+                stats['invalid'] += 1
+                continue
+            if row['item'] in rows:
+                stats['duplicates'] += 1
+            else:
+                rows[row['item']] = row
+        existing = existing_items(list(rows))
+        new_rows = [row for item, row in rows.items() if item not in existing]
+        stats['duplicates'] += len(rows) - len(new_rows)
+        if new_rows:
+            if use_copy:
+                copy_rows(new_rows)
+            else:
+                db.session.bulk_insert_mappings(ProductModel, new_rows)
+            db.session.commit()
+        stats['inserted'] += len(new_rows)
+    count_cache.invalidate('products')
+
+    stats['seconds'] = round(time.time() - started, 3)
+    stats['rows_per_second'] = round(stats['read'] / stats['seconds']) if stats['seconds'] else None
+    return stats
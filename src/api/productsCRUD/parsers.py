@@ -1,10 +1,61 @@
-from flask_restplus import reqparse
+from flask_restplus import reqparse, inputs
+from src.api.productsCRUD.search import SEARCH_MODES
 
 pagination_arguments = reqparse.RequestParser()
 pagination_arguments.add_argument('page', type=int, required=False, default=1, help='Page number')
 pagination_arguments.add_argument('bool', type=bool, required=False, default=1, help='Page number')
 pagination_arguments.add_argument('per_page', type=int, required=False, choices=[2, 10, 20, 30, 40, 50],
                                   default=10, help='Results per page {error_msg}')
+pagination_arguments.add_argument('cursor', type=str, required=False,
+                                  help='Cursor from next_cursor, switches to keyset pagination')
+pagination_arguments.add_argument('with_count', type=inputs.boolean, required=False, default=False,
+                                  help='Include the total in keyset pagination')
 
 search_argument = reqparse.RequestParser()
-search_argument.add_argument('q', type=str, required=False, help='item to search')
\ No newline at end of file
+search_argument.add_argument('q', type=str, required=False, help='item to search')
+
+export_arguments = reqparse.RequestParser()
+export_arguments.add_argument('format', type=str, required=False, choices=['ndjson', 'csv'],
+                              default='ndjson', help='Export format {error_msg}')
+export_arguments.add_argument('since', type=inputs.datetime_from_iso8601, required=False,
+                              help='Only purchases at or after this ISO 8601 datetime')
+export_arguments.add_argument('until', type=inputs.datetime_from_iso8601, required=False,
+                              help='Only purchases before this ISO 8601 datetime')
+
+import_arguments = reqparse.RequestParser()
+import_arguments.add_argument('format', type=str, required=False, choices=['csv', 'ndjson'],
+                              default='csv', help='Format of the request body {error_msg}')
+import_arguments.add_argument('chunk_size', type=inputs.int_range(1, 50000), required=False,
+                              default=5000, help='Rows per transaction')
+
+top_arguments = reqparse.RequestParser()
+top_arguments.add_argument('limit', type=inputs.int_range(1, 100), required=False, default=10,
+                           help='Number of entries {error_msg}')
+
+top_sellers_arguments = top_arguments.copy()
+top_sellers_arguments.add_argument('day', type=inputs.date, required=False,
+                                   help='UTC day (YYYY-MM-DD) instead of all time')
+
+product_sales_arguments = reqparse.RequestParser()
+product_sales_arguments.add_argument('days', type=inputs.int_range(1, 366), required=False,
+                                     default=30, help='Days of daily sales {error_msg}')
+
+buy_arguments = reqparse.RequestParser()
+buy_arguments.add_argument('quantity', type=inputs.positive, required=True,
+                           help='Units to buy {error_msg}')
+
+product_list_arguments = reqparse.RequestParser()
+product_list_arguments.add_argument('per_page', type=inputs.positive, required=True,
+                                    help='Results per page {error_msg}')
+product_list_arguments.add_argument('page', type=inputs.positive, required=False, default=1,
+                                    help='Page number')
+product_list_arguments.add_argument('orderBy', type=str, action='append', required=False,
+                                    help='item or likes, may be repeated')
+product_list_arguments.add_argument('searchByName', type=str, required=False,
+                                    help='Item name to search')
+product_list_arguments.add_argument('searchMode', type=str, required=False, choices=SEARCH_MODES,
+                                    default='exact', help='Search mode {error_msg}')
+product_list_arguments.add_argument('cursor', type=str, required=False,
+                                    help='Cursor from the next link, switches to keyset pagination')
+product_list_arguments.add_argument('withCount', type=inputs.boolean, required=False,
+                                    default=False, help='Include the total in keyset pagination')
@@ -0,0 +1,139 @@
+import threading
+import time
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from sqlalchemy import case, func
+from src.models import db, ProductModel
+from src.api.pagination import count_cache, paginate
+
+SEARCH_MODES = ('exact', 'prefix', 'substring')
+
+
+class NGramIndex(object):
+    """
+    In-process trigram index over product items, used for small catalogs.
+
+    The index is rebuilt lazily once a committed product write bumps the
+    'products' count cache generation, or after `ttl` seconds to pick up
+    writes from other processes.
+    """
+
+    def __init__(self, n=3, ttl=60):
+        self.n = n
+        self.ttl = ttl
+        self._names = {}
+        self._postings = {}
+        self._generation = None
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    def _grams(self, text):
+        return {text[i:i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def build(self, rows):
+        names, postings = {}, {}
+        for _id, item in rows:
+            name = (item or '').lower()
+            names[_id] = name
+            for gram in self._grams(name):
+                postings.setdefault(gram, set()).add(_id)
+        self._names, self._postings = names, postings
+
+    def refresh(self):
+        generation = count_cache.generation('products')
+        if self._generation == generation and time.time() - self._built_at < self.ttl:
+            return
+        with self._lock:
+            if self._generation == generation and time.time() - self._built_at < self.ttl:
+                return
+            self.build(db.session.query(ProductModel.id, ProductModel.item))
+            self._generation = generation
+            self._built_at = time.time()
+
+    def search(self, term, mode):
+        """
+        :return: matching product ids, best match first
+        """
+        term = term.lower()
+        names = self._names
+        if len(term) < self.n:
+            candidates = names
+        else:
+            grams = sorted(self._grams(term), key=lambda gram: len(self._postings.get(gram, ())))
+            candidates = set(self._postings.get(grams[0], ()))
+            for gram in grams[1:]:
+                candidates &= self._postings.get(gram, set())
+                if not candidates:
+                    break
+        ranked = []
+        for _id in candidates:
+            name = names[_id]
+            position = name.find(term)
+            if position < 0 or (mode == 'prefix' and position > 0):
+                continue
+            ranked.append((name != term, position, name, _id))
+        ranked.sort()
+        return [_id for _, _, _, _id in ranked]
+
+
+ngram_index = NGramIndex()
+
+
+def init_app(flask_app):
+    ngram_index.ttl = flask_app.config.get('SEARCH_NGRAM_TTL', ngram_index.ttl)
+
+
+def _like_pattern(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _is_postgresql():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def search_filter(term, mode):
+    item = ProductModel.item
+    if mode == 'exact':
+        return item == term
+    if _is_postgresql():
+        # both patterns are served by the pg_trgm GIN index on products.item
+        if mode == 'prefix':
+            return item.ilike(_like_pattern(term) + '%', escape='\\')
+        return item.ilike('%' + _like_pattern(term) + '%', escape='\\')
+    lowered = term.lower()
+    if mode == 'prefix':
+        # a range over lower(item) can use ix_products_item_lower
+        return (func.lower(item) >= lowered) & (func.lower(item) < lowered + u'\U0010ffff')
+    return func.instr(func.lower(item), lowered) > 0
+
+
+def search_rank(term, mode):
+    item = ProductModel.item
+    if mode == 'exact':
+        return [ProductModel.id]
+    lowered = term.lower()
+    exact_first = case([(func.lower(item) == lowered, 0)], else_=1)
+    if _is_postgresql():
+        return [exact_first, func.similarity(item, term).desc(), func.lower(item), ProductModel.id]
+    return [exact_first, func.instr(func.lower(item), lowered), func.lower(item), ProductModel.id]
+
+
+def search_products(term, mode, order_by, page, per_page):
+    """
+    Page of products matching term, ranked by match quality unless order_by is given.
+    :return: Pagination
+    """
+    if mode != 'exact' and not order_by and \
+            count_cache.count('products', None, ProductModel.query) <= \
+            current_app.config.get('SEARCH_NGRAM_MAX_PRODUCTS', 0):
+        ngram_index.refresh()
+        ids = ngram_index.search(term, mode)
+        page_ids = ids[(page - 1) * per_page:page * per_page]
+        rows = {product.id: product for product in
+                ProductModel.query.filter(ProductModel.id.in_(page_ids))} if page_ids else {}
+        items = [rows[_id] for _id in page_ids if _id in rows]
+        return Pagination(None, page, per_page, len(ids), items)
+
+    query = ProductModel.query.filter(search_filter(term, mode))
+    query = query.order_by(*(order_by or search_rank(term, mode)))
+    return paginate(query, page, per_page, 'products', (mode, term))
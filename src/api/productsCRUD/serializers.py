@@ -19,6 +19,7 @@ pagination = api.model('A page of results', {
     'pages': fields.Integer(description='Total number of pages of results'),
     'per_page': fields.Integer(description='Number of items per page of results'),
     'total': fields.Integer(description='Total number of results'),
+    'next_cursor': fields.String(description='Cursor of the next page in keyset pagination'),
 })
 
 productlist_input = api.model('Productlist', {
@@ -50,3 +51,61 @@ page_of_product_items = api.inherit('Page of productlist item', productlist,
                                     pagination,
                                     {'items': fields.List(fields.Nested(productlist_item_output))
 })
+
+checkout_line = api.model('Checkout line', {
+    'product_id': fields.Integer(required=True, min=1, example=1),
+    'quantity': fields.Integer(required=True, min=1, example=2)
+})
+
+checkout = api.model('Checkout', {
+    'items': fields.List(fields.Nested(checkout_line), required=True, min_items=1)
+})
+
+purchase_log = api.model('Purchase log', {
+    'id': fields.Integer(readOnly=True),
+    'user': fields.String(description='email of the buyer'),
+    'product_id': fields.Integer,
+    'item': fields.String,
+    'price': fields.Float,
+    'purchase_quantity': fields.Integer,
+    'datetime': fields.DateTime
+})
+
+page_of_purchase_logs = api.inherit('Page of purchase logs', pagination, {
+    'items': fields.List(fields.Nested(purchase_log))
+})
+
+product_sales = api.model('Product sales', {
+    'product_id': fields.Integer,
+    'item': fields.String,
+    'units': fields.Integer(description='units sold'),
+    'purchases': fields.Integer(description='purchase log entries'),
+    'last_purchase': fields.DateTime
+})
+
+top_sellers = api.model('Top sellers', {
+    'day': fields.Date(description='UTC day, null for all time'),
+    'products': fields.List(fields.Nested(product_sales))
+})
+
+daily_sales = api.model('Daily sales', {
+    'day': fields.Date,
+    'units': fields.Integer,
+    'purchases': fields.Integer
+})
+
+product_sales_detail = api.inherit('Product sales detail', product_sales, {
+    'daily': fields.List(fields.Nested(daily_sales))
+})
+
+buyer_totals = api.model('Buyer totals', {
+    'user_id': fields.Integer,
+    'email': fields.String,
+    'units': fields.Integer(description='units bought'),
+    'purchases': fields.Integer(description='purchase log entries'),
+    'last_purchase': fields.DateTime
+})
+
+top_buyers = api.model('Top buyers', {
+    'users': fields.List(fields.Nested(buyer_totals))
+})
@@ -2,7 +2,7 @@ import logging
 import traceback
 from flask_restplus import Api
 from sqlalchemy.orm.exc import NoResultFound
-from flask import request, json, abort, current_app, _app_ctx_stack
+from flask import request, abort, current_app, g
 from functools import wraps
 
 
@@ -31,15 +31,9 @@ def auth_required(func):
         token = request.headers['X-API-TOKEN']
         auth_token = 'Bearer ' + token
         from src.api.auth.business import auth_status
-        res = auth_status(auth_token)
-        resobj = json.dumps(res)
-        resjson = json.loads(resobj)
-        status_code = resjson[-1]
-        data = resjson[0]
+        data, status_code = auth_status(auth_token)
         if data['status'] == 'success':
-            with current_app.app_context():
-                ctxapp = _app_ctx_stack
-                ctxapp.user_data = data['data']
+            g.user_data = data['data']
             return func(*args, **kwargs)
 
         responseObject = {
@@ -7,13 +7,24 @@ from flask import Flask, Blueprint
 # from src.api.productsCRUD.business import Product, ProductBuy, ProductLike, ProductList
 from src.api.productsCRUD.endpoints.products import ns as productsCRUD_namespace
 from src.api.auth.endpoints.user_profile import ns as auth_namespace
+from src.api.internal.endpoints.stats import ns as internal_namespace
 from src.api.restplus import api
+from src.api.auth import cache as auth_cache
+from src.api.auth.hashing import password_hasher
+from src.api.pagination import count_cache
+from src import instrumentation, profiler
+from src.api.productsCRUD import search as product_search
 from src.models import db
+from src.blacklist import token_blacklist
+from src.events import event_bus
+from src.mailer import mailer
+from src.cache import product_cache
+from src.likes import like_buffer
 from flask_mail import Mail
 from flask_bcrypt import Bcrypt
 
 app = Flask(__name__)
-logging.config.fileConfig('logging.conf')
+logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
 app.config.from_pyfile('config.py')
 log = logging.getLogger(__name__)
 mail = Mail()
@@ -24,18 +35,37 @@ def configure_app(flask_app):
     flask_app.config.from_object(os.environ['APP_SETTINGS'])
 
 
-def initialize_app(flask_app):
+def initialize_app(flask_app, create_tables=True):
+    """
+    :param create_tables: False leaves the schema to the migrations, as manage.py does
+    """
     configure_app(flask_app)
 
     blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
     api.init_app(blueprint)
     api.add_namespace(auth_namespace)
     api.add_namespace(productsCRUD_namespace)
+    if flask_app.config.get('INTERNAL_ENDPOINTS_ENABLED'):
+        api.add_namespace(internal_namespace)
+    instrumentation.init_app(flask_app, blueprint)
+    profiler.init_app(flask_app, blueprint)
     flask_app.register_blueprint(blueprint)
     mail.init_app(flask_app)
-    db.init_app(flask_app)
-    with flask_app.app_context():
-        db.create_all()
+    auth_cache.init_app(flask_app)
+    password_hasher.init_app(flask_app)
+    count_cache.init_app(flask_app)
+    product_search.init_app(flask_app)
+    product_cache.init_app(flask_app)
+    if 'sqlalchemy' not in flask_app.extensions:
+        # manage.py binds the database on its own for the db commands
+        db.init_app(flask_app)
+    if create_tables:
+        with flask_app.app_context():
+            db.create_all()
+    token_blacklist.init_app(flask_app)
+    like_buffer.init_app(flask_app)
+    event_bus.init_app(flask_app)
+    mailer.init_app(flask_app)
     return flask_app
 
 
@@ -0,0 +1,102 @@
+"""
+Throughput of the analytics event worker over the memory:// transport:
+publishes a fixed number of purchase and like events, then drains them
+with each batch size / concurrency combination and reports messages/s.
+
+    python -m src.benchmarks.event_worker --messages 50000
+    python -m src.benchmarks.event_worker --handlers db --database-url sqlite:////tmp/events.db
+
+With --handlers noop the handlers discard their batch, which measures the
+broker, batching, dedup and acking overhead on its own; --handlers db
+writes purchase logs and likes like the real worker.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+
+def publish(connection, count, products):
+    from kombu import Producer
+    from src.events import ANALYTICS_QUEUE, EXCHANGE, LIKE, PURCHASE, like_event, purchase_event
+
+    ANALYTICS_QUEUE(connection.default_channel).declare()
+    producer = Producer(connection.default_channel, exchange=EXCHANGE, serializer='json')
+    for i in range(count):
+        product_id = i % products + 1
+        if i % 2:
+            producer.publish(like_event(product_id), routing_key=LIKE)
+        else:
+            producer.publish(purchase_event(1, {product_id: 1}), routing_key=PURCHASE)
+
+
+def run(flask_app, connection, args, batch_size, concurrency, handlers):
+    from src.worker import Worker
+
+    publish(connection, args.messages, args.products)
+    worker = Worker(connection, flask_app, prefetch_count=batch_size * (concurrency + 1),
+                    batch_size=batch_size, batch_timeout=args.batch_timeout,
+                    concurrency=concurrency, handlers=handlers)
+    started = time.perf_counter()
+    acknowledged = worker.drain(timeout=0.05)
+    elapsed = time.perf_counter() - started
+    return OrderedDict([
+        ('batch_size', batch_size),
+        ('concurrency', concurrency),
+        ('messages', acknowledged),
+        ('seconds', round(elapsed, 3)),
+        ('messages_per_second', round(acknowledged / elapsed)),
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--batch-sizes', default='1,100,500,2000')
+    parser.add_argument('--concurrency', default='1,4')
+    parser.add_argument('--batch-timeout', type=float, default=0.05)
+    parser.add_argument('--handlers', choices=['noop', 'db'], default='noop')
+    parser.add_argument('--database-url', default='sqlite:////tmp/event_worker.db')
+    parser.add_argument('--output', metavar='PATH')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('APP_SETTINGS', 'src.config.TestingConfig')
+    os.environ['TEST_DATABASE_URI'] = args.database_url
+    from kombu import Connection
+    from src.app import app, initialize_app
+    from src.events import LIKE, PURCHASE
+    from src.models import db, UserModel, ProductModel
+
+    initialize_app(app)
+    handlers = None
+    if args.handlers == 'noop':
+        handlers = {PURCHASE: lambda events: None, LIKE: lambda events: None}
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(UserModel('events@example.com', 'secret', 'user'))
+        db.session.add_all([ProductModel('product {}'.format(i), 'npc', 100, 1.0)
+                            for i in range(args.products)])
+        db.session.commit()
+
+    results = []
+    with Connection('memory://') as connection:
+        for batch_size, concurrency in itertools.product(
+                [int(size) for size in args.batch_sizes.split(',')],
+                [int(threads) for threads in args.concurrency.split(',')]):
+            result = run(app, connection, args, batch_size, concurrency, handlers)
+            results.append(result)
+            print('batch {batch_size:>5} x {concurrency} threads: {messages} messages in '
+                  '{seconds}s, {messages_per_second} msg/s'.format(**result))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'handlers': args.handlers, 'results': results}, out, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
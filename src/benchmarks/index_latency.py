@@ -0,0 +1,145 @@
+"""
+Times the hot lookup queries against a seeded database with and without the
+secondary indexes declared on the models.
+
+    python -m src.benchmarks.index_latency --users 20000 --products 50000
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import time
+from sqlalchemy import create_engine, func, select
+from src.models import db
+
+metadata = db.Model.metadata
+users = metadata.tables['users']
+products = metadata.tables['products']
+purchase_logs = metadata.tables['purchase_logs']
+blacklist_tokens = metadata.tables['blacklist_tokens']
+productlist = metadata.tables['productlist']
+productlistitem = metadata.tables['productlistitem']
+
+START = datetime.datetime(2018, 1, 1)
+
+
+def insert(conn, table, rows, batch_size=10000):
+    for i in range(0, len(rows), batch_size):
+        conn.execute(table.insert(), rows[i:i + batch_size])
+
+
+def seed(engine, sizes, rng):
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        insert(conn, users, [{'id': i, 'email': 'user{}@example.com'.format(i), 'role': 'user'}
+                             for i in range(1, sizes.users + 1)])
+        insert(conn, products, [{'id': i, 'item': 'product {}'.format(i), 'stock': 100,
+                                 'price': 9.99, 'likes': 0} for i in range(1, sizes.products + 1)])
+        insert(conn, purchase_logs, [{
+            'user_id': rng.randint(1, sizes.users),
+            'product_id': rng.randint(1, sizes.products),
+            'purchase_quantity': 1,
+            'datetime': START + datetime.timedelta(minutes=i)
+        } for i in range(sizes.purchases)])
+        insert(conn, blacklist_tokens, [{
+            'token_hash': hashlib.sha256(str(i).encode()).hexdigest(),
+            'blacklisted_on': START + datetime.timedelta(seconds=i)
+        } for i in range(sizes.tokens)])
+        insert(conn, productlist, [{'id': i, 'name': 'list {}'.format(i),
+                                    'created_by': rng.randint(1, sizes.users)}
+                                   for i in range(1, sizes.lists + 1)])
+        insert(conn, productlistitem, [{'item': 'product {}'.format(i),
+                                        'productlist_id': rng.randint(1, sizes.lists)}
+                                       for i in range(sizes.lists * 10)])
+
+
+def queries(sizes, rng):
+    """
+    :return: {name: callable returning a fresh statement}
+    """
+    def in_range(limit):
+        return rng.randint(1, limit)
+
+    return {
+        'user_by_email': lambda: select([users]).where(
+            users.c.email == 'user{}@example.com'.format(in_range(sizes.users))),
+        'blacklisted_token': lambda: select([blacklist_tokens.c.id]).where(
+            blacklist_tokens.c.token_hash ==
+            hashlib.sha256(str(in_range(sizes.tokens)).encode()).hexdigest()),
+        'product_by_item': lambda: select([products]).where(
+            products.c.item == 'product {}'.format(in_range(sizes.products))),
+        'product_by_lower_item': lambda: select([products]).where(
+            func.lower(products.c.item) == 'product {}'.format(in_range(sizes.products))),
+        'purchases_by_user': lambda: select([purchase_logs]).where(
+            purchase_logs.c.user_id == in_range(sizes.users)),
+        'purchases_by_product': lambda: select([purchase_logs]).where(
+            purchase_logs.c.product_id == in_range(sizes.products)),
+        'purchases_by_day': lambda: select([purchase_logs]).where(purchase_logs.c.datetime.between(
+            START + datetime.timedelta(minutes=in_range(sizes.purchases)),
+            START + datetime.timedelta(minutes=in_range(sizes.purchases) + 1440))),
+        'productlists_by_owner': lambda: select([productlist]).where(
+            productlist.c.created_by == in_range(sizes.users)).order_by(productlist.c.id).limit(20),
+        'items_by_productlist': lambda: select([productlistitem]).where(
+            productlistitem.c.productlist_id == in_range(sizes.lists)).order_by(
+            productlistitem.c.id).limit(20),
+    }
+
+
+def measure(engine, statements, repeat):
+    """
+    :return: {name: median latency in milliseconds}
+    """
+    results = {}
+    with engine.connect() as conn:
+        for name, statement in sorted(statements.items()):
+            timings = []
+            for _ in range(repeat):
+                query = statement()
+                started = time.perf_counter()
+                conn.execute(query).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            results[name] = round(timings[len(timings) // 2], 3)
+    return results
+
+
+def secondary_indexes():
+    return [index for table in metadata.sorted_tables for index in table.indexes]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database-url', default='sqlite:///index_latency.db')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--purchases', type=int, default=200000)
+    parser.add_argument('--tokens', type=int, default=50000)
+    parser.add_argument('--lists', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    sizes = parser.parse_args(argv)
+
+    engine = create_engine(sizes.database_url)
+    seed(engine, sizes, random.Random(sizes.seed))
+    indexes = secondary_indexes()
+
+    for index in indexes:
+        index.drop(engine)
+    before = measure(engine, queries(sizes, random.Random(sizes.seed)), sizes.repeat)
+    for index in indexes:
+        index.create(engine)
+    if engine.dialect.name == 'postgresql':
+        engine.execute('ANALYZE')
+    after = measure(engine, queries(sizes, random.Random(sizes.seed)), sizes.repeat)
+
+    print(json.dumps({
+        name: {'before_ms': before[name], 'after_ms': after[name],
+               'speedup': round(before[name] / after[name], 1) if after[name] else None}
+        for name in sorted(before)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
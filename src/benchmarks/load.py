@@ -0,0 +1,437 @@
+"""
+Load test of the API: seeds a database, replays session mixes against the
+real Flask app and reports latency percentiles and throughput per endpoint.
+
+Run it from the repository root (the app reads logging.conf from there):
+
+    python -m src.benchmarks.load --users 1000 --products 10000 --sessions 500
+    python -m src.benchmarks.load --server --workers 4 --concurrency 16
+    python -m src.benchmarks.load --record workload.jsonl
+    python -m src.benchmarks.load --replay workload.jsonl --baseline before.json
+
+A run is reproducible from its --seed and sizes, which are stored in the
+result and in recorded workloads, so results of different commits compare.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+PASSWORD = 'benchmark'
+
+# session mixes: lists of step names, expanded by `steps` below
+MIXES = OrderedDict([
+    ('browse', ['login', 'status', 'list_productlists', 'get_productlist', 'list_productlists',
+                'get_productlist', 'logout']),
+    ('purchase', ['login', 'list_productlists', 'buy', 'buy', 'purchases', 'logout']),
+    ('session', ['login', 'status', 'list_productlists', 'get_productlist', 'buy', 'purchases',
+                 'logout']),
+    ('catalog', ['login', 'search_products', 'get_product', 'like_product', 'get_product',
+                 'buy_product', 'logout']),
+])
+
+
+def parse_mix(value):
+    """
+    :param value: e.g. 'browse=3,purchase=1'
+    :return: OrderedDict of mix name -> weight
+    """
+    weights = OrderedDict()
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in MIXES:
+            raise argparse.ArgumentTypeError('Unknown mix {!r}, choose from {}'.format(
+                name, ', '.join(MIXES)))
+        weights[name] = int(weight or 1)
+    return weights
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(samples, elapsed):
+    """
+    :param samples: [(latency seconds, ok)]
+    """
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    return OrderedDict([
+        ('count', len(samples)),
+        ('errors', sum(1 for _, ok in samples if not ok)),
+        ('p50_ms', round(percentile(latencies, 0.50), 3) if latencies else None),
+        ('p95_ms', round(percentile(latencies, 0.95), 3) if latencies else None),
+        ('p99_ms', round(percentile(latencies, 0.99), 3) if latencies else None),
+        ('mean_ms', round(sum(latencies) / len(latencies), 3) if latencies else None),
+        ('throughput_rps', round(len(samples) / elapsed, 1) if elapsed else None),
+    ])
+
+
+# -- seeding ------------------------------------------------------------------
+
+def seed(database_url, sizes):
+    """
+    (Re)creates every table and fills it deterministically: user i owns
+    productlists [(i - 1) * lists_per_user + 1, i * lists_per_user].
+    """
+    import bcrypt
+    from sqlalchemy import create_engine
+    from src.models import db
+
+    metadata = db.Model.metadata
+    tables = metadata.tables
+    rng = random.Random(sizes['seed'])
+    engine = create_engine(database_url)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    rounds = int(os.environ.get('BENCHMARK_BCRYPT_ROUNDS', 13))
+    # one hash shared by all users: verifying it costs the same as distinct hashes
+    password = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds)).decode()
+
+    def insert(table, rows):
+        for i in range(0, len(rows), 5000):
+            conn.execute(tables[table].insert(), rows[i:i + 5000])
+
+    with engine.begin() as conn:
+        insert('users', [{'id': i, 'email': user_email(i), 'password': password, 'role': 'user'}
+                         for i in range(1, sizes['users'] + 1)])
+        insert('products', [{'id': i, 'item': 'product {}'.format(i), 'npc': 'npc', 'stock': 10 ** 9,
+                             'price': round(rng.uniform(1, 100), 2), 'likes': 0}
+                            for i in range(1, sizes['products'] + 1)])
+        lists = sizes['users'] * sizes['lists_per_user']
+        insert('productlist', [{'id': i, 'name': 'list {}'.format(i),
+                                'created_by': (i - 1) // sizes['lists_per_user'] + 1}
+                               for i in range(1, lists + 1)])
+        insert('productlistitem', [{'item': 'item {}'.format(i), 'productlist_id': list_id,
+                                    'likes': False}
+                                   for list_id in range(1, lists + 1)
+                                   for i in range(sizes['items_per_list'])])
+    engine.dispose()
+
+
+def user_email(i):
+    return 'user{}@benchmark.local'.format(i)
+
+
+# -- workload -----------------------------------------------------------------
+
+def steps(name, user, rng, sizes):
+    """
+    :return: [step name, method, path, json body]
+    """
+    if name == 'login':
+        return [name, 'POST', '/api/v1/auth/login', {'email': user_email(user), 'password': PASSWORD}]
+    if name == 'status':
+        return [name, 'GET', '/api/v1/auth/status', None]
+    if name == 'list_productlists':
+        return [name, 'GET', '/api/v1/productsCRUD/?page=1&per_page=10', None]
+    if name == 'get_productlist':
+        productlist_id = (user - 1) * sizes['lists_per_user'] + rng.randint(1, sizes['lists_per_user'])
+        return [name, 'GET', '/api/v1/productsCRUD/{}?page=1&per_page=10'.format(productlist_id), None]
+    if name == 'buy':
+        return [name, 'POST', '/api/v1/productsCRUD/checkout',
+                {'items': [{'product_id': rng.randint(1, sizes['products']), 'quantity': 1}]}]
+    if name == 'search_products':
+        return [name, 'GET', '/api/v1/productsCRUD/products?searchByName=product+{}&searchMode='
+                'prefix&per_page=10'.format(rng.randint(1, 99)), None]
+    if name == 'get_product':
+        return [name, 'GET', '/api/v1/productsCRUD/products/{}'.format(
+            rng.randint(1, sizes['products'])), None]
+    if name == 'like_product':
+        return [name, 'POST', '/api/v1/productsCRUD/products/{}/like'.format(
+            rng.randint(1, sizes['products'])), None]
+    if name == 'buy_product':
+        return [name, 'POST', '/api/v1/productsCRUD/products/{}/buy?quantity=1'.format(
+            rng.randint(1, sizes['products'])), None]
+    if name == 'purchases':
+        return [name, 'GET', '/api/v1/productsCRUD/purchases?page=1&per_page=10', None]
+    if name == 'logout':
+        return [name, 'POST', '/api/v1/auth/logout', None]
+    raise ValueError(name)
+
+
+def generate(sizes, mix, sessions):
+    rng = random.Random(sizes['seed'])
+    names, weights = list(mix), list(mix.values())
+    workload = []
+    for _ in range(sessions):
+        name = rng.choices(names, weights)[0]
+        user = rng.randint(1, sizes['users'])
+        workload.append({'mix': name, 'steps': [steps(step, user, rng, sizes) for step in MIXES[name]]})
+    return workload
+
+
+def save_workload(path, sizes, workload):
+    with open(path, 'w') as f:
+        f.write(json.dumps({'sizes': sizes}) + '\n')
+        for session in workload:
+            f.write(json.dumps(session) + '\n')
+
+
+def load_workload(path):
+    with open(path) as f:
+        sizes = json.loads(f.readline())['sizes']
+        return sizes, [json.loads(line) for line in f if line.strip()]
+
+
+# -- drivers ------------------------------------------------------------------
+
+class ClientDriver(object):
+    """
+    Sends requests through the Flask test client, in process.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+
+    def request(self, method, path, body, token):
+        headers = {'X-API-TOKEN': token} if token else {}
+        kwargs = {'data': json.dumps(body), 'content_type': 'application/json'} \
+            if body is not None else {}
+        with self.app.test_client() as client:
+            response = client.open(path, method=method, headers=headers, **kwargs)
+            return response.status_code, response.get_data()
+
+
+class HTTPDriver(object):
+    """
+    Sends requests over HTTP, one connection per request.
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body, token):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        if token:
+            headers['X-API-TOKEN'] = token
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+
+def _serve(fd, port):
+    from werkzeug.serving import make_server
+    from src.app import app, initialize_app
+    initialize_app(app)
+    make_server('127.0.0.1', port, app, threaded=True, fd=fd).serve_forever()
+
+
+def start_server(workers):
+    """
+    Pre-forks `workers` processes accepting on one listening socket.
+    :return: (port, processes)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_serve, args=(sock.fileno(), port), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            HTTPDriver(port).request('GET', '/api/v1/swagger.json', None, None)
+            break
+        except OSError:
+            time.sleep(0.2)
+    return port, processes
+
+
+def run(driver, workload, concurrency):
+    """
+    :return: ({step name: [(latency, ok)]}, elapsed seconds)
+    """
+    samples = {}
+    lock = threading.Lock()
+    sessions = iter(workload)
+
+    def worker():
+        recorded = []
+        while True:
+            with lock:
+                session = next(sessions, None)
+            if session is None:
+                break
+            token = None
+            for name, method, path, body in session['steps']:
+                started = time.perf_counter()
+                try:
+                    status, data = driver.request(method, path, body, token)
+                except (OSError, http.client.HTTPException):
+                    status, data = None, b''
+                latency = time.perf_counter() - started
+                ok = status is not None and status < 400
+                recorded.append((name, latency, ok))
+                if name == 'login' and ok:
+                    token = json.loads(data.decode()).get('auth_token')
+        with lock:
+            for name, latency, ok in recorded:
+                samples.setdefault(name, []).append((latency, ok))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def micro(flask_app, sizes, iterations):
+    """
+    Service level timings of the product reads and likes, without the HTTP
+    layer, to separate the cache and the like buffer from request overhead.
+    """
+    from src.api.productsCRUD.business import ProductService
+    from src.cache import product_cache
+    from src.likes import like_buffer
+
+    rng = random.Random(sizes['seed'])
+    hot = [rng.randint(1, sizes['products']) for _ in range(100)]
+    cases = OrderedDict([
+        ('get_product_cached', lambda: ProductService.get_product(rng.choice(hot))),
+        ('get_product_uncached', lambda: (product_cache.invalidate(hot[0]),
+                                          ProductService.get_product(hot[0]))),
+        ('like_product', lambda: ProductService.give_like_product(rng.choice(hot))),
+    ])
+    results = OrderedDict()
+    with flask_app.test_request_context():
+        for name, case in cases.items():
+            samples = []
+            started = time.perf_counter()
+            for _ in range(iterations):
+                begin = time.perf_counter()
+                case()
+                samples.append((time.perf_counter() - begin, True))
+            results[name] = summarize(samples, time.perf_counter() - started)
+        like_buffer.flush()
+    return results
+
+
+def compare(results, baseline):
+    """
+    Relative change of each endpoint metric against a previous result file.
+    """
+    changes = OrderedDict()
+    for section in ('endpoints', 'micro'):
+        for name, current in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous:
+                continue
+            changes[name] = OrderedDict(
+                (key, '{:+.1f}%'.format((current[key] - previous[key]) / previous[key] * 100))
+                for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps')
+                if current.get(key) and previous.get(key))
+    return changes
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database-url',
+                        default='sqlite:///' + os.path.join(tempfile.gettempdir(), 'benchmark.db'))
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--lists-per-user', type=int, default=3)
+    parser.add_argument('--items-per-list', type=int, default=20)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('browse=3,purchase=1,session=1,catalog=1'))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--server', action='store_true',
+                        help='run a pre-forked WSGI server instead of the test client')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--micro', type=int, default=1000, metavar='ITERATIONS',
+                        help='service level iterations, 0 to skip')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--record', metavar='PATH', help='write the workload and exit')
+    parser.add_argument('--replay', metavar='PATH', help='run a recorded workload')
+    parser.add_argument('--baseline', metavar='PATH', help='previous result to compare with')
+    parser.add_argument('--output', metavar='PATH')
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        sizes, workload = load_workload(args.replay)
+    else:
+        sizes = OrderedDict([('seed', args.seed), ('users', args.users), ('products', args.products),
+                             ('lists_per_user', args.lists_per_user),
+                             ('items_per_list', args.items_per_list)])
+        workload = generate(sizes, args.mix, args.sessions)
+    if args.record:
+        save_workload(args.record, sizes, workload)
+        return 0
+
+    os.environ['APP_SETTINGS'] = 'src.config.BenchmarkConfig'
+    os.environ['BENCHMARK_DATABASE_URI'] = args.database_url
+    os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark')
+    seed(args.database_url, sizes)
+
+    if args.server:
+        port, processes = start_server(args.workers)
+        try:
+            samples, elapsed = run(HTTPDriver(port), workload, args.concurrency)
+        finally:
+            for process in processes:
+                process.terminate()
+    from src.app import app, initialize_app
+    initialize_app(app)
+    if not args.server:
+        samples, elapsed = run(ClientDriver(app), workload, args.concurrency)
+
+    results = OrderedDict([
+        ('meta', OrderedDict([
+            ('revision', git_revision()),
+            ('python', platform.python_version()),
+            ('database', args.database_url.split(':', 1)[0]),
+            ('driver', 'server' if args.server else 'client'),
+            ('workers', args.workers if args.server else 1),
+            ('concurrency', args.concurrency),
+            ('sessions', len(workload)),
+            ('sizes', sizes),
+        ])),
+        ('endpoints', OrderedDict((name, summarize(samples[name], elapsed))
+                                  for name in sorted(samples))),
+        ('total', summarize([sample for name in samples for sample in samples[name]], elapsed)),
+    ])
+    if args.micro:
+        results['micro'] = micro(app, sizes, args.micro)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['change'] = compare(results, json.load(f))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Fails when an endpoint runs more SQL statements than its budget, so N+1
+regressions break the build.
+
+    APP_SETTINGS=src.config.TestingConfig TEST_DATABASE_URI=sqlite:////tmp/budget.db \
+        python -m src.benchmarks.query_budget
+"""
+import sys
+from src.app import app, initialize_app
+from src.models import db, UserModel, ProductModel, ProductList, ProductListItem, PurchaseLogModel
+from src.profiler import profile_queries
+
+# (path, statement budget) with the auth token already cached after the warm-up request
+BUDGETS = [
+    ('/api/v1/auth/status', 0),
+    ('/api/v1/productsCRUD/', 3),
+    # version, productlist, item count (cold count cache), items
+    ('/api/v1/productsCRUD/{productlist_id}', 4),
+    ('/api/v1/productsCRUD/purchases', 2),
+    ('/api/v1/productsCRUD/purchases/product/{product_id}', 2),
+    # aggregates, never the purchase log
+    ('/api/v1/productsCRUD/sales/top', 1),
+    ('/api/v1/productsCRUD/sales/product/{product_id}', 3),
+]
+
+
+def seed(rows=30):
+    user = UserModel('budget@example.com', 'secret', 'admin')
+    db.session.add(user)
+    db.session.flush()
+    products = [ProductModel('product {}'.format(i), 'npc', 100, 9.99) for i in range(rows)]
+    productlist = ProductList('budget list', user.id)
+    db.session.add_all(products + [productlist])
+    db.session.flush()
+    db.session.add_all([ProductListItem('item {}'.format(i), productlist.id) for i in range(rows)])
+    db.session.add_all([PurchaseLogModel(user, products[0].id, 1) for _ in range(rows)])
+    db.session.commit()
+    return user.encode_auth_token(user.id).decode(), productlist.id, products[0].id
+
+
+def main():
+    initialize_app(app)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        token, productlist_id, product_id = seed()
+
+    client = app.test_client()
+    headers = {'X-API-TOKEN': token, 'Authorization': 'Bearer ' + token}
+    client.get('/api/v1/auth/status', headers=headers)
+
+    failures = 0
+    for path, budget in BUDGETS:
+        url = path.format(productlist_id=productlist_id, product_id=product_id)
+        with profile_queries() as profile:
+            response = client.get(url, headers=headers)
+        status = 'ok' if profile.count <= budget else 'OVER BUDGET'
+        print('{:<55} {:>3} {:>3} statements (budget {}) {}'.format(
+            url, response.status_code, profile.count, budget, status))
+        if profile.count > budget:
+            failures += 1
+            for duplicate in profile.duplicates():
+                print('    duplicated x{}: {}'.format(duplicate['count'], duplicate['statement']))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
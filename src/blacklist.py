@@ -0,0 +1,127 @@
+import datetime
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """
+    Fixed size bloom filter over hex digests (e.g. sha256 token hashes).
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(int(round(self.num_bits / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, hexdigest):
+        # the input is already a uniform hash, so derive k indexes by double hashing
+        h1 = int(hexdigest[:16], 16)
+        h2 = int(hexdigest[16:32], 16) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, hexdigest):
+        """
+        Digests that already look present (e.g. re-read by a sync) are not
+        counted again, so `count` tracks distinct entries.
+        :return: True if the digest was new to the filter
+        """
+        added = False
+        for pos in self._positions(hexdigest):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, hexdigest):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(hexdigest))
+
+
+class TokenBlacklist(object):
+    """
+    Negative lookup filter in front of the blacklist_tokens table.
+
+    A miss means the token is definitely not blacklisted and no query is
+    needed; a hit still has to be confirmed against the database. Rows
+    written by other processes are picked up by an incremental sync that
+    runs at most once every `sync_interval` seconds.
+    """
+
+    # re-read rows this far behind the last sync to cover commit latency
+    SYNC_OVERLAP = datetime.timedelta(seconds=60)
+
+    def __init__(self, capacity=100000, error_rate=0.001, sync_interval=5):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self._filter = None
+        self._synced_at = 0
+        self._sync_mark = None
+        self._lock = threading.Lock()
+
+    def init_app(self, flask_app):
+        self.capacity = flask_app.config.get('BLACKLIST_FILTER_CAPACITY', self.capacity)
+        self.error_rate = flask_app.config.get('BLACKLIST_FILTER_ERROR_RATE', self.error_rate)
+        self.sync_interval = flask_app.config.get('BLACKLIST_SYNC_INTERVAL', self.sync_interval)
+        with flask_app.app_context():
+            self.load()
+
+    def load(self):
+        """
+        Rebuilds the filter from every live row of blacklist_tokens.
+        """
+        from src.models import db, BlacklistToken
+        started = datetime.datetime.utcnow()
+        hashes = [h for h, in db.session.query(BlacklistToken.token_hash)]
+        bloom = BloomFilter(max(self.capacity, len(hashes) * 2), self.error_rate)
+        for token_hash in hashes:
+            bloom.add(token_hash)
+        with self._lock:
+            self._filter = bloom
+            self._sync_mark = started
+            self._synced_at = time.time()
+        log.info('Loaded %d blacklisted tokens into filter', len(hashes))
+
+    def sync(self):
+        from src.models import db, BlacklistToken
+        started = datetime.datetime.utcnow()
+        since = self._sync_mark - self.SYNC_OVERLAP
+        hashes = [h for h, in db.session.query(BlacklistToken.token_hash).filter(
+            BlacklistToken.blacklisted_on >= since)]
+        with self._lock:
+            for token_hash in hashes:
+                self._filter.add(token_hash)
+            self._sync_mark = started
+            self._synced_at = time.time()
+        if self._filter.count > self._filter.capacity:
+            self.load()
+
+    def add(self, token_hash):
+        if self._filter is None:
+            return
+        with self._lock:
+            self._filter.add(token_hash)
+
+    def might_contain(self, token_hash):
+        if self._filter is None:
+            return True
+        if time.time() - self._synced_at > self.sync_interval:
+            try:
+                self.sync()
+            except Exception:
+                log.exception('Blacklist filter sync failed')
+                return True
+        return token_hash in self._filter
+
+
+token_blacklist = TokenBlacklist()
@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # only needed for the 'redis' cache backend
+    redis = None
+
+
+class TTLCache(object):
+    """
+    Bounded, thread safe LRU mapping whose entries carry their own expiry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        """
+        Store value until expires_at (epoch seconds), capped by the cache ttl.
+        """
+        if self.ttl:
+            ceiling = time.time() + self.ttl
+            expires_at = ceiling if expires_at is None else min(expires_at, ceiling)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class LocalCacheBackend(object):
+    """
+    In-process backend: LRU eviction with a fixed ttl.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class RedisCacheBackend(object):
+    """
+    Backend for any Redis compatible server; values are stored as JSON.
+    """
+
+    def __init__(self, url, ttl=None, prefix=''):
+        if redis is None:
+            raise RuntimeError('The redis cache backend requires the redis package.')
+        self._client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get('{}{}'.format(self.prefix, key))
+        return None if raw is None else json.loads(raw.decode())
+
+    def set(self, key, value):
+        self._client.set('{}{}'.format(self.prefix, key), json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self._client.delete('{}{}'.format(self.prefix, key))
+
+    def clear(self):
+        for key in self._client.scan_iter('{}*'.format(self.prefix)):
+            self._client.delete(key)
+
+
+class ReadThroughCache(object):
+    """
+    Read-through cache of JSON serializable payloads over a pluggable backend.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.backend = LocalCacheBackend()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, flask_app):
+        prefix = self.name.upper()
+        backend = flask_app.config.get('{}_CACHE_BACKEND'.format(prefix), 'local')
+        ttl = flask_app.config.get('{}_CACHE_TTL'.format(prefix))
+        if backend == 'redis':
+            self.backend = RedisCacheBackend(flask_app.config['{}_CACHE_URL'.format(prefix)], ttl,
+                                             prefix='{}:'.format(self.name))
+        else:
+            self.backend = LocalCacheBackend(
+                flask_app.config.get('{}_CACHE_SIZE'.format(prefix), 1024), ttl)
+
+    def get_or_load(self, key, loader):
+        """
+        :param loader: called on a miss; a None result is not cached
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.backend.delete(key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+product_cache = ReadThroughCache('product')
@@ -0,0 +1,101 @@
+import logging
+import time
+import uuid
+from kombu import Connection, Exchange, Queue, pools
+from src import metrics
+
+log = logging.getLogger(__name__)
+
+EXCHANGE = Exchange('ecommerce.events', type='topic', durable=True)
+ANALYTICS_QUEUE = Queue('ecommerce.analytics', EXCHANGE, routing_key='#', durable=True)
+# messages a worker gave up on, kept for inspection and manual replay
+DEAD_LETTER_EXCHANGE = Exchange('ecommerce.dead', type='direct', durable=True)
+DEAD_LETTER_QUEUE = Queue('ecommerce.dead', DEAD_LETTER_EXCHANGE, routing_key='dead',
+                          durable=True)
+
+PURCHASE = 'purchase.created'
+LIKE = 'product.liked'
+
+published = metrics.counter(
+    'events_published_total', 'Events published to the broker.', ['routing_key'])
+publish_failures = metrics.counter(
+    'events_publish_failures_total', 'Events that could not be published.', ['routing_key'])
+publish_seconds = metrics.histogram(
+    'events_publish_seconds', 'Time spent publishing one event, confirms included.')
+
+
+def purchase_event(user_id, quantities):
+    """
+    :param quantities: {product_id: quantity} bought in one order
+    """
+    return {
+        'id': uuid.uuid4().hex,
+        'at': time.time(),
+        'user_id': user_id,
+        'lines': [[product_id, quantity] for product_id, quantity in sorted(quantities.items())]
+    }
+
+
+def like_event(product_id, count=1):
+    return {'id': uuid.uuid4().hex, 'at': time.time(), 'product_id': product_id, 'count': count}
+
+
+class EventBus(object):
+    """
+    Publishes domain events through a pool of kombu producers.
+
+    On AMQP the connection enables publisher confirms, so `publish` returns
+    once the broker has taken the message. Nothing is published unless
+    EVENTS_ENABLED is set.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.connection = None
+        self.retry_policy = {'max_retries': 3, 'interval_start': 0, 'interval_step': 0.2,
+                             'interval_max': 1}
+
+    def init_app(self, flask_app):
+        self.enabled = flask_app.config.get('EVENTS_ENABLED', False)
+        if not self.enabled:
+            return
+        self.connection = connect(flask_app)
+        pools.set_limit(flask_app.config.get('EVENTS_PRODUCER_POOL_SIZE', 10))
+        self.declare(ANALYTICS_QUEUE)
+
+    def declare(self, queue):
+        """
+        Declares a queue with its exchange and binding, so messages published
+        before its first consumer starts are kept.
+        """
+        with self.connection.clone() as conn:
+            queue(conn.default_channel).declare()
+
+    def publish(self, routing_key, body, exchange=EXCHANGE):
+        """
+        :return: True once the event is confirmed, False if it was dropped
+        """
+        if not self.enabled:
+            return False
+        started = time.perf_counter()
+        try:
+            with pools.producers[self.connection].acquire(block=True, timeout=5) as producer:
+                producer.publish(body, exchange=exchange, routing_key=routing_key,
+                                 serializer='json', delivery_mode=2, declare=[exchange],
+                                 retry=True, retry_policy=self.retry_policy)
+        except Exception:
+            publish_failures.inc(labels=(routing_key,))
+            log.exception('Publishing %s event %s failed', routing_key, body.get('id'))
+            return False
+        publish_seconds.observe(time.perf_counter() - started)
+        published.inc(labels=(routing_key,))
+        return True
+
+
+def connect(flask_app):
+    return Connection(flask_app.config['BROKER_URL'],
+                      heartbeat=flask_app.config.get('BROKER_HEARTBEAT', 10),
+                      transport_options={'confirm_publish': True})
+
+
+event_bus = EventBus()
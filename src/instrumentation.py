@@ -0,0 +1,101 @@
+import threading
+import time
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from src import metrics
+from src.api.auth.cache import token_cache
+from src.cache import product_cache
+
+request_seconds = metrics.histogram(
+    'http_request_duration_seconds', 'Latency of API requests.',
+    ['namespace', 'route', 'method', 'status'])
+request_statements = metrics.histogram(
+    'http_request_sql_statements', 'SQL statements executed per API request.',
+    ['namespace', 'route'], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+request_sql_seconds = metrics.histogram(
+    'http_request_sql_seconds', 'Time spent in SQL per API request.', ['namespace', 'route'])
+statements_total = metrics.counter(
+    'db_statements_total', 'SQL statements executed.')
+statement_seconds = metrics.histogram(
+    'db_statement_seconds', 'Latency of single SQL statements.')
+bcrypt_seconds = metrics.histogram(
+    'bcrypt_seconds', 'Time spent hashing or checking passwords.', ['operation'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+cache_requests = metrics.counter(
+    'cache_requests_total', 'Cache lookups by result.', ['cache', 'result'])
+
+# SQL totals of the request being served by this thread, None outside requests
+_current = threading.local()
+
+
+def _cache_requests():
+    values = {}
+    for name, stats in (('product', product_cache.stats()), ('auth_token', token_cache.stats())):
+        values[(name, 'hit')] = stats['hits']
+        values[(name, 'miss')] = stats['misses']
+    return values
+
+
+cache_requests.set_function(_cache_requests)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    statements_total.inc()
+    statement_seconds.observe(elapsed)
+    totals = getattr(_current, 'totals', None)
+    if totals is not None:
+        totals[0] += 1
+        totals[1] += elapsed
+
+
+def current_sql_totals():
+    """
+    :return: [statements, seconds] executed so far by the current request
+    """
+    return getattr(_current, 'totals', None)
+
+
+def _labels(blueprint):
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    namespace = rule[len(blueprint.url_prefix or ''):].strip('/').split('/')[0]
+    return namespace, rule
+
+
+def init_app(flask_app, blueprint):
+    """
+    Times every request of the api blueprint and mounts /metrics when
+    METRICS_ENABLED is set.
+    """
+    @blueprint.before_request
+    def start_timer():
+        _current.started = time.perf_counter()
+        _current.totals = [0, 0.0]
+
+    @blueprint.after_request
+    def record(response):
+        started = getattr(_current, 'started', None)
+        if started is not None:
+            namespace, rule = _labels(blueprint)
+            statements, sql_seconds = _current.totals
+            request_seconds.observe(time.perf_counter() - started,
+                                    (namespace, rule, request.method, str(response.status_code)))
+            request_statements.observe(statements, (namespace, rule))
+            request_sql_seconds.observe(sql_seconds, (namespace, rule))
+            _current.started = _current.totals = None
+        return response
+
+    if flask_app.config.get('METRICS_ENABLED'):
+        flask_app.add_url_rule('/metrics', 'metrics', render_metrics)
+
+
+def render_metrics():
+    return Response(metrics.render_text(metrics.registry),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
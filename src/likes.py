@@ -0,0 +1,101 @@
+import atexit
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class LikeBuffer(object):
+    """
+    Write-behind aggregation of product likes.
+
+    Increments are summed in memory per product id and written back as one
+    batched UPDATE products SET likes = likes + :n by a background thread,
+    either every `flush_interval` seconds or as soon as `flush_threshold`
+    likes are pending. Deltas stay visible through `pending` until their
+    batch is committed; `pending` waits out a flush in progress, so a
+    batch is never counted both in the row and as pending.
+    """
+
+    def __init__(self, flush_interval=1.0, flush_threshold=1000):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = {}
+        self._in_flight = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._due = threading.Event()
+        self._thread = None
+        self._app = None
+
+    def init_app(self, flask_app):
+        self.flush_interval = flask_app.config.get('LIKES_FLUSH_INTERVAL', self.flush_interval)
+        self.flush_threshold = flask_app.config.get('LIKES_FLUSH_THRESHOLD', self.flush_threshold)
+        self._app = flask_app
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='like-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def add(self, product_id, count=1):
+        with self._lock:
+            self._pending[product_id] = self._pending.get(product_id, 0) + count
+            self._count += count
+            due = self._count >= self.flush_threshold
+        if due:
+            # the request never waits for, or fails with, the write
+            self._due.set()
+
+    def pending(self, product_id):
+        with self._flush_lock, self._lock:
+            return self._pending.get(product_id, 0) + self._in_flight.get(product_id, 0)
+
+    def flush(self):
+        """
+        Writes every pending delta in one executemany UPDATE.
+        :return: number of products updated
+        """
+        from src.models import ProductModel
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending, self._count = self._pending, {}, 0
+                self._in_flight = batch
+            try:
+                ProductModel.add_likes(batch)
+            except Exception:
+                with self._lock:
+                    for product_id, count in batch.items():
+                        self._pending[product_id] = self._pending.get(product_id, 0) + count
+                        self._count += count
+                    self._in_flight = {}
+                raise
+            with self._lock:
+                self._in_flight = {}
+            return len(batch)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._due.wait(self.flush_interval)
+            self._due.clear()
+            if self._stop.is_set():
+                break
+            try:
+                with self._app.app_context():
+                    self.flush()
+            except Exception:
+                log.exception('Flushing product likes failed')
+
+    def stop(self):
+        self._stop.set()
+        self._due.set()
+        if self._app is not None:
+            with self._app.app_context():
+                self.flush()
+
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,392 @@
+import atexit
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import smtplib
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from flask import current_app
+from flask_mail import Message
+from kombu import Exchange, Queue
+from src import metrics
+from src.events import event_bus
+from src.worker import Worker
+
+log = logging.getLogger(__name__)
+
+MAIL_SEND = 'mail.send'
+MAIL_EXCHANGE = Exchange('ecommerce.mail', type='direct', durable=True)
+MAIL_QUEUE = Queue('ecommerce.mail', MAIL_EXCHANGE, routing_key=MAIL_SEND, durable=True)
+
+sent = metrics.counter(
+    'mail_sent_total', 'Messages accepted by the SMTP server.')
+failures = metrics.counter(
+    'mail_failures_total', 'Failed send attempts, by what happened to the message.', ['outcome'])
+send_seconds = metrics.histogram(
+    'mail_send_seconds', 'Time to send one message, including (re)connecting.')
+queued = metrics.gauge(
+    'mail_queued', 'Messages waiting in the local dispatch queue, retries included.')
+
+
+class MailDeliveryError(Exception):
+    """
+    Raised when messages still fail with transient errors after the last
+    attempt; `unsent` lists them.
+    """
+
+    def __init__(self, message, unsent=()):
+        super(MailDeliveryError, self).__init__(message)
+        self.unsent = list(unsent)
+
+
+def is_transient(error):
+    """
+    Dropped connections, timeouts and 4xx replies are worth retrying;
+    refused recipients, 5xx replies and invalid messages are not.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    # SMTPServerDisconnected and socket errors
+    return isinstance(error, OSError)
+
+
+def message_to_dict(message):
+    """
+    JSON serializable form of a flask_mail Message for the broker; attachments
+    are not supported.
+    """
+    return {
+        'id': uuid.uuid4().hex,
+        'subject': message.subject,
+        'sender': message.sender,
+        'recipients': message.recipients,
+        'cc': message.cc,
+        'bcc': message.bcc,
+        'reply_to': message.reply_to,
+        'body': message.body,
+        'html': message.html,
+    }
+
+
+def message_from_dict(body):
+    sender = body['sender']
+    return Message(subject=body['subject'],
+                   sender=tuple(sender) if isinstance(sender, list) else sender,
+                   recipients=body['recipients'], cc=body['cc'], bcc=body['bcc'],
+                   reply_to=body['reply_to'], body=body['body'], html=body['html'])
+
+
+class SMTPSession(object):
+    """
+    One SMTP connection reused across sends. It is opened on first use and
+    reopened after an error or after `idle_timeout` seconds without use,
+    since servers drop idle clients. Needs an app context.
+    """
+
+    def __init__(self, idle_timeout=30):
+        self.idle_timeout = idle_timeout
+        self._stack = None
+        self._connection = None
+        self._last_used = 0
+
+    def send(self, message):
+        if self._connection is not None and time.time() - self._last_used > self.idle_timeout:
+            self.close()
+        if self._connection is None:
+            stack = ExitStack()
+            self._connection = stack.enter_context(current_app.extensions['mail'].connect())
+            self._stack = stack
+        try:
+            self._connection.send(message)
+        except Exception:
+            self.close()
+            raise
+        self._last_used = time.time()
+
+    def close(self):
+        if self._stack is None:
+            return
+        stack, self._stack, self._connection = self._stack, None, None
+        try:
+            stack.close()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+class MailDispatcher(object):
+    """
+    Sends flask_mail messages off the request thread.
+
+    MAIL_DISPATCH_MODE picks how:
+    - 'thread': messages are queued for `workers` background threads. Each
+      thread sends whatever is due in batches over its own kept-alive SMTP
+      connection, and retries transient failures with exponential backoff.
+    - 'broker': messages are published to the ecommerce.mail queue and
+      `manage.py mail_worker` sends them. This falls back to the threads
+      when events are disabled or the broker is down.
+    - 'inline': messages are sent on the calling thread, for tests against
+      the debugging SMTP server in src/smtp_debug.py.
+    """
+
+    def __init__(self, mode='thread', workers=2, batch_size=50, max_queued=10000,
+                 max_attempts=5, backoff=1.0, max_backoff=300, idle_timeout=30):
+        self.mode = mode
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        self._app = None
+        # (due, sequence, attempt, message)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+        self._registered = False
+        self._stopping = False
+        self._local = threading.local()
+        queued.set_function(lambda: len(self._heap))
+
+    def init_app(self, flask_app):
+        config = flask_app.config
+        self.mode = config.get('MAIL_DISPATCH_MODE', self.mode)
+        self.workers = config.get('MAIL_WORKERS', self.workers)
+        self.batch_size = config.get('MAIL_BATCH_SIZE', self.batch_size)
+        self.max_queued = config.get('MAIL_QUEUE_SIZE', self.max_queued)
+        self.max_attempts = config.get('MAIL_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff = config.get('MAIL_RETRY_BACKOFF', self.backoff)
+        self.max_backoff = config.get('MAIL_RETRY_MAX_BACKOFF', self.max_backoff)
+        self.idle_timeout = config.get('MAIL_CONNECTION_IDLE_TIMEOUT', self.idle_timeout)
+        self._app = flask_app
+        if self.mode == 'broker' and event_bus.enabled:
+            event_bus.declare(MAIL_QUEUE)
+
+    def send(self, message):
+        """
+        :return: True if the message was sent or queued, False if it was dropped
+        """
+        if self.mode == 'inline':
+            try:
+                return self.deliver([message]) == 1
+            except MailDeliveryError:
+                return False
+        if self.mode == 'broker' and event_bus.enabled and not message.attachments:
+            if event_bus.publish(MAIL_SEND, message_to_dict(message), exchange=MAIL_EXCHANGE):
+                return True
+            log.warning('Publishing mail failed, sending it from this process')
+        return self._enqueue(message)
+
+    def retry_delay(self, attempt):
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    def deliver(self, messages):
+        """
+        Sends on the calling thread over its kept-alive connection, sleeping
+        between retries; permanent failures are logged and skipped.
+        :raise MailDeliveryError: if messages still fail after max_attempts
+        :return: number of messages sent
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = SMTPSession(self.idle_timeout)
+        pending = list(messages)
+        count = 0
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.retry_delay(attempt - 1))
+            retry = []
+            for message in pending:
+                error = self._send_one(session, message)
+                if error is None:
+                    count += 1
+                elif is_transient(error):
+                    retry.append(message)
+                else:
+                    self._drop(message, error)
+            pending = retry
+            if not pending:
+                return count
+            if attempt + 1 < self.max_attempts:
+                failures.inc(len(pending), ('retried',))
+        failures.inc(len(pending), ('dropped',))
+        raise MailDeliveryError('{} messages could not be sent after {} attempts.'.format(
+            len(pending), self.max_attempts), pending)
+
+    def _send_one(self, session, message):
+        """
+        :return: None once sent, else the error
+        """
+        started = time.perf_counter()
+        try:
+            session.send(message)
+        except Exception as error:
+            return error
+        send_seconds.observe(time.perf_counter() - started)
+        sent.inc()
+        return None
+
+    def _drop(self, message, error):
+        failures.inc(labels=('dropped',))
+        log.error('Dropping mail %r to %d recipients: %s', message.subject, len(message.send_to),
+                  error)
+
+    def _enqueue(self, message, attempt=0, due=None):
+        with self._cond:
+            if len(self._heap) >= self.max_queued:
+                self._drop(message, 'dispatch queue is full')
+                return False
+            heapq.heappush(self._heap, (due or time.time(), next(self._sequence), attempt, message))
+            self._cond.notify()
+        self._start()
+        return True
+
+    def _start(self):
+        # started lazily, and again in forked server workers, which do not inherit threads
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._stopping = False
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='mail-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            if not self._registered:
+                atexit.register(self.stop)
+                self._registered = True
+            self._pid = os.getpid()
+
+    def _take(self):
+        """
+        :return: up to batch_size due (attempt, message) pairs, [] after
+            idle_timeout without any, None once stopping and nothing is due
+        """
+        deadline = time.time() + self.idle_timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    batch = []
+                    while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                        _, _, attempt, message = heapq.heappop(self._heap)
+                        batch.append((attempt, message))
+                    return batch
+                if self._stopping:
+                    return None
+                if now >= deadline:
+                    return []
+                timeout = deadline - now
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                self._cond.wait(timeout)
+
+    def _run(self):
+        session = SMTPSession(self.idle_timeout)
+        with self._app.app_context():
+            try:
+                while True:
+                    batch = self._take()
+                    if batch is None:
+                        break
+                    if not batch:
+                        session.close()
+                        continue
+                    for attempt, message in batch:
+                        error = self._send_one(session, message)
+                        if error is None:
+                            continue
+                        if is_transient(error) and attempt + 1 < self.max_attempts:
+                            failures.inc(labels=('retried',))
+                            delay = self.retry_delay(attempt)
+                            log.warning('Sending mail %r failed (%s), retrying in %.1fs',
+                                        message.subject, error, delay)
+                            self._enqueue(message, attempt + 1, time.time() + delay)
+                        else:
+                            self._drop(message, error)
+            except Exception:
+                log.exception('Mail thread crashed')
+            finally:
+                session.close()
+
+    def stop(self, timeout=10):
+        """
+        Sends what is due, waiting up to `timeout` seconds; messages still
+        waiting for a retry are dropped.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0))
+        self._pid = None
+        if self._heap:
+            log.error('Dropping %d unsent mails on shutdown', len(self._heap))
+
+
+class MailWorker(Worker):
+    """
+    Consumes the ecommerce.mail queue.
+
+    Unlike the event handlers, sending runs outside any database
+    transaction: the ids of the messages already sent are read first and
+    the ids of the ones just sent are recorded afterwards, in short
+    transactions of their own. Only the messages that still fail after
+    the retries are requeued, so the rest of the batch is not sent again.
+    """
+
+    def __init__(self, connection, flask_app, **kwargs):
+        kwargs.setdefault('queues', (MAIL_QUEUE,))
+        super(MailWorker, self).__init__(connection, flask_app, **kwargs)
+
+    def process(self, events):
+        from src.models import db, ProcessedEvent
+        with self.app.app_context():
+            seen = ProcessedEvent.seen(body['id'] for _, body, _ in events)
+        messages = {}
+        failed = set()
+        for i, (_, body, _) in enumerate(events):
+            if body['id'] in seen:
+                continue
+            try:
+                messages[i] = message_from_dict(body)
+            except (KeyError, TypeError, ValueError):
+                log.error('Cannot build a mail from message %s', body['id'])
+                failed.add(i)
+        if not messages:
+            return failed
+        with self.app.app_context():
+            try:
+                mailer.deliver(messages.values())
+            except MailDeliveryError as error:
+                unsent = {id(message) for message in error.unsent}
+                failed.update(i for i, message in messages.items() if id(message) in unsent)
+            except Exception:
+                log.exception('Sending a batch of %d mails failed', len(messages))
+                return set(range(len(events)))
+            done = [events[i][1]['id'] for i in messages if i not in failed]
+            now = datetime.datetime.utcnow()
+            try:
+                db.session.bulk_insert_mappings(ProcessedEvent, [
+                    {'event_id': event_id, 'processed_on': now} for event_id in done])
+                db.session.commit()
+            except Exception:
+                # sent anyway; a redelivery before the ids are pruned may send them again
+                log.exception('Recording %d sent mails failed', len(done))
+                db.session.rollback()
+        return failed
+
+
+mailer = MailDispatcher()
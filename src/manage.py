@@ -1,15 +1,31 @@
+import datetime
 import os
+import sys
 import coverage
+from dateutil.parser import parse as parse_datetime
 from flask import g
 from flask_migrate import Migrate, MigrateCommand
 from flask_script import Manager
 
-from app import app
-from src.models import db
+from app import app, initialize_app
+from src import metrics
+from src.models import db, BlacklistToken, ProcessedEvent, rebuild_sales as rebuild_sales_aggregates
+from src.blacklist import token_blacklist
+from src.events import connect
+from src.mailer import MailWorker
+from src.outbox import OutboxRelay
+from src.smtp_debug import DebuggingSMTPServer
+from src.worker import Worker
+from src.api.productsCRUD.export import product_rows, purchase_rows, stream_rows
+from src.api.productsCRUD.importer import import_products as load_products
 app.config.from_object(os.environ['APP_SETTINGS'])
 app.config.from_pyfile('config.py')
+# the db commands only need the database: the rest of the app (blacklist, like
+# buffer, event bus, mailer) reads tables that older revisions do not have yet
+db.init_app(app)
 
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                  'migrations'))
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
@@ -28,6 +44,14 @@ COV = coverage.coverage(
 COV.start()
 
 
+def setup_app():
+    """
+    Initializes the rest of the app for commands that use it; the schema is
+    left to `db upgrade`.
+    """
+    initialize_app(app, create_tables=False)
+
+
 @manager.command
 def create_db():
     """Creates the db tables."""
@@ -46,5 +70,128 @@ def drop_db():
     db.drop_all()
 
 
+@manager.command
+def prune_blacklist():
+    """Deletes blacklisted tokens that have expired."""
+    setup_app()
+    deleted = BlacklistToken.prune_expired()
+    token_blacklist.load()
+    print('Pruned {} expired blacklisted tokens.'.format(deleted))
+
+
+@manager.command
+def rebuild_sales():
+    """Recomputes the sales aggregates from the purchase log; stop the event worker first."""
+    setup_app()
+    count = rebuild_sales_aggregates()
+    print('Aggregated {} purchase logs.'.format(count))
+
+
+@manager.option('-t', '--table', dest='table', choices=['purchases', 'products'],
+                default='purchases', help='Table to export')
+@manager.option('-f', '--format', dest='fmt', choices=['ndjson', 'csv'], default='ndjson')
+@manager.option('--since', dest='since', default=None, help='ISO 8601 lower bound on purchases')
+@manager.option('--until', dest='until', default=None, help='ISO 8601 upper bound on purchases')
+@manager.option('-o', '--output', dest='output', default=None, help='File to write, stdout if omitted')
+def export(table, fmt, since, until, output):
+    """Streams purchase logs or the catalog as NDJSON/CSV."""
+    setup_app()
+    if table == 'purchases':
+        query = purchase_rows(since and parse_datetime(since), until and parse_datetime(until))
+    else:
+        query = product_rows()
+    out = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        for chunk in stream_rows(query, fmt):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+
+@manager.option('path', help='CSV or NDJSON file of products')
+@manager.option('-f', '--format', dest='fmt', choices=['csv', 'ndjson'], default=None,
+                help='Defaults to the file extension')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=5000)
+def import_products(path, fmt, chunk_size):
+    """Bulk loads products, skipping items that already exist."""
+    setup_app()
+    fmt = fmt or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    with open(path, newline='') as stream:
+        stats = load_products(stream, fmt, chunk_size)
+    print('Read {read} rows, inserted {inserted}, skipped {duplicates} duplicates and '
+          '{invalid} invalid rows in {seconds}s ({rows_per_second} rows/s).'.format(**stats))
+
+
+@manager.command
+def worker():
+    """Consumes purchase and like events and writes them in batches."""
+    setup_app()
+    if app.config['WORKER_METRICS_PORT']:
+        metrics.serve(app.config['WORKER_METRICS_PORT'])
+    with connect(app) as connection:
+        consumer = Worker(connection, app,
+                          prefetch_count=app.config['WORKER_PREFETCH_COUNT'],
+                          batch_size=app.config['WORKER_BATCH_SIZE'],
+                          batch_timeout=app.config['WORKER_BATCH_TIMEOUT'],
+                          concurrency=app.config['WORKER_CONCURRENCY'])
+        consumer.install_signal_handlers()
+        consumer.run()
+
+
+@manager.command
+def relay_outbox():
+    """Publishes events written to the outbox table."""
+    setup_app()
+    if app.config['WORKER_METRICS_PORT']:
+        metrics.serve(app.config['WORKER_METRICS_PORT'])
+    relay = OutboxRelay(app, batch_size=app.config['OUTBOX_BATCH_SIZE'],
+                        poll_interval=app.config['OUTBOX_POLL_INTERVAL'])
+    relay.install_signal_handlers()
+    relay.run()
+
+
+@manager.option('-d', '--days', dest='days', type=int, default=None,
+                help='Defaults to PROCESSED_EVENTS_RETENTION_DAYS')
+def prune_processed_events(days):
+    """Forgets processed event ids older than the retention period."""
+    setup_app()
+    days = days if days is not None else app.config['PROCESSED_EVENTS_RETENTION_DAYS']
+    deleted = ProcessedEvent.prune(datetime.datetime.utcnow() - datetime.timedelta(days=days))
+    print('Pruned {} processed event ids.'.format(deleted))
+
+
+@manager.command
+def mail_worker():
+    """Sends mail queued on the broker in batches over kept-alive SMTP connections."""
+    setup_app()
+    if app.config['WORKER_METRICS_PORT']:
+        metrics.serve(app.config['WORKER_METRICS_PORT'])
+    batch_size = app.config['MAIL_BATCH_SIZE']
+    concurrency = app.config['MAIL_WORKERS']
+    with connect(app) as connection:
+        consumer = MailWorker(connection, app, prefetch_count=batch_size * (concurrency + 1),
+                              batch_size=batch_size,
+                              batch_timeout=app.config['WORKER_BATCH_TIMEOUT'],
+                              concurrency=concurrency)
+        consumer.install_signal_handlers()
+        consumer.run()
+
+
+@manager.option('-p', '--port', dest='port', type=int, default=8025)
+def smtp_debug(port):
+    """Runs a local SMTP server that prints every message instead of delivering it."""
+    def show(mailfrom, rcpttos, message):
+        print('From {} to {}\n{}\n'.format(mailfrom, ', '.join(rcpttos), message.as_string()))
+
+    server = DebuggingSMTPServer(port=port, on_message=show)
+    print('Listening on {}:{}, set APP_MAIL_SERVER, APP_MAIL_PORT and APP_MAIL_USE_SSL=0'.format(
+        server.host, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,200 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    """
+    A named family of samples, one per combination of label values.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set_function(self, function):
+        """
+        Reads the value at collection time instead of tracking it.
+        :param function: returns a value, or a {label values: value} dict
+        """
+        self._function = function
+
+    def samples(self):
+        """
+        :return: iterable of (sample name, label values, value)
+        """
+        if self._function is not None:
+            values = self._function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            values = self._values
+        for labels, value in list(values.items()):
+            yield self.name, labels, value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, labels=()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def samples(self):
+        for labels, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', labels + (('+Inf' if bound == float('inf')
+                                                         else repr(bound)),), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+    def sample_labelnames(self, sample_name):
+        return self.labelnames + ('le',) if sample_name.endswith('_bucket') else self.labelnames
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        :return: the metric already registered under that name, if any
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def collect(self):
+        return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def snapshot(self):
+        """
+        :return: JSON serializable {metric name: [{sample, labels, value}]}
+        """
+        result = {}
+        for metric in self.collect():
+            result[metric.name] = [{
+                'sample': sample_name,
+                'labels': dict(zip(_labelnames(metric, sample_name), labels)),
+                'value': value
+            } for sample_name, labels, value in metric.samples()]
+        return result
+
+
+def _labelnames(metric, sample_name):
+    if isinstance(metric, Histogram):
+        return metric.sample_labelnames(sample_name)
+    return metric.labelnames
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def render_text(metric_registry):
+    """
+    Renders every metric in the Prometheus text exposition format (0.0.4).
+    """
+    lines = []
+    for metric in metric_registry.collect():
+        lines.append('# HELP {} {}'.format(metric.name, _escape(metric.documentation)))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for sample_name, labels, value in metric.samples():
+            if labels:
+                pairs = ','.join('{}="{}"'.format(name, _escape(label)) for name, label in
+                                 zip(_labelnames(metric, sample_name), labels))
+                lines.append('{}{{{}}} {}'.format(sample_name, pairs, _format_value(value)))
+            else:
+                lines.append('{} {}'.format(sample_name, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='0.0.0.0', metric_registry=registry):
+    """
+    Serves the registry on http://host:port/ from a daemon thread, for
+    processes without a Flask app of their own (e.g. the event worker).
+    :return: the server, call shutdown() to stop it
+    """
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+        return [render_text(metric_registry).encode()]
+
+    server = make_server(host, port, application, handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,99 @@
+"""Create the tables the app used to create with db.create_all()
+
+Revision ID: 1f0c5e7a2b34
+Revises:
+Create Date: 2026-10-18 10:00:48.402117
+
+Databases that the app already created keep their tables; this only
+matters for a fresh database set up with `manage.py db upgrade`.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1f0c5e7a2b34'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+TABLES = ['users', 'products', 'blacklist_tokens', 'purchase_logs', 'productlist',
+          'productlistitem']
+
+
+def has_table(name):
+    return name in sa.inspect(op.get_bind()).get_table_names()
+
+
+def upgrade():
+    if not has_table('users'):
+        op.create_table(
+            'users',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('email', sa.String(length=80), nullable=True),
+            sa.Column('password', sa.String(length=90), nullable=True),
+            sa.Column('role', sa.String(length=50), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if not has_table('products'):
+        op.create_table(
+            'products',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('item', sa.String(length=80), nullable=True),
+            sa.Column('npc', sa.String(length=80), nullable=True),
+            sa.Column('stock', sa.Integer(), nullable=True),
+            sa.Column('price', sa.Float(precision=2), nullable=True),
+            sa.Column('likes', sa.Integer(), nullable=True),
+            sa.Column('last_update', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if not has_table('blacklist_tokens'):
+        op.create_table(
+            'blacklist_tokens',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('token', sa.String(length=500), nullable=False),
+            sa.Column('blacklisted_on', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('token')
+        )
+    if not has_table('purchase_logs'):
+        op.create_table(
+            'purchase_logs',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=True),
+            sa.Column('product_id', sa.Integer(), nullable=True),
+            sa.Column('purchase_quantity', sa.Integer(), nullable=True),
+            sa.Column('datetime', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['product_id'], ['products.id']),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if not has_table('productlist'):
+        op.create_table(
+            'productlist',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=80), nullable=True),
+            sa.Column('date_created', sa.DateTime(), nullable=True),
+            sa.Column('date_modified', sa.DateTime(), nullable=True),
+            sa.Column('created_by', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['created_by'], ['users.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if not has_table('productlistitem'):
+        op.create_table(
+            'productlistitem',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('item', sa.String(), nullable=True),
+            sa.Column('productlist_id', sa.Integer(), nullable=False),
+            sa.Column('date_created', sa.DateTime(), nullable=True),
+            sa.Column('date_modified', sa.DateTime(), nullable=True),
+            sa.Column('likes', sa.Boolean(), nullable=True),
+            sa.ForeignKeyConstraint(['productlist_id'], ['productlist.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    for name in reversed(TABLES):
+        if has_table(name):
+            op.drop_table(name)
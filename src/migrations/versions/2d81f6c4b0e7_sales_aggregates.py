@@ -0,0 +1,85 @@
+"""Add per product, per day and per user sales aggregates
+
+Revision ID: 2d81f6c4b0e7
+Revises: 7c3e5a9d1f20
+Create Date: 2026-10-18 12:37:44.120965
+
+The aggregates are recomputed from purchase_logs, like `manage.py
+rebuild_sales` does, even when the tables already existed: an app that
+created them with db.create_all() has only aggregated the purchases made
+since, not the history.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d81f6c4b0e7'
+down_revision = '7c3e5a9d1f20'
+branch_labels = None
+depends_on = None
+
+TOTALS = ['units', 'purchases', 'last_purchase']
+
+
+def has_table(name):
+    return name in sa.inspect(op.get_bind()).get_table_names()
+
+
+def total_columns():
+    return [
+        sa.Column('units', sa.Integer(), nullable=False),
+        sa.Column('purchases', sa.Integer(), nullable=False),
+        sa.Column('last_purchase', sa.DateTime(), nullable=True),
+    ]
+
+
+def upgrade():
+    if not has_table('product_sales'):
+        op.create_table(
+            'product_sales',
+            sa.Column('product_id', sa.Integer(), nullable=False),
+            *total_columns(),
+            sa.ForeignKeyConstraint(['product_id'], ['products.id']),
+            sa.PrimaryKeyConstraint('product_id')
+        )
+        op.create_index('ix_product_sales_units', 'product_sales', ['units', 'product_id'])
+    if not has_table('product_sales_daily'):
+        op.create_table(
+            'product_sales_daily',
+            sa.Column('product_id', sa.Integer(), nullable=False),
+            sa.Column('day', sa.Date(), nullable=False),
+            *total_columns(),
+            sa.ForeignKeyConstraint(['product_id'], ['products.id']),
+            sa.PrimaryKeyConstraint('product_id', 'day')
+        )
+        op.create_index('ix_product_sales_daily_day_units', 'product_sales_daily',
+                        ['day', 'units', 'product_id'])
+    if not has_table('user_purchase_totals'):
+        op.create_table(
+            'user_purchase_totals',
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            *total_columns(),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('user_id')
+        )
+        op.create_index('ix_user_purchase_totals_units', 'user_purchase_totals',
+                        ['units', 'user_id'])
+
+    for table in ('product_sales', 'product_sales_daily', 'user_purchase_totals'):
+        op.execute('DELETE FROM {}'.format(table))
+    totals = ('sum(purchase_quantity), count(*), max(datetime) FROM purchase_logs '
+              'WHERE product_id IS NOT NULL')
+    op.execute('INSERT INTO product_sales (product_id, {0}) SELECT product_id, {1} '
+               'GROUP BY product_id'.format(', '.join(TOTALS), totals))
+    op.execute('INSERT INTO product_sales_daily (product_id, day, {0}) '
+               'SELECT product_id, date(datetime), {1} GROUP BY product_id, date(datetime)'
+               .format(', '.join(TOTALS), totals))
+    op.execute('INSERT INTO user_purchase_totals (user_id, {0}) SELECT user_id, {1} '
+               'AND user_id IS NOT NULL GROUP BY user_id'.format(', '.join(TOTALS), totals))
+
+
+def downgrade():
+    for table in ('user_purchase_totals', 'product_sales_daily', 'product_sales'):
+        if has_table(table):
+            op.drop_table(table)
@@ -0,0 +1,45 @@
+"""Make users.email unique
+
+Revision ID: 4b7d0c2e91a6
+Revises: ef92039bf802
+Create Date: 2026-10-18 10:31:52.204117
+
+Registration inserts and lets the unique index reject a taken email, so
+duplicates already in the table have to be merged by hand first.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7d0c2e91a6'
+down_revision = 'ef92039bf802'
+branch_labels = None
+depends_on = None
+
+
+def email_index():
+    for index in sa.inspect(op.get_bind()).get_indexes('users'):
+        if index['name'] == 'ix_users_email':
+            return index
+    return None
+
+
+def upgrade():
+    duplicates = op.get_bind().execute(sa.text(
+        'SELECT email FROM users GROUP BY email HAVING count(*) > 1')).fetchall()
+    if duplicates:
+        raise RuntimeError('users.email has duplicates, merge them before upgrading: {}'.format(
+            ', '.join(email for email, in duplicates)))
+    index = email_index()
+    if index is not None and index['unique']:
+        return
+    if index is not None:
+        op.drop_index('ix_users_email', table_name='users')
+    op.create_index('ix_users_email', 'users', ['email'], unique=True)
+
+
+def downgrade():
+    if email_index() is not None:
+        op.drop_index('ix_users_email', table_name='users')
+    op.create_index('ix_users_email', 'users', ['email'], unique=False)
@@ -0,0 +1,50 @@
+"""Add the event outbox and processed event tables
+
+Revision ID: 7c3e5a9d1f20
+Revises: 4b7d0c2e91a6
+Create Date: 2026-10-18 11:48:05.913274
+
+Tables that db.create_all() already created are left alone.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c3e5a9d1f20'
+down_revision = '4b7d0c2e91a6'
+branch_labels = None
+depends_on = None
+
+
+def has_table(name):
+    return name in sa.inspect(op.get_bind()).get_table_names()
+
+
+def upgrade():
+    if not has_table('outbox_events'):
+        op.create_table(
+            'outbox_events',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('event_id', sa.String(length=32), nullable=False),
+            sa.Column('routing_key', sa.String(length=64), nullable=False),
+            sa.Column('payload', sa.Text(), nullable=False),
+            sa.Column('created_on', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if not has_table('processed_events'):
+        op.create_table(
+            'processed_events',
+            sa.Column('event_id', sa.String(length=32), nullable=False),
+            sa.Column('processed_on', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('event_id')
+        )
+        op.create_index('ix_processed_events_processed_on', 'processed_events', ['processed_on'])
+
+
+def downgrade():
+    if has_table('processed_events'):
+        op.drop_index('ix_processed_events_processed_on', table_name='processed_events')
+        op.drop_table('processed_events')
+    if has_table('outbox_events'):
+        op.drop_table('outbox_events')
@@ -0,0 +1,89 @@
+"""Store blacklisted tokens as indexed sha256 hashes
+
+Revision ID: ef92039bf802
+Revises: f93f2f113ee4
+Create Date: 2026-10-18 10:04:37.118023
+
+The raw tokens cannot be recovered from their hashes, so a downgrade
+empties the blacklist: tokens logged out before it are accepted again
+until they expire.
+"""
+import base64
+import datetime
+import hashlib
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ef92039bf802'
+down_revision = 'f93f2f113ee4'
+branch_labels = None
+depends_on = None
+
+blacklist_tokens = sa.table(
+    'blacklist_tokens',
+    sa.column('id', sa.Integer),
+    sa.column('token', sa.String),
+    sa.column('token_hash', sa.String),
+    sa.column('expires_on', sa.DateTime)
+)
+
+
+def token_expiry(token):
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode())
+        return datetime.datetime.utcfromtimestamp(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = {column['name'] for column in sa.inspect(bind).get_columns('blacklist_tokens')}
+    if 'token' in columns:
+        with op.batch_alter_table('blacklist_tokens') as batch_op:
+            batch_op.add_column(sa.Column('token_hash', sa.String(length=64), nullable=True))
+            batch_op.add_column(sa.Column('expires_on', sa.DateTime(), nullable=True))
+
+        rows = bind.execute(sa.select([blacklist_tokens.c.id, blacklist_tokens.c.token])).fetchall()
+        for _id, token in rows:
+            bind.execute(blacklist_tokens.update().where(blacklist_tokens.c.id == _id).values(
+                token_hash=hashlib.sha256(token.encode()).hexdigest(),
+                expires_on=token_expiry(token)))
+
+        with op.batch_alter_table('blacklist_tokens') as batch_op:
+            batch_op.alter_column('token_hash', existing_type=sa.String(length=64), nullable=False)
+            batch_op.create_unique_constraint('uq_blacklist_tokens_token_hash', ['token_hash'])
+            batch_op.drop_column('token')
+
+    indexes = {index['name'] for index in sa.inspect(bind).get_indexes('blacklist_tokens')}
+    for name, column in (('ix_blacklist_tokens_blacklisted_on', 'blacklisted_on'),
+                         ('ix_blacklist_tokens_expires_on', 'expires_on')):
+        if name not in indexes:
+            op.create_index(name, 'blacklist_tokens', [column])
+
+
+def downgrade():
+    bind = op.get_bind()
+    indexes = {index['name'] for index in sa.inspect(bind).get_indexes('blacklist_tokens')}
+    for name in ('ix_blacklist_tokens_expires_on', 'ix_blacklist_tokens_blacklisted_on'):
+        if name in indexes:
+            op.drop_index(name, table_name='blacklist_tokens')
+
+    columns = {column['name'] for column in sa.inspect(bind).get_columns('blacklist_tokens')}
+    if 'token_hash' in columns:
+        # named by upgrade(), or by the database when create_all() made the table
+        constraints = [constraint['name'] for constraint
+                       in sa.inspect(bind).get_unique_constraints('blacklist_tokens')
+                       if constraint['column_names'] == ['token_hash'] and constraint['name']]
+        op.execute(blacklist_tokens.delete())
+        with op.batch_alter_table('blacklist_tokens') as batch_op:
+            for name in constraints:
+                batch_op.drop_constraint(name, type_='unique')
+            batch_op.drop_column('token_hash')
+            batch_op.drop_column('expires_on')
+            batch_op.add_column(sa.Column('token', sa.String(length=500), nullable=True))
+            batch_op.create_unique_constraint('uq_blacklist_tokens_token', ['token'])
@@ -0,0 +1,59 @@
+"""Index every hot lookup column
+
+Revision ID: f93f2f113ee4
+Revises: 1f0c5e7a2b34
+Create Date: 2026-10-18 10:02:11.530412
+
+db.create_all() also creates these indexes on a fresh database, so indexes
+that already exist are skipped.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f93f2f113ee4'
+down_revision = '1f0c5e7a2b34'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_users_email', 'users', ['email']),
+    ('ix_products_item', 'products', ['item']),
+    ('ix_products_item_lower', 'products', [sa.text('lower(item)')]),
+    ('ix_purchase_logs_user_id', 'purchase_logs', ['user_id']),
+    ('ix_purchase_logs_product_id', 'purchase_logs', ['product_id']),
+    ('ix_purchase_logs_datetime', 'purchase_logs', ['datetime']),
+    ('ix_productlist_created_by_id', 'productlist', ['created_by', 'id']),
+    ('ix_productlistitem_productlist_id_id', 'productlistitem', ['productlist_id', 'id']),
+]
+
+
+def existing_indexes(table):
+    # the inspector skips expression indexes, so ask the catalog directly
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        query = 'SELECT indexname FROM pg_indexes WHERE tablename = :table'
+    elif bind.dialect.name == 'sqlite':
+        query = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+    else:
+        return {index['name'] for index in sa.inspect(bind).get_indexes(table)}
+    return {name for name, in bind.execute(sa.text(query), table=table)}
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        if name not in existing_indexes(table):
+            op.create_index(name, table, columns)
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute('CREATE INDEX IF NOT EXISTS ix_products_item_trgm ON products '
+                   'USING gin (item gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_products_item_trgm')
+    for name, table, _ in reversed(INDEXES):
+        if name in existing_indexes(table):
+            op.drop_index(name, table_name=table)
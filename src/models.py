@@ -1,16 +1,30 @@
-from flask_sqlalchemy import SQLAlchemy
 from flask import current_app
+from sqlalchemy import DDL, and_, bindparam, case, event, func, literal_column, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from src.blacklist import token_blacklist
+from src.cache import product_cache
+from src.likes import like_buffer
+from src.pool import SQLAlchemy
 import datetime
+import hashlib
+import json
 import jwt
+import uuid
 
 db = SQLAlchemy()
 
 
+def supports_returning():
+    return db.engine.dialect.name == 'postgresql'
+
+
 class ProductModel(db.Model):
     __tablename__ = 'products'
 
     id = db.Column(db.Integer, primary_key=True)
-    item = db.Column(db.String(80))
+    item = db.Column(db.String(80), index=True)
     npc = db.Column(db.String(80))
     stock = db.Column(db.Integer)
     price = db.Column(db.Float(precision=2))
@@ -18,6 +32,10 @@ class ProductModel(db.Model):
     last_update = db.Column(db.DateTime)
     logs = db.relationship('PurchaseLogModel', lazy='dynamic')
 
+    __table_args__ = (
+        db.Index('ix_products_item_lower', func.lower(item)),
+    )
+
     def __init__(self, item, npc, stock, price):
         self.item = item
         self.npc = npc
@@ -33,22 +51,97 @@ class ProductModel(db.Model):
     def find_by_id(cls, _id):
         return cls.query.filter_by(id=_id).first()
 
+    @classmethod
+    def find_by_item(cls, item):
+        return cls.query.filter_by(item=item).first()
+
     @classmethod
     def find_by_name(cls, name, *order_by, **pagination):
-        return cls.query.filter_by(name=name).order_by(*order_by).paginate(**pagination)
+        return cls.query.filter_by(item=name).order_by(*order_by).paginate(**pagination)
 
     @classmethod
     def all_items(cls, *order_by, **pagination):
         return cls.query.order_by(*order_by).paginate(**pagination)
 
-    def to_dict(self):
+    @classmethod
+    def last_updated(cls, _id):
+        """
+        :return: (last_update,) row|None, without loading the product
+        """
+        return db.session.query(cls.last_update).filter(cls.id == _id).first()
+
+    @classmethod
+    def reserve_stock(cls, _id, quantity):
+        """
+        Decrements stock only if enough is left, in the caller's transaction
+        :return: row with the post-decrement stock|None
+        """
+        columns = (cls.id, cls.item, cls.npc, cls.stock, cls.price)
+        stmt = cls.__table__.update().where(
+            (cls.id == _id) & (cls.stock >= quantity)
+        ).values(stock=cls.stock - quantity, last_update=datetime.datetime.utcnow())
+        if supports_returning():
+            return db.session.execute(stmt.returning(*columns)).first()
+        if not db.session.execute(stmt).rowcount:
+            return None
+        return db.session.query(*columns).filter(cls.id == _id).first()
+
+    @classmethod
+    def reserve_stock_bulk(cls, quantities):
+        """
+        Decrements stock of every product in one UPDATE, in the caller's transaction
+        :param quantities: {product_id: quantity}
+        :return: {product_id: post-decrement stock}|None if any product is short
+        """
+        ids = list(quantities)
+        requested = case(quantities, value=cls.id)
+        stmt = cls.__table__.update().where(
+            cls.id.in_(ids) & (cls.stock >= requested)
+        ).values(stock=cls.stock - requested, last_update=datetime.datetime.utcnow())
+        if supports_returning():
+            rows = db.session.execute(stmt.returning(cls.id, cls.stock)).fetchall()
+            return dict(rows) if len(rows) == len(ids) else None
+        if db.session.execute(stmt).rowcount != len(ids):
+            return None
+        return cls.current_stocks(ids)
+
+    @classmethod
+    def add_likes(cls, deltas, session=None):
+        """
+        Applies {product_id: count} like increments in one executemany UPDATE,
+        in its own transaction unless a session is given; the caller then
+        commits and invalidates the product cache
+        """
+        stmt = cls.__table__.update().where(cls.id == bindparam('_id')).values(
+            likes=func.coalesce(cls.likes, 0) + bindparam('count'),
+            last_update=datetime.datetime.utcnow())
+        params = [{'_id': _id, 'count': count} for _id, count in deltas.items()]
+        if session is not None:
+            session.execute(stmt, params)
+            return
+        with db.engine.begin() as connection:
+            connection.execute(stmt, params)
+        product_cache.invalidate(*deltas)
+
+    @classmethod
+    def current_stock(cls, _id):
+        return db.session.query(cls.stock).filter(cls.id == _id).scalar()
+
+    @classmethod
+    def current_stocks(cls, ids):
+        return dict(db.session.query(cls.id, cls.stock).filter(cls.id.in_(list(ids))))
+
+    def to_dict(self, pending_likes=True):
+        likes = self.likes or 0
+        if pending_likes:
+            likes += like_buffer.pending(self.id)
         return {
             'id': self.id,
             'item': self.item,
             'npc': self.npc,
             'stock': self.stock,
             'price': self.price,
-            'likes': self.likes,
+            'likes': likes,
             'last_update': str(self.last_update)
         }
 
@@ -56,22 +149,33 @@ class ProductModel(db.Model):
         self.last_update = datetime.datetime.utcnow()
         db.session.add(self)
         db.session.commit()
+        product_cache.invalidate(self.id)
 
     def delete_from_db(self):
+        _id = self.id
         db.session.delete(self)
         db.session.commit()
+        product_cache.invalidate(_id)
+
+
+# substring and prefix search on PostgreSQL go through a trigram index
+event.listen(ProductModel.__table__, 'after_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+event.listen(ProductModel.__table__, 'after_create',
+             DDL('CREATE INDEX ix_products_item_trgm ON products '
+                 'USING gin (item gin_trgm_ops)').execute_if(dialect='postgresql'))
 
 
 class PurchaseLogModel(db.Model):
     __tablename__ = 'purchase_logs'
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     user = db.relationship('UserModel')
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id'))
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), index=True)
     product = db.relationship('ProductModel')
     purchase_quantity = db.Column(db.Integer)
-    datetime = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    datetime = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
 
     def __init__(self, user, product_id, purchase_quantity):
         self.user = user
@@ -85,7 +189,7 @@ class PurchaseLogModel(db.Model):
 
     @classmethod
     def find_by_user(cls, user):
-        return cls.query.filter_by(user=user).all()
+        return cls.query.options(joinedload(cls.product)).filter_by(user=user).all()
 
     @classmethod
     def find_by_id(cls, _id):
@@ -93,12 +197,28 @@ class PurchaseLogModel(db.Model):
 
     @classmethod
     def find_by_product(cls, product):
-        return cls.query.filter_by(product=product).all()
+        return cls.query.options(joinedload(cls.user)).filter_by(product=product).all()
+
+    @classmethod
+    def history(cls, user_id=None, product_id=None):
+        """
+        Column-only purchase history, newest first, joined in a single query
+        :return: query of rows with id, datetime, purchase_quantity, user, product_id, item, price
+        """
+        query = db.session.query(
+            cls.id, cls.datetime, cls.purchase_quantity, UserModel.email.label('user'),
+            ProductModel.id.label('product_id'), ProductModel.item, ProductModel.price
+        ).join(UserModel, cls.user_id == UserModel.id).join(ProductModel, cls.product_id == ProductModel.id)
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        if product_id is not None:
+            query = query.filter(cls.product_id == product_id)
+        return query.order_by(cls.datetime.desc(), cls.id.desc())
 
     def to_dict(self):
         return {
             'id': self.id,
-            'user': self.user.username,
+            'user': self.user.email,
             'product': self.product.to_dict(),
             'datetime': str(self.datetime)
         }
@@ -112,7 +232,7 @@ class UserModel(db.Model):
     __tablename__ = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(80))
+    email = db.Column(db.String(80), index=True, unique=True)
     password = db.Column(db.String(90))
     role = db.Column(db.String(50))
     logs = db.relationship('PurchaseLogModel', lazy='dynamic')
@@ -139,6 +259,31 @@ class UserModel(db.Model):
     def find_by_role(cls, role):
         return cls.query.filter_by(role=role).all()
 
+    @classmethod
+    def insert_if_absent(cls, email, password, role='user'):
+        """
+        One INSERT that leaves an existing user with the same email untouched,
+        relying on the unique index on email instead of a lookup first.
+        The caller commits.
+        :return: id of the new user, None if the email is already registered
+        """
+        table = cls.__table__
+        values = {'email': email, 'password': password, 'role': role}
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            statement = postgresql.insert(table).values(**values).on_conflict_do_nothing(
+                index_elements=[table.c.email]).returning(table.c.id)
+            return db.session.execute(statement).scalar()
+        if dialect == 'sqlite':
+            result = db.session.execute(table.insert().prefix_with('OR IGNORE').values(**values))
+            return result.lastrowid if result.rowcount else None
+        try:
+            with db.session.begin_nested():
+                result = db.session.execute(table.insert().values(**values))
+        except IntegrityError:
+            return None
+        return result.inserted_primary_key[0]
+
     def save_to_db(self):
         db.session.add(self)
         db.session.commit()
@@ -147,7 +292,8 @@ class UserModel(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def encode_auth_token(self, user_id):
+    @staticmethod
+    def encode_auth_token(user_id):
         """
         Generates the Auth Token
         :return: string
@@ -158,7 +304,9 @@ class UserModel(db.Model):
                                                                        seconds=current_app.config[
                                                                            'PAYLOAD_EXPIRATION_TIME']),
                 'iat': datetime.datetime.utcnow(),
-                'sub': user_id
+                'sub': user_id,
+                # keeps tokens issued within the same second distinct
+                'jti': uuid.uuid4().hex
             }
             return jwt.encode(
                 payload,
@@ -195,25 +343,47 @@ class BlacklistToken(db.Model):
     __tablename__ = 'blacklist_tokens'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    token = db.Column(db.String(500), unique=True, nullable=False)
-    blacklisted_on = db.Column(db.DateTime, nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    blacklisted_on = db.Column(db.DateTime, nullable=False, index=True)
+    expires_on = db.Column(db.DateTime, index=True)
 
-    def __init__(self, token):
-        self.token = token
-        self.blacklisted_on = datetime.datetime.now()
+    def __init__(self, token, expires_on=None):
+        self.token_hash = BlacklistToken.hash_token(token)
+        self.blacklisted_on = datetime.datetime.utcnow()
+        self.expires_on = expires_on
 
     def __repr__(self):
-        return '<id: token: {}'.format(self.token)
+        return '<id: {} token_hash: {} expires_on: {}'.format(self.id, self.token_hash, self.expires_on)
+
+    @staticmethod
+    def hash_token(auth_token):
+        if isinstance(auth_token, str):
+            auth_token = auth_token.encode()
+        return hashlib.sha256(auth_token).hexdigest()
 
     @staticmethod
     def check_blacklist(auth_token):
         # check whether auth token has been blacklisted
-        res = BlacklistToken.query.filter_by(token=str(auth_token)).first()
+        token_hash = BlacklistToken.hash_token(auth_token)
+        if not token_blacklist.might_contain(token_hash):
+            return False
+        res = BlacklistToken.query.filter_by(token_hash=token_hash).first()
         if res:
             return True
         else:
             return False
 
+    @classmethod
+    def prune_expired(cls):
+        """
+        Deletes blacklisted tokens whose JWT has expired anyway
+        :return: number of deleted rows
+        """
+        deleted = cls.query.filter(cls.expires_on < datetime.datetime.utcnow()).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return deleted
+
 
 class ProductList(db.Model):
     __tablename__ = 'productlist'
@@ -227,6 +397,10 @@ class ProductList(db.Model):
     date_modified = db.Column(db.DateTime, onupdate=datetime.datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_productlist_created_by_id', 'created_by', 'id'),
+    )
+
     def __init__(self, name, created_by):
         self.name = name
         self.created_by = created_by
@@ -248,6 +422,10 @@ class ProductListItem(db.Model):
     date_modified = db.Column(db.DateTime, onupdate=datetime.datetime.utcnow)
     likes = db.Column(db.Boolean)
 
+    __table_args__ = (
+        db.Index('ix_productlistitem_productlist_id_id', 'productlist_id', 'id'),
+    )
+
     def __init__(self, name, producttlist_id, likes=False):
         self.item = name
         self.productlist_id = producttlist_id
@@ -257,3 +435,271 @@ class ProductListItem(db.Model):
         return '<id: {} item: {} productlist_id: {} date_created: {} date_modified: {} done: {}'.format(
             self.id, self.item, self.productlist_id, self.date_created, self.date_modified, self.likes
         )
+
+
+class OutboxEvent(db.Model):
+    """
+    Event written in the transaction of the change it describes, so it is
+    stored if and only if the change commits. The relay (src/outbox.py)
+    publishes it and deletes the row.
+    """
+    __tablename__ = 'outbox_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.String(32), nullable=False)
+    routing_key = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_on = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __init__(self, routing_key, body):
+        self.event_id = body['id']
+        self.routing_key = routing_key
+        self.payload = json.dumps(body, separators=(',', ':'))
+
+    def __repr__(self):
+        return '<id: {} event_id: {} routing_key: {}'.format(self.id, self.event_id, self.routing_key)
+
+    @classmethod
+    def add(cls, routing_key, body):
+        """
+        Adds the event to the current transaction, the caller commits
+        """
+        db.session.add(cls(routing_key, body))
+
+    @classmethod
+    def claim(cls, limit):
+        """
+        Oldest events first; on PostgreSQL the rows stay locked until the
+        transaction ends and rows locked by another relay are skipped
+        """
+        query = cls.query.order_by(cls.id).limit(limit)
+        if db.session.get_bind().dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        return query.all()
+
+    def body(self):
+        return json.loads(self.payload)
+
+
+class ProcessedEvent(db.Model):
+    """
+    Ids of events the worker already wrote, inserted in the same transaction
+    as their effects so a redelivered event is skipped.
+    """
+    __tablename__ = 'processed_events'
+
+    event_id = db.Column(db.String(32), primary_key=True)
+    processed_on = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def seen(cls, event_ids, chunk_size=500):
+        """
+        :return: set of the given ids that were already processed
+        """
+        event_ids = list(event_ids)
+        seen = set()
+        for i in range(0, len(event_ids), chunk_size):
+            seen.update(event_id for event_id, in db.session.query(cls.event_id).filter(
+                cls.event_id.in_(event_ids[i:i + chunk_size])))
+        return seen
+
+    @classmethod
+    def prune(cls, older_than):
+        """
+        Forgets ids processed before `older_than`; redeliveries older than
+        that are no longer recognised
+        :return: number of deleted rows
+        """
+        deleted = cls.query.filter(cls.processed_on < older_than).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class ProductSales(db.Model):
+    """
+    Units sold per product, maintained by record_sales
+    """
+    __tablename__ = 'product_sales'
+
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    purchases = db.Column(db.Integer, nullable=False, default=0)
+    last_purchase = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_product_sales_units', units, product_id),
+    )
+
+    @classmethod
+    def top(cls, limit):
+        """
+        Best sellers, read from the (units, product_id) index
+        :return: rows of product_id, item, units, purchases, last_purchase
+        """
+        return db.session.query(
+            cls.product_id, ProductModel.item, cls.units, cls.purchases, cls.last_purchase
+        ).join(ProductModel, ProductModel.id == cls.product_id).order_by(
+            cls.units.desc(), cls.product_id.desc()).limit(limit).all()
+
+
+class ProductSalesDaily(db.Model):
+    """
+    Units sold per product and UTC day, maintained by record_sales
+    """
+    __tablename__ = 'product_sales_daily'
+
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    purchases = db.Column(db.Integer, nullable=False, default=0)
+    last_purchase = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_product_sales_daily_day_units', day, units, product_id),
+    )
+
+    @classmethod
+    def top(cls, day, limit):
+        return db.session.query(
+            cls.product_id, ProductModel.item, cls.units, cls.purchases, cls.last_purchase
+        ).join(ProductModel, ProductModel.id == cls.product_id).filter(cls.day == day).order_by(
+            cls.units.desc(), cls.product_id.desc()).limit(limit).all()
+
+    @classmethod
+    def series(cls, product_id, since):
+        """
+        :return: rows of day, units, purchases from `since` on, oldest first
+        """
+        return db.session.query(cls.day, cls.units, cls.purchases).filter(
+            cls.product_id == product_id, cls.day >= since).order_by(cls.day).all()
+
+
+class UserPurchaseTotals(db.Model):
+    """
+    Units bought per user, maintained by record_sales
+    """
+    __tablename__ = 'user_purchase_totals'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    purchases = db.Column(db.Integer, nullable=False, default=0)
+    last_purchase = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_user_purchase_totals_units', units, user_id),
+    )
+
+    @classmethod
+    def top(cls, limit):
+        return db.session.query(
+            cls.user_id, UserModel.email, cls.units, cls.purchases, cls.last_purchase
+        ).join(UserModel, UserModel.id == cls.user_id).order_by(
+            cls.units.desc(), cls.user_id.desc()).limit(limit).all()
+
+
+def _add_totals(model, keys, totals):
+    """
+    Adds {key tuple: [units, purchases, last_purchase]} into `model`,
+    inserting missing rows, with one executemany upsert on PostgreSQL and
+    SQLite. Rows are written in key order so concurrent writers cannot
+    deadlock.
+    """
+    if not totals:
+        return
+    table = model.__table__
+    rows = [dict(zip(keys, key), units=units, purchases=purchases, last_purchase=last_purchase)
+            for key, (units, purchases, last_purchase) in sorted(totals.items())]
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c[key] for key in keys],
+            set_={
+                'units': table.c.units + statement.excluded.units,
+                'purchases': table.c.purchases + statement.excluded.purchases,
+                'last_purchase': func.greatest(table.c.last_purchase,
+                                               statement.excluded.last_purchase)
+            }), rows)
+        return
+    if dialect == 'sqlite':
+        # SQLAlchemy has no SQLite upsert construct yet, the syntax needs SQLite 3.24
+        columns = list(keys) + ['units', 'purchases', 'last_purchase']
+        statement = text(
+            'INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT ({keys}) DO UPDATE SET '
+            'units = units + excluded.units, purchases = purchases + excluded.purchases, '
+            'last_purchase = max(coalesce(last_purchase, excluded.last_purchase), '
+            'excluded.last_purchase)'.format(
+                table=table.name, columns=', '.join(columns), keys=', '.join(keys),
+                values=', '.join(':' + column for column in columns))
+        ).bindparams(*[bindparam(column, type_=table.c[column].type) for column in columns])
+        db.session.execute(statement, rows)
+        return
+    for row in rows:
+        match = and_(*[table.c[key] == row[key] for key in keys])
+        update = table.update().where(match).values(
+            units=table.c.units + row['units'], purchases=table.c.purchases + row['purchases'],
+            last_purchase=case([(table.c.last_purchase > row['last_purchase'],
+                                 table.c.last_purchase)], else_=row['last_purchase']))
+        if db.session.execute(update).rowcount:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(**row))
+        except IntegrityError:
+            db.session.execute(update)
+
+
+def _accumulate(totals, key, quantity, at):
+    entry = totals.get(key)
+    if entry is None:
+        totals[key] = [quantity, 1, at]
+    else:
+        entry[0] += quantity
+        entry[1] += 1
+        entry[2] = max(entry[2], at)
+
+
+def record_sales(purchases):
+    """
+    Adds purchases to the sales aggregates in the caller's transaction
+    :param purchases: iterable of (user_id, product_id, quantity, datetime)
+    """
+    products, days, users = {}, {}, {}
+    for user_id, product_id, quantity, at in purchases:
+        _accumulate(products, (product_id,), quantity, at)
+        _accumulate(days, (product_id, at.date()), quantity, at)
+        if user_id is not None:
+            _accumulate(users, (user_id,), quantity, at)
+    _add_totals(ProductSales, ('product_id',), products)
+    _add_totals(ProductSalesDaily, ('product_id', 'day'), days)
+    _add_totals(UserPurchaseTotals, ('user_id',), users)
+
+
+def rebuild_sales():
+    """
+    Recomputes every sales aggregate from purchase_logs in one transaction;
+    stop the event worker first, purchases it writes meanwhile may be lost.
+    :return: number of purchase logs aggregated
+    """
+    logs = PurchaseLogModel.__table__
+    recorded = logs.c.product_id.isnot(None)
+    totals = [func.sum(logs.c.purchase_quantity), func.count(literal_column('*')),
+              func.max(logs.c.datetime)]
+    columns = ['units', 'purchases', 'last_purchase']
+    day = func.date(logs.c.datetime)
+    for model in (ProductSales, ProductSalesDaily, UserPurchaseTotals):
+        db.session.execute(model.__table__.delete())
+    db.session.execute(ProductSales.__table__.insert().from_select(
+        ['product_id'] + columns,
+        db.select([logs.c.product_id] + totals).where(recorded).group_by(logs.c.product_id)))
+    db.session.execute(ProductSalesDaily.__table__.insert().from_select(
+        ['product_id', 'day'] + columns,
+        db.select([logs.c.product_id, day] + totals).where(recorded).group_by(
+            logs.c.product_id, day)))
+    db.session.execute(UserPurchaseTotals.__table__.insert().from_select(
+        ['user_id'] + columns,
+        db.select([logs.c.user_id] + totals).where(
+            recorded & logs.c.user_id.isnot(None)).group_by(logs.c.user_id)))
+    count = db.session.query(func.count(logs.c.id)).filter(recorded).scalar()
+    db.session.commit()
+    return count
@@ -0,0 +1,93 @@
+import datetime
+import logging
+import signal
+import time
+from src import metrics
+from src.events import event_bus
+
+log = logging.getLogger(__name__)
+
+relayed = metrics.counter(
+    'outbox_relayed_total', 'Outbox events published and deleted.')
+relay_failures = metrics.counter(
+    'outbox_relay_failures_total', 'Relay passes that stopped on a failed publish.')
+relay_lag = metrics.gauge(
+    'outbox_lag_seconds', 'Age of the newest event of the last relayed batch.')
+
+
+class OutboxRelay(object):
+    """
+    Moves outbox events to the broker.
+
+    Each pass claims the oldest `batch_size` rows, publishes them in id
+    order with publisher confirms and deletes the published ones in the same
+    transaction. A crash between the publish and the commit publishes the
+    batch again, so delivery is at least once and consumers dedup on the
+    event id.
+
+    On PostgreSQL several relays can run side by side, each skipping the
+    rows another one has locked; events are then no longer globally ordered,
+    only within a batch. Run a single relay on other databases.
+    """
+
+    def __init__(self, flask_app, batch_size=500, poll_interval=0.5, retry_interval=5):
+        self.app = flask_app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.should_stop = False
+
+    def relay_once(self):
+        """
+        :return: number of events published, None if the broker refused one
+        """
+        from src.models import db, OutboxEvent
+        with self.app.app_context():
+            try:
+                events = OutboxEvent.claim(self.batch_size)
+                published = []
+                for event in events:
+                    # stop at the first failure so later events do not overtake it
+                    if not event_bus.publish(event.routing_key, event.body()):
+                        break
+                    published.append(event)
+                if published:
+                    newest = published[-1].created_on
+                    OutboxEvent.query.filter(OutboxEvent.id.in_([event.id for event in published])) \
+                        .delete(synchronize_session=False)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        if published:
+            relayed.inc(len(published))
+            relay_lag.set((datetime.datetime.utcnow() - newest).total_seconds())
+        if len(published) < len(events):
+            relay_failures.inc()
+            return None
+        return len(published)
+
+    def run(self):
+        if not event_bus.enabled:
+            raise RuntimeError('EVENTS_ENABLED is off, nothing would be published.')
+        log.info('Relaying outbox events in batches of %d', self.batch_size)
+        while not self.should_stop:
+            try:
+                count = self.relay_once()
+            except Exception:
+                log.exception('Relaying outbox events failed')
+                count = None
+            if count is None:
+                time.sleep(self.retry_interval)
+            elif count < self.batch_size:
+                time.sleep(self.poll_interval)
+
+    def stop(self, *args):
+        """
+        Finishes the current batch and returns from run(); usable as a signal handler.
+        """
+        self.should_stop = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
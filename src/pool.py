@@ -0,0 +1,88 @@
+import time
+import weakref
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+from src import metrics
+
+checkout_seconds = metrics.histogram(
+    'db_pool_checkout_seconds', 'Time spent waiting for a connection from the pool.')
+checkout_timeouts = metrics.counter(
+    'db_pool_checkout_timeouts_total', 'Checkouts that gave up after pool_timeout.')
+overflow_opened = metrics.counter(
+    'db_pool_overflow_connections_total', 'Connections opened beyond pool_size.')
+connections = metrics.gauge(
+    'db_pool_connections', 'Pool connections by state.', ['state'])
+
+_pools = weakref.WeakSet()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool recording checkout waits, timeouts and overflow connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            checkout_timeouts.inc()
+            raise
+        finally:
+            checkout_seconds.observe(time.perf_counter() - started)
+
+    def _inc_overflow(self):
+        opened = super(InstrumentedQueuePool, self)._inc_overflow()
+        if opened and self._overflow > 0:
+            overflow_opened.inc()
+        return opened
+
+
+def _connection_states():
+    states = {('checked_out',): 0, ('idle',): 0, ('overflow',): 0}
+    for pool in list(_pools):
+        states[('checked_out',)] += pool.checkedout()
+        states[('idle',)] += pool.checkedin()
+        states[('overflow',)] += max(pool.overflow(), 0)
+    return states
+
+
+connections.set_function(_connection_states)
+
+
+def pool_status():
+    """
+    :return: current size and usage of every instrumented pool
+    """
+    return [{
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'idle': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': pool._max_overflow,
+        'timeout': pool._timeout
+    } for pool in list(_pools)]
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Applies SQLALCHEMY_ENGINE_OPTIONS and pools connections in an
+    InstrumentedQueuePool unless the driver needs a pool of its own.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        poolclass = options.setdefault('poolclass', InstrumentedQueuePool)
+        if not issubclass(poolclass, QueuePool):
+            # e.g. NullPool/StaticPool picked for SQLite take no sizing arguments
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(key, None)
+        elif info.drivername.startswith('sqlite'):
+            # pooled sqlite connections are handed to whichever thread checks them out
+            options.setdefault('connect_args', {}).setdefault('check_same_thread', False)
@@ -0,0 +1,169 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-SQL-Profile'
+
+# QueryProfiles recording on this thread, innermost last
+_local = threading.local()
+
+
+class QueryProfile(object):
+    """
+    SQL statements executed while the profile was active, with their timings.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def seconds(self):
+        return sum(elapsed for _, _, elapsed in self.queries)
+
+    def record(self, statement, parameters, elapsed):
+        self.queries.append((statement, parameters, elapsed))
+
+    def by_statement(self):
+        """
+        :return: [{statement, count, time_ms}] grouped by statement text, slowest first
+        """
+        groups = OrderedDict()
+        for statement, _, elapsed in self.queries:
+            group = groups.setdefault(statement, [0, 0.0])
+            group[0] += 1
+            group[1] += elapsed
+        return sorted(({'statement': statement, 'count': count, 'time_ms': round(total * 1000, 3)}
+                       for statement, (count, total) in groups.items()),
+                      key=lambda group: group['time_ms'], reverse=True)
+
+    def duplicates(self):
+        """
+        Statements executed more than once with the same parameters.
+        :return: [{statement, count}]
+        """
+        seen = OrderedDict()
+        for statement, parameters, _ in self.queries:
+            key = (statement, repr(parameters))
+            seen[key] = seen.get(key, 0) + 1
+        return [{'statement': statement, 'count': count}
+                for (statement, _), count in seen.items() if count > 1]
+
+    def summary(self, limit=10):
+        return {
+            'count': self.count,
+            'time_ms': round(self.seconds * 1000, 3),
+            'duplicates': self.duplicates(),
+            'statements': self.by_statement()[:limit]
+        }
+
+    def assert_max_queries(self, limit):
+        """
+        :raise AssertionError: listing the statements when more than limit ran
+        """
+        if self.count > limit:
+            raise AssertionError('{} SQL statements executed, expected at most {}:\n{}'.format(
+                self.count, limit, json.dumps(self.by_statement(), indent=2)))
+
+
+def _active():
+    profiles = getattr(_local, 'profiles', None)
+    if profiles is None:
+        profiles = _local.profiles = []
+    return profiles
+
+
+@contextmanager
+def profile_queries():
+    """
+    Records the statements run on this thread inside the block, e.g.
+
+        with profile_queries() as profile:
+            client.get('/api/v1/productsCRUD/')
+        profile.assert_max_queries(3)
+    """
+    profile = QueryProfile()
+    _active().append(profile)
+    try:
+        yield profile
+    finally:
+        _active().remove(profile)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'profiles', None):
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profiles = getattr(_local, 'profiles', None)
+    started = conn.info.get('profile_started')
+    if profiles and started:
+        elapsed = time.perf_counter() - started.pop()
+        for profile in profiles:
+            profile.record(statement, parameters, elapsed)
+
+
+def _requested():
+    config = current_app.config
+    if config.get('SQL_PROFILER_ENABLED'):
+        return True
+    return bool(config.get('SQL_PROFILER_HEADER_ENABLED') and request.headers.get(PROFILE_HEADER))
+
+
+def init_app(flask_app, blueprint):
+    """
+    Profiles api requests when SQL_PROFILER_ENABLED is set, or when the
+    client sends X-SQL-Profile and SQL_PROFILER_HEADER_ENABLED allows it.
+    When SQL_SLOW_REQUEST_MS is set (development and staging), every request
+    is also timed against it and logged with its query breakdown when slower.
+    """
+    @blueprint.before_request
+    def start_profile():
+        attach = _requested()
+        if attach or current_app.config.get('SQL_SLOW_REQUEST_MS') is not None:
+            profile = QueryProfile()
+            _active().append(profile)
+            _local.request_profile = (profile, attach, time.perf_counter())
+
+    @blueprint.after_request
+    def finish_profile(response):
+        current = getattr(_local, 'request_profile', None)
+        if current is None:
+            return response
+        _local.request_profile = None
+        profile, attach, started = current
+        if profile in _active():
+            _active().remove(profile)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        threshold = current_app.config.get('SQL_SLOW_REQUEST_MS')
+        if threshold is not None and elapsed_ms > threshold:
+            log.warning('Slow request %s %s took %.1f ms: %s', request.method, request.path,
+                        elapsed_ms, json.dumps(profile.summary()))
+
+        if attach:
+            summary = profile.summary()
+            response.headers['X-SQL-Count'] = str(summary['count'])
+            response.headers['X-SQL-Time-Ms'] = str(summary['time_ms'])
+            response.headers['X-SQL-Duplicates'] = str(
+                sum(duplicate['count'] - 1 for duplicate in summary['duplicates']))
+            if request.headers.get(PROFILE_HEADER) == 'body' and response.is_json:
+                payload = response.get_json()
+                if isinstance(payload, dict):
+                    payload['_sql_profile'] = summary
+                    response.set_data(json.dumps(payload))
+        return response
@@ -0,0 +1,135 @@
+import socketserver
+import threading
+from email import message_from_bytes
+
+
+def envelope_address(argument):
+    # 'FROM:<a@example.com> SIZE=123' -> 'a@example.com'
+    return argument.partition(':')[2].strip().split(' ')[0].strip('<>')
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib: HELO/EHLO, MAIL, RCPT, DATA, RSET,
+    NOOP and QUIT, without authentication or TLS.
+    """
+
+    def reply(self, line):
+        self.wfile.write('{}\r\n'.format(line).encode())
+
+    def handle(self):
+        self.server.connected()
+        self.reply('220 {} smtp-debug'.format(self.server.host))
+        mailfrom, rcpttos = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self.reply('250-{}'.format(self.server.host))
+                self.reply('250 8BITMIME')
+            elif command == 'HELO':
+                self.reply('250 {}'.format(self.server.host))
+            elif command == 'MAIL':
+                mailfrom, rcpttos = envelope_address(argument), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                if mailfrom is None:
+                    self.reply('503 Error: need MAIL command')
+                    continue
+                rcpttos.append(envelope_address(argument))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                if not rcpttos:
+                    self.reply('503 Error: need RCPT command')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                self.reply(self.server.process_message(mailfrom, rcpttos, data) or '250 OK')
+                mailfrom, rcpttos = None, []
+            elif command == 'RSET':
+                mailfrom, rcpttos = None, []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('500 Error: command "{}" not recognized'.format(command))
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line.rstrip(b'\r\n') == b'.':
+                return b''.join(lines)
+            # undo the client's dot-stuffing
+            lines.append(line[1:] if line.startswith(b'.') else line)
+
+
+class DebuggingSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP stand-in that keeps what it receives in `messages`.
+
+    Point MAIL_SERVER/MAIL_PORT at it with MAIL_USE_SSL and MAIL_USE_TLS off
+    and MAIL_SUPPRESS_SEND False. As a context manager it serves from a
+    background thread:
+
+        with DebuggingSMTPServer() as server:
+            app.config.update(MAIL_SERVER=server.host, MAIL_PORT=server.port)
+
+    `fail_next` makes that many of the next messages fail with a 451, to
+    exercise retries. `connections` counts the SMTP connections accepted.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=0, on_message=None):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), SMTPHandler)
+        self.host, self.port = self.server_address[:2]
+        self.on_message = on_message
+        self.messages = []
+        self.fail_next = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def connected(self):
+        with self._lock:
+            self.connections += 1
+
+    def process_message(self, mailfrom, rcpttos, data):
+        """
+        :return: an error reply, or None to accept the message
+        """
+        with self._lock:
+            if self.fail_next:
+                self.fail_next -= 1
+                return '451 Requested action aborted: local error in processing'
+            message = message_from_bytes(data)
+            self.messages.append(message)
+        if self.on_message is not None:
+            self.on_message(mailfrom, rcpttos, message)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05},
+                                        name='smtp-debug')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
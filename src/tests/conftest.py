@@ -0,0 +1,84 @@
+"""
+Run from the repository root, which holds logging.conf:
+
+    python -m pytest src/tests
+"""
+import os
+import tempfile
+import pytest
+
+os.environ.setdefault('APP_SETTINGS', 'src.config.TestingConfig')
+os.environ.setdefault('TEST_DATABASE_URI', 'sqlite:///{}'.format(
+    os.path.join(tempfile.gettempdir(), 'ecommerce-tests.db')))
+os.environ.setdefault('FLASK_SECRET_KEY', 'testing')
+
+
+@pytest.fixture(scope='session')
+def app():
+    from src.app import app, initialize_app
+    return initialize_app(app)
+
+
+@pytest.fixture
+def db(app):
+    """
+    Empty tables with one user and three products, inside an app context.
+    """
+    from src.models import db, UserModel, ProductModel
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(UserModel('buyer@example.com', 'secret', 'user'))
+        db.session.add_all([ProductModel('product {}'.format(i), 'npc', 100, 1.0)
+                            for i in range(3)])
+        db.session.commit()
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def broker(app):
+    """
+    Enables events over the in-process memory:// transport, with empty queues.
+    """
+    from kombu import Connection
+    from src.events import ANALYTICS_QUEUE, DEAD_LETTER_QUEUE, event_bus
+    app.config['EVENTS_ENABLED'] = True
+    event_bus.init_app(app)
+    with Connection(app.config['BROKER_URL']) as connection:
+        for queue in (ANALYTICS_QUEUE, DEAD_LETTER_QUEUE):
+            queue(connection.default_channel).declare()
+            queue(connection.default_channel).purge()
+        yield connection
+    app.config['EVENTS_ENABLED'] = False
+    event_bus.enabled = False
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+@pytest.fixture
+def token(client):
+    """
+    Auth token of a newly registered user, for the X-API-TOKEN header.
+    """
+    import json
+    response = client.post('/api/v1/auth/register', content_type='application/json',
+                           data=json.dumps({'email': 'new@example.com', 'password': 'secret'}))
+    return json.loads(response.data.decode())['auth_token']
+
+
+@pytest.fixture
+def admin_token(client, db, token):
+    """
+    Auth token of the same user, promoted to admin.
+    """
+    import json
+    from src.models import UserModel
+    UserModel.query.filter_by(email='new@example.com').one().role = 'admin'
+    db.session.commit()
+    response = client.post('/api/v1/auth/login', content_type='application/json',
+                           data=json.dumps({'email': 'new@example.com', 'password': 'secret'}))
+    return json.loads(response.data.decode())['auth_token']
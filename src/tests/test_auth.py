@@ -0,0 +1,32 @@
+import json
+from src.api.auth.cache import token_cache, token_digest
+from src.blacklist import token_blacklist
+from src.models import BlacklistToken
+
+
+def post(client, url, data, token=None):
+    headers = {'X-API-TOKEN': token} if token else {}
+    response = client.post(url, data=json.dumps(data), content_type='application/json',
+                           headers=headers)
+    return response.status_code, json.loads(response.data.decode())
+
+
+def register(client, email='new@example.com', password='secret'):
+    status, body = post(client, '/api/v1/auth/register', {'email': email, 'password': password})
+    assert status == 201
+    return body['auth_token']
+
+
+def test_cached_token_blacklisted_elsewhere_is_rejected(client, db):
+    token = register(client)
+    assert client.get('/api/v1/auth/status', headers={'X-API-TOKEN': token}).status_code == 200
+    assert token_cache.get(token_digest(token)) is not None
+
+    # a logout on another worker: the row and the bloom filter, but not this cache
+    blacklisted = BlacklistToken(token, None)
+    db.session.add(blacklisted)
+    db.session.commit()
+    token_blacklist.add(blacklisted.token_hash)
+
+    assert client.get('/api/v1/auth/status', headers={'X-API-TOKEN': token}).status_code == 401
+    assert token_cache.get(token_digest(token)) is None
@@ -0,0 +1,63 @@
+import datetime
+import hashlib
+import threading
+from src.blacklist import BloomFilter, TokenBlacklist
+from src.models import BlacklistToken
+
+
+def digest(value):
+    return hashlib.sha256(str(value).encode()).hexdigest()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    digests = [digest(i) for i in range(1000)]
+    for value in digests:
+        bloom.add(value)
+
+    assert all(value in bloom for value in digests)
+    false_positives = sum(digest(-i) in bloom for i in range(1, 10001))
+    assert false_positives < 300
+
+
+def test_bloom_filter_counts_each_digest_once():
+    bloom = BloomFilter(100)
+    assert bloom.add(digest(1)) is True
+    assert bloom.add(digest(1)) is False
+    assert bloom.count == 1
+
+
+def test_concurrent_adds_are_all_kept():
+    blacklist = TokenBlacklist(capacity=10000)
+    blacklist._filter = BloomFilter(10000)
+    digests = [digest(i) for i in range(4000)]
+
+    def add(chunk):
+        for value in chunk:
+            blacklist.add(value)
+
+    threads = [threading.Thread(target=add, args=(digests[i::8],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(blacklist.might_contain(value) for value in digests)
+
+
+def test_sync_overlap_does_not_force_a_reload(app, db, monkeypatch):
+    now = datetime.datetime.utcnow()
+    db.session.add_all([BlacklistToken('token {}'.format(i), now) for i in range(3)])
+    db.session.commit()
+    blacklist = TokenBlacklist(capacity=3, sync_interval=0)
+    blacklist.load()
+    reloads = []
+    monkeypatch.setattr(blacklist, 'load', lambda: reloads.append(True))
+
+    # every sync re-reads the rows of the overlap window
+    for _ in range(5):
+        blacklist.sync()
+
+    assert blacklist._filter.count == 3
+    assert reloads == []
+    assert blacklist.might_contain(BlacklistToken.hash_token('token 0'))
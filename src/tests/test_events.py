@@ -0,0 +1,129 @@
+from kombu import Producer
+from src.events import ANALYTICS_QUEUE, DEAD_LETTER_QUEUE, EXCHANGE, LIKE, PURCHASE, \
+    like_event, purchase_event, event_bus
+from src.models import OutboxEvent, ProcessedEvent, ProductModel, PurchaseLogModel
+from src.outbox import OutboxRelay
+from src.worker import Worker
+
+
+def publish(connection, *events):
+    producer = Producer(connection.default_channel, exchange=EXCHANGE, serializer='json')
+    for routing_key, body in events:
+        producer.publish(body, routing_key=routing_key)
+
+
+def received(connection, queue=ANALYTICS_QUEUE):
+    messages = []
+    while True:
+        message = queue(connection.default_channel).get(no_ack=True)
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+def test_redelivered_events_are_written_once(app, db, broker):
+    purchase = purchase_event(1, {1: 2, 2: 1})
+    like = like_event(3, 4)
+    publish(broker, (PURCHASE, purchase), (LIKE, like), (PURCHASE, purchase), (LIKE, like))
+
+    worker = Worker(broker, app, batch_size=2, batch_timeout=0.01)
+    assert worker.drain(timeout=0.01) == 4
+    # and again in a later batch, after a crash between commit and ack
+    publish(broker, (PURCHASE, purchase))
+    assert worker.drain(timeout=0.01) == 1
+
+    db.session.remove()
+    logs = sorted((log.product_id, log.purchase_quantity) for log in PurchaseLogModel.query)
+    assert logs == [(1, 2), (2, 1)]
+    assert ProductModel.query.get(3).likes == 4
+    assert ProcessedEvent.seen([purchase['id'], like['id']]) == {purchase['id'], like['id']}
+
+
+def test_failing_batch_is_written_once_after_requeue(app, db, broker):
+    calls = []
+
+    def flaky(events):
+        calls.append(len(events))
+        if len(calls) == 1:
+            raise RuntimeError('database went away')
+
+    purchase = purchase_event(1, {1: 1})
+    publish(broker, (PURCHASE, purchase), (LIKE, like_event(1)))
+    worker = Worker(broker, app, batch_size=10, batch_timeout=0.01,
+                    handlers={PURCHASE: flaky, LIKE: lambda events: None})
+    assert worker.drain(timeout=0.01) + worker.drain(timeout=0.01) == 2
+    assert calls == [1, 1]
+    assert received(broker, DEAD_LETTER_QUEUE) == []
+
+
+def test_poison_events_are_dead_lettered(app, db, broker):
+    def handler(events):
+        if any(event.get('poison') for event in events):
+            raise KeyError('lines')
+
+    good = purchase_event(1, {1: 1})
+    poison = dict(purchase_event(1, {2: 1}), poison=True)
+    publish(broker, (PURCHASE, {'no': 'id'}), (PURCHASE, good), (PURCHASE, poison))
+    worker = Worker(broker, app, batch_size=10, batch_timeout=0.01,
+                    handlers={PURCHASE: handler})
+    acknowledged = 0
+    for _ in range(3):
+        acknowledged += worker.drain(timeout=0.01)
+
+    assert acknowledged == 1
+    assert ProcessedEvent.seen([good['id'], poison['id']]) == {good['id']}
+    reasons = [message.headers['x-dead-letter-reason']
+               for message in received(broker, DEAD_LETTER_QUEUE)]
+    assert reasons == ['no event id', 'failed again after a redelivery']
+
+
+def test_relay_publishes_in_order_and_deletes(app, db, broker):
+    bodies = [purchase_event(1, {i: 1}) for i in range(1, 4)]
+    for body in bodies:
+        OutboxEvent.add(PURCHASE, body)
+    db.session.commit()
+
+    assert OutboxRelay(app, batch_size=2).relay_once() == 2
+    assert OutboxRelay(app, batch_size=2).relay_once() == 1
+    assert OutboxRelay(app, batch_size=2).relay_once() == 0
+
+    assert [message.payload['id'] for message in received(broker)] == [
+        body['id'] for body in bodies]
+    db.session.remove()
+    assert OutboxEvent.query.count() == 0
+
+
+def test_relay_stops_at_the_first_failed_publish(app, db, broker, monkeypatch):
+    bodies = [like_event(i) for i in range(1, 4)]
+    for body in bodies:
+        OutboxEvent.add(LIKE, body)
+    db.session.commit()
+    publish_event = event_bus.publish
+    monkeypatch.setattr(event_bus, 'publish', lambda routing_key, body, **kwargs: (
+        body['id'] != bodies[1]['id'] and publish_event(routing_key, body, **kwargs)))
+
+    assert OutboxRelay(app).relay_once() is None
+
+    assert [message.payload['id'] for message in received(broker)] == [bodies[0]['id']]
+    db.session.remove()
+    assert [event.event_id for event in OutboxEvent.query.order_by(OutboxEvent.id)] == [
+        body['id'] for body in bodies[1:]]
+
+
+def test_buy_and_like_reach_the_worker_through_the_outbox(app, db, broker, client, token):
+    headers = {'X-API-TOKEN': token}
+    assert client.post('/api/v1/productsCRUD/products/1/buy?quantity=2',
+                       headers=headers).status_code == 200
+    assert client.post('/api/v1/productsCRUD/products/2/like', headers=headers).status_code == 200
+
+    # nothing is written to the log or the likes until the worker runs
+    db.session.remove()
+    assert PurchaseLogModel.query.count() == 0
+    assert [event.routing_key for event in OutboxEvent.query.order_by(OutboxEvent.id)] == [
+        PURCHASE, LIKE]
+
+    assert OutboxRelay(app).relay_once() == 2
+    assert Worker(broker, app, batch_size=10, batch_timeout=0.01).drain(timeout=0.01) == 2
+    db.session.remove()
+    assert [(log.product_id, log.purchase_quantity) for log in PurchaseLogModel.query] == [(1, 2)]
+    assert ProductModel.query.get(2).likes == 1
@@ -0,0 +1,50 @@
+import csv
+import datetime
+import io
+import json
+from src.api.productsCRUD.export import product_rows, stream_rows
+from src.models import PurchaseLogModel
+
+DAY = datetime.datetime(2026, 10, 1, 12)
+
+
+def test_rows_are_streamed_in_batches(db):
+    chunks = list(stream_rows(product_rows(), 'ndjson', batch_size=2))
+
+    assert [chunk.count('\n') for chunk in chunks] == [2, 1]
+    rows = [json.loads(line) for line in ''.join(chunks).splitlines()]
+    assert [(row['id'], row['item'], row['stock']) for row in rows] == [
+        (1, 'product 0', 100), (2, 'product 1', 100), (3, 'product 2', 100)]
+
+
+def test_csv_starts_with_the_header_row(db):
+    chunks = list(stream_rows(product_rows(), 'csv', batch_size=2))
+
+    assert len(chunks) == 2
+    rows = list(csv.reader(io.StringIO(''.join(chunks))))
+    assert rows[0] == ['id', 'item', 'npc', 'stock', 'price', 'likes', 'last_update']
+    assert [row[1] for row in rows[1:]] == ['product 0', 'product 1', 'product 2']
+
+
+def test_purchases_export_is_filtered_by_time(client, db, admin_token):
+    db.session.bulk_insert_mappings(PurchaseLogModel, [
+        {'user_id': 1, 'product_id': 1, 'purchase_quantity': i,
+         'datetime': DAY + datetime.timedelta(days=i)} for i in range(4)])
+    db.session.commit()
+
+    response = client.get('/api/v1/productsCRUD/export/purchases', headers={
+        'X-API-TOKEN': admin_token}, query_string={
+        'since': (DAY + datetime.timedelta(days=1)).isoformat(),
+        'until': (DAY + datetime.timedelta(days=3)).isoformat()})
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=purchases.ndjson'
+    assert [json.loads(line)['purchase_quantity']
+            for line in response.get_data(as_text=True).splitlines()] == [1, 2]
+
+
+def test_export_is_admin_only(client, token):
+    response = client.get('/api/v1/productsCRUD/export/products', headers={'X-API-TOKEN': token})
+    assert response.status_code == 403
@@ -0,0 +1,67 @@
+import json
+import threading
+import time
+import bcrypt
+import pytest
+from src.api.auth.hashing import HashingBusy, PasswordHasher, hash_rounds, password_hasher
+from src.models import UserModel
+
+
+def login(client, password='secret'):
+    response = client.post('/api/v1/auth/login', content_type='application/json',
+                           data=json.dumps({'email': 'new@example.com', 'password': password}))
+    return response.status_code
+
+
+@pytest.fixture
+def saturated(monkeypatch):
+    """
+    The app's hasher with every slot taken.
+    """
+    monkeypatch.setattr(password_hasher, 'queue_timeout', 0.01)
+    monkeypatch.setattr(password_hasher, '_slots', threading.BoundedSemaphore(1))
+    password_hasher._slots.acquire()
+
+
+def test_full_queue_raises_after_the_timeout():
+    hasher = PasswordHasher(workers=0, max_pending=1, queue_timeout=0.05, rounds=4)
+    hasher._slots.acquire()
+    started = time.time()
+    with pytest.raises(HashingBusy):
+        hasher.hash('secret')
+    assert time.time() - started >= 0.05
+
+    hasher._slots.release()
+    assert hash_rounds(hasher.hash('secret')) == 4
+
+
+def test_register_and_login_answer_503_when_hashing_is_busy(client, token, saturated):
+    response = client.post('/api/v1/auth/register', content_type='application/json',
+                           data=json.dumps({'email': 'late@example.com', 'password': 'secret'}))
+    assert response.status_code == 503
+    assert login(client) == 503
+
+
+def test_login_rehashes_an_old_cost_factor(client, db, token):
+    user = UserModel.query.filter_by(email='new@example.com').one()
+    user.password = bcrypt.hashpw(b'secret', bcrypt.gensalt(5)).decode()
+    db.session.commit()
+
+    assert login(client) == 200
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        db.session.remove()
+        if hash_rounds(UserModel.query.filter_by(email='new@example.com').one().password) == 4:
+            break
+        time.sleep(0.01)
+    assert hash_rounds(UserModel.query.filter_by(email='new@example.com').one().password) == 4
+    assert login(client) == 200
+
+
+def test_unexpected_login_errors_are_logged(client, token, monkeypatch, caplog):
+    def broken(password, hashed):
+        raise RuntimeError('pool crashed')
+
+    monkeypatch.setattr(password_hasher, 'verify', broken)
+    assert login(client) == 500
+    assert 'pool crashed' in caplog.text
@@ -0,0 +1,46 @@
+import io
+from src.api.productsCRUD.importer import import_products
+from src.models import ProductModel
+
+NDJSON = '\n'.join([
+    '{"item": "lamp", "npc": "npc", "stock": 3, "price": 9.5}',
+    '{"item": "desk", "npc": "npc", "stock": 1, "price": 90',
+    '',
+    '["item", "npc"]',
+    '{"item": "chair", "stock": "many", "price": 20}',
+    '{"item": "lamp", "npc": "npc", "stock": 5, "price": 9.5}',
+    '{"item": "product 0", "npc": "npc", "stock": 5, "price": 1}',
+    '{"item": "rug", "npc": "npc", "stock": 2, "price": 30}',
+])
+
+
+def counters(stats):
+    return {key: stats[key] for key in ('read', 'inserted', 'duplicates', 'invalid')}
+
+
+def test_malformed_ndjson_lines_count_as_invalid(client, db, admin_token):
+    response = client.post('/api/v1/productsCRUD/import?format=ndjson', data=NDJSON,
+                           headers={'X-API-TOKEN': admin_token})
+
+    assert response.status_code == 201
+    assert counters(response.json) == {'read': 7, 'inserted': 2, 'duplicates': 2, 'invalid': 3}
+    db.session.remove()
+    assert [(product.item, product.stock) for product in
+            ProductModel.query.filter(ProductModel.id > 3).order_by(ProductModel.id)] == [
+        ('lamp', 3), ('rug', 2)]
+
+
+def test_csv_chunks_skip_items_of_earlier_chunks(db):
+    lines = ['item,npc,stock,price'] + ['item {},npc,1,2.5'.format(i % 4) for i in range(10)]
+
+    stats = import_products(io.StringIO('\n'.join(lines)), 'csv', chunk_size=3)
+
+    assert counters(stats) == {'read': 10, 'inserted': 4, 'duplicates': 6, 'invalid': 0}
+    db.session.remove()
+    assert ProductModel.query.count() == 7
+
+
+def test_import_is_admin_only(client, token):
+    response = client.post('/api/v1/productsCRUD/import?format=ndjson', data=NDJSON,
+                           headers={'X-API-TOKEN': token})
+    assert response.status_code == 403
@@ -0,0 +1,108 @@
+import threading
+import pytest
+from src.likes import LikeBuffer
+from src.models import ProductModel
+
+
+@pytest.fixture
+def buffer(app, monkeypatch):
+    """
+    A buffer of its own, whose flusher thread only runs once signalled.
+    """
+    monkeypatch.setitem(app.config, 'LIKES_FLUSH_INTERVAL', 60)
+    monkeypatch.setitem(app.config, 'LIKES_FLUSH_THRESHOLD', 10)
+    like_buffer = LikeBuffer()
+    like_buffer.init_app(app)
+    yield like_buffer
+    like_buffer._stop.set()
+    like_buffer._due.set()
+
+
+def likes(db, product_id):
+    db.session.remove()
+    return ProductModel.query.get(product_id).likes
+
+
+def test_likes_below_the_threshold_stay_pending(db, buffer):
+    buffer.add(1, 3)
+    buffer.add(1, 2)
+
+    assert buffer.pending(1) == 5
+    assert likes(db, 1) == 0
+    assert buffer.flush() == 1
+    assert likes(db, 1) == 5
+    assert buffer.pending(1) == 0
+
+
+def test_threshold_signals_the_flusher_thread(db, buffer, monkeypatch):
+    flushed = threading.Event()
+    flush = buffer.flush
+
+    def flush_in_thread():
+        assert threading.current_thread() is buffer._thread
+        count = flush()
+        flushed.set()
+        return count
+
+    monkeypatch.setattr(buffer, 'flush', flush_in_thread)
+    buffer.add(2, 10)
+
+    assert flushed.wait(5)
+    assert likes(db, 2) == 10
+
+
+def test_failed_flush_keeps_the_likes(db, buffer, monkeypatch):
+    def broken(deltas, session=None):
+        raise RuntimeError('database went away')
+
+    buffer.add(1, 4)
+    monkeypatch.setattr(ProductModel, 'add_likes', broken)
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    assert buffer.pending(1) == 4
+
+    monkeypatch.undo()
+    assert buffer.flush() == 1
+    assert likes(db, 1) == 4
+
+
+def test_concurrent_likes_are_all_counted(db, buffer):
+    buffer.flush_threshold = 10 ** 9
+
+    def like(product_id):
+        for _ in range(500):
+            buffer.add(product_id)
+
+    threads = [threading.Thread(target=like, args=(i % 3 + 1,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(buffer.pending(i) for i in (1, 2, 3)) == 3000
+
+    buffer.flush()
+    assert [likes(db, i) for i in (1, 2, 3)] == [1000, 1000, 1000]
+
+
+def test_committed_batch_is_not_counted_twice(app, db, buffer, monkeypatch):
+    add_likes = ProductModel.add_likes
+    seen, readers = [], []
+
+    def read():
+        with app.app_context():
+            seen.append(likes(db, 1) + buffer.pending(1))
+
+    def add_likes_then_read(deltas, session=None):
+        add_likes(deltas, session)
+        # the batch is committed, the flush has not finished yet
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(0.2)
+        readers.append(reader)
+
+    buffer.add(1, 7)
+    monkeypatch.setattr(ProductModel, 'add_likes', add_likes_then_read)
+    buffer.flush()
+    readers[0].join()
+
+    assert seen == [7]
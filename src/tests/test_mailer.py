@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+import pytest
+from flask_mail import Message
+from src.app import mail
+from src.mailer import MailDeliveryError, mailer
+from src.smtp_debug import DebuggingSMTPServer
+
+
+@pytest.fixture
+def smtp(app, monkeypatch):
+    """
+    The debugging SMTP server, with the app's mail pointed at it.
+    """
+    with DebuggingSMTPServer() as server:
+        for key, value in (('MAIL_SERVER', server.host), ('MAIL_PORT', server.port),
+                           ('MAIL_USE_SSL', False), ('MAIL_SUPPRESS_SEND', False)):
+            monkeypatch.setitem(app.config, key, value)
+        mail.init_app(app)
+        monkeypatch.setattr(mailer, 'backoff', 0.01)
+        # no connection kept alive from an earlier test
+        monkeypatch.setattr(mailer, '_local', threading.local())
+        yield server
+        mailer.stop()
+        monkeypatch.undo()
+        mail.init_app(app)
+
+
+def wait_for(server, count, timeout=5):
+    deadline = time.time() + timeout
+    while len(server.messages) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return server.messages
+
+
+def test_registration_and_checkout_send_mail(client, smtp, token):
+    response = client.post('/api/v1/productsCRUD/checkout', headers={'X-API-TOKEN': token},
+                           content_type='application/json',
+                           data=json.dumps({'items': [{'product_id': 2, 'quantity': 3}]}))
+    assert response.status_code == 201
+
+    assert [(message['To'], message['Subject']) for message in smtp.messages] == [
+        ('new@example.com', 'Welcome'), ('new@example.com', 'Your order')]
+    assert 'product 2: 3' in smtp.messages[1].get_payload()
+
+
+def test_queued_mail_is_batched_and_retried(app, smtp, monkeypatch):
+    monkeypatch.setattr(mailer, 'mode', 'thread')
+    monkeypatch.setattr(mailer, 'workers', 1)
+    smtp.fail_next = 2
+
+    with app.app_context():
+        for i in range(5):
+            assert mailer.send(Message('mail {}'.format(i), recipients=['a@example.com']))
+
+    assert sorted(message['Subject'] for message in wait_for(smtp, 5)) == [
+        'mail {}'.format(i) for i in range(5)]
+    # a fresh connection after each failure, then one for the rest and the retries
+    assert smtp.connections == 3
+
+
+def test_delivery_gives_up_after_max_attempts(app, smtp, monkeypatch):
+    monkeypatch.setattr(mailer, 'max_attempts', 2)
+    smtp.fail_next = 3
+
+    with app.app_context(), pytest.raises(MailDeliveryError) as error:
+        messages = [Message('mail {}'.format(i), recipients=['a@example.com']) for i in range(2)]
+        mailer.deliver(messages)
+
+    assert error.value.unsent == [messages[0]]
+    assert [message['Subject'] for message in smtp.messages] == ['mail 1']
@@ -0,0 +1,103 @@
+from urllib.parse import parse_qs, urlparse
+import pytest
+from src.api.pagination import count_cache, decode_cursor, encode_cursor, paginate
+from src.models import ProductList, ProductModel
+
+
+@pytest.fixture
+def productlists(db, token):
+    """
+    Five productlists of the user behind `token`, and one of another user.
+    """
+    user_id = 2
+    db.session.add_all([ProductList('list {}'.format(i), user_id) for i in range(5)])
+    db.session.add(ProductList('not mine', 1))
+    db.session.commit()
+    return token
+
+
+def test_cursor_round_trip_and_garbage():
+    assert decode_cursor(encode_cursor([3, 'apple', None])) == [3, 'apple', None]
+    for cursor in ('not a cursor!', encode_cursor({'id': 1})[:-2], encode_cursor({'id': 1})):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+
+
+def test_productlist_pages_follow_the_cursor(client, productlists):
+    headers = {'X-API-TOKEN': productlists}
+    ids, cursor = [], ''
+    while cursor is not None:
+        response = client.get('/api/v1/productsCRUD/', headers=headers,
+                              query_string={'per_page': 2, 'cursor': cursor, 'with_count': True})
+        assert response.status_code == 200
+        ids += [productlist['id'] for productlist in response.json['items']]
+        assert response.json['total'] == 5
+        cursor = response.json['next_cursor']
+
+    assert ids == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize('cursor', ['%%%', encode_cursor([1, 2]), encode_cursor('1')])
+def test_malformed_productlist_cursor_is_a_400(client, productlists, cursor):
+    headers = {'X-API-TOKEN': productlists}
+    for url in ('/api/v1/productsCRUD/', '/api/v1/productsCRUD/1'):
+        response = client.get(url, headers=headers, query_string={'cursor': cursor})
+        assert response.status_code == 400
+        assert response.json['message'] == 'Invalid cursor.'
+
+
+def test_product_pages_seek_past_ties(client, db):
+    # equal likes, so the id tie-breaker decides the order
+    db.session.add_all([ProductModel('product {}'.format(i), 'npc', 1, 1.0) for i in range(3, 10)])
+    db.session.commit()
+    ProductModel.add_likes({4: 2, 7: 2, 9: 1})
+
+    ids, cursor = [], ''
+    while cursor is not None:
+        response = client.get('/api/v1/productsCRUD/products', query_string={
+            'per_page': 3, 'orderBy': 'likes', 'cursor': cursor})
+        assert response.status_code == 200
+        ids += [product['id'] for product in response.json['products']]
+        link = response.json['metadata']['links']['next']
+        cursor = link and parse_qs(urlparse(link).query)['cursor'][0]
+
+    assert ids == [4, 7, 9, 1, 2, 3, 5, 6, 8, 10]
+    response = client.get('/api/v1/productsCRUD/products',
+                          query_string={'per_page': 3, 'cursor': encode_cursor([1])})
+    assert response.status_code == 400
+
+
+def product_total(per_page=2):
+    return paginate(ProductModel.query.order_by(ProductModel.id), 1, per_page, 'products').total
+
+
+def test_cached_total_is_dropped_when_a_write_commits(db):
+    assert product_total() == 3
+    # a write the ORM does not see, as from another process, is not counted...
+    db.session.execute(ProductModel.__table__.insert().values(item='raw', npc='npc', stock=1))
+    db.session.commit()
+    assert product_total() == 3
+
+    # ...until a tracked model commits in this one
+    db.session.add(ProductModel('product 4', 'npc', 1, 1.0))
+    db.session.commit()
+    assert product_total() == 5
+
+
+def test_rolled_back_writes_keep_the_cached_total(db):
+    generation = count_cache.generation('products')
+    db.session.add(ProductModel('product 4', 'npc', 1, 1.0))
+    db.session.flush()
+    db.session.rollback()
+
+    assert count_cache.generation('products') == generation
+
+
+def test_writes_only_invalidate_their_own_namespace(db):
+    mine, others = count_cache.generation(('productlist', 1)), \
+        count_cache.generation(('productlist', 2))
+    db.session.add(ProductList('mine', 1))
+    db.session.commit()
+
+    assert count_cache.generation(('productlist', 1)) == mine + 1
+    assert count_cache.generation(('productlist', 2)) == others
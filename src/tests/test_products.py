@@ -0,0 +1,60 @@
+from src.likes import like_buffer
+from src.models import ProductModel, PurchaseLogModel
+
+
+def test_product_get_answers_304_until_it_changes(client):
+    response = client.get('/api/v1/productsCRUD/products/1')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = client.get('/api/v1/productsCRUD/products/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    ProductModel.add_likes({1: 3})
+    response = client.get('/api/v1/productsCRUD/products/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.json['likes'] == 3
+    assert client.get('/api/v1/productsCRUD/products/1', headers={
+        'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+
+
+def test_missing_product_is_a_404_without_etag(client):
+    response = client.get('/api/v1/productsCRUD/products/99')
+    assert response.status_code == 404
+    assert 'ETag' not in response.headers
+
+
+def test_buy_decrements_stock_and_logs_the_purchase(client, db, token):
+    headers = {'X-API-TOKEN': token}
+    response = client.post('/api/v1/productsCRUD/products/2/buy?quantity=30', headers=headers)
+    assert response.status_code == 200
+    assert response.json['successful_purchase']['product']['current_stock'] == 70
+
+    response = client.post('/api/v1/productsCRUD/products/2/buy?quantity=71', headers=headers)
+    assert response.status_code == 409
+    assert response.json['stock_not_enough'] == {'current_stock': 70}
+    assert client.post('/api/v1/productsCRUD/products/99/buy?quantity=1',
+                       headers=headers).status_code == 404
+    assert client.post('/api/v1/productsCRUD/products/2/buy?quantity=1').status_code == 401
+
+    db.session.remove()
+    assert [(log.user.email, log.product_id, log.purchase_quantity)
+            for log in PurchaseLogModel.query] == [('new@example.com', 2, 30)]
+
+
+def test_likes_are_counted_before_they_are_written_back(client, db, token):
+    headers = {'X-API-TOKEN': token}
+    for expected in (1, 2):
+        response = client.post('/api/v1/productsCRUD/products/3/like', headers=headers)
+        assert response.status_code == 200
+        assert response.json['likes'] == expected
+    assert client.post('/api/v1/productsCRUD/products/99/like',
+                       headers=headers).status_code == 404
+
+    assert client.get('/api/v1/productsCRUD/products/3').json['likes'] == 2
+    like_buffer.flush()
+    db.session.remove()
+    assert ProductModel.query.get(3).likes == 2
+    assert client.get('/api/v1/productsCRUD/products/3').json['likes'] == 2
@@ -0,0 +1,70 @@
+import datetime
+import threading
+from src.models import ProductSales, ProductSalesDaily, PurchaseLogModel, UserPurchaseTotals, \
+    rebuild_sales, record_sales
+
+DAY = datetime.datetime(2026, 10, 1, 12)
+
+
+def totals(db):
+    db.session.remove()
+    return (
+        sorted((row.product_id, row.units, row.purchases, row.last_purchase)
+               for row in ProductSales.query),
+        sorted((row.product_id, row.day, row.units, row.purchases)
+               for row in ProductSalesDaily.query),
+        sorted((row.user_id, row.units, row.purchases) for row in UserPurchaseTotals.query),
+    )
+
+
+def log_purchases(db, purchases):
+    db.session.bulk_insert_mappings(PurchaseLogModel, [
+        {'user_id': user_id, 'product_id': product_id, 'purchase_quantity': quantity,
+         'datetime': at} for user_id, product_id, quantity, at in purchases])
+    record_sales(purchases)
+    db.session.commit()
+
+
+def test_upserts_add_to_existing_rows(db):
+    later = DAY + datetime.timedelta(hours=1)
+    next_day = DAY + datetime.timedelta(days=1)
+    log_purchases(db, [(1, 1, 2, DAY), (1, 1, 1, later), (None, 2, 5, DAY)])
+    # older purchase arriving late must not move last_purchase back
+    log_purchases(db, [(1, 1, 3, next_day), (1, 2, 1, DAY - datetime.timedelta(hours=1))])
+
+    products, days, users = totals(db)
+    assert products == [(1, 6, 3, next_day), (2, 6, 2, DAY)]
+    assert days == [(1, DAY.date(), 3, 2), (1, next_day.date(), 3, 1), (2, DAY.date(), 6, 2)]
+    assert users == [(1, 7, 4)]
+
+
+def test_rebuild_matches_incremental_totals(db):
+    log_purchases(db, [(1, i % 3 + 1, i, DAY + datetime.timedelta(hours=i)) for i in range(1, 40)])
+    incremental = totals(db)
+
+    assert rebuild_sales() == 39
+    assert totals(db) == incremental
+
+
+def test_concurrent_writers_lose_no_units(app, db):
+    errors = []
+
+    def buy():
+        try:
+            with app.app_context():
+                for _ in range(20):
+                    log_purchases(db, [(1, 1, 1, DAY), (1, 2, 2, DAY)])
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=buy) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    products, days, users = totals(db)
+    assert [(product_id, units, purchases) for product_id, units, purchases, _ in products] == [
+        (1, 80, 80), (2, 160, 80)]
+    assert users == [(1, 240, 160)]
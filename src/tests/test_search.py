@@ -0,0 +1,48 @@
+import pytest
+from src.models import ProductModel
+
+
+@pytest.fixture(params=['ngram', 'sql'])
+def catalog(request, app, db, monkeypatch):
+    """
+    Fruit products, searched through the in-process n-gram index or in SQL.
+    """
+    if request.param == 'sql':
+        monkeypatch.setitem(app.config, 'SEARCH_NGRAM_MAX_PRODUCTS', 0)
+    db.session.add_all([ProductModel(item, 'npc', 10, 1.0) for item in (
+        'Pineapple', 'apple pie', 'Grape', 'Snapple', 'Apple', '100% apple')])
+    db.session.commit()
+
+
+def search(client, term, mode, **params):
+    params = dict(params, searchByName=term, searchMode=mode, per_page=params.get('per_page', 10))
+    response = client.get('/api/v1/productsCRUD/products', query_string=params)
+    assert response.status_code == 200
+    return [product['item'] for product in response.json['products']]
+
+
+def test_exact_search_matches_the_whole_name(client, catalog):
+    assert search(client, 'Apple', 'exact') == ['Apple']
+
+
+def test_prefix_search_ignores_case(client, catalog):
+    assert search(client, 'APP', 'prefix') == ['Apple', 'apple pie']
+
+
+def test_substring_search_ranks_exact_then_earliest_match(client, catalog):
+    assert search(client, 'apple', 'substring') == [
+        'Apple', 'apple pie', 'Snapple', 'Pineapple', '100% apple']
+
+
+def test_like_wildcards_in_the_term_are_literal(client, catalog):
+    assert search(client, '0% a', 'substring') == ['100% apple']
+    assert search(client, '_', 'substring') == []
+
+
+def test_ranked_results_page_in_order(client, catalog):
+    assert search(client, 'apple', 'substring', per_page=2, page=2) == ['Snapple', 'Pineapple']
+
+
+def test_order_by_overrides_the_ranking(client, catalog):
+    assert search(client, 'apple', 'substring', orderBy='item') == [
+        '100% apple', 'Apple', 'Pineapple', 'Snapple', 'apple pie']
@@ -0,0 +1,347 @@
+import collections
+import datetime
+import logging
+import signal
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from kombu import Producer
+from kombu.mixins import ConsumerMixin
+from src import metrics
+from src.events import ANALYTICS_QUEUE, DEAD_LETTER_QUEUE, LIKE, PURCHASE
+
+log = logging.getLogger(__name__)
+
+batch_seconds = metrics.histogram(
+    'worker_batch_seconds', 'Time from handing a batch to a handler thread until it is settled.')
+batch_messages = metrics.histogram(
+    'worker_batch_messages', 'Messages per batch.',
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+messages_total = metrics.counter(
+    'worker_messages_total', 'Messages settled by the event worker.', ['outcome'])
+throughput = metrics.gauge(
+    'worker_throughput_messages_per_second', 'Messages per second of the last settled batch.')
+inflight = metrics.gauge(
+    'worker_inflight_batches', 'Batches handed to handler threads and not settled yet.')
+duplicates = metrics.counter(
+    'worker_duplicate_events_total', 'Redelivered events skipped because they were processed.')
+
+
+# requeued event ids remembered to spot their redelivery on virtual transports
+REQUEUED_IDS = 100000
+
+
+# Handlers write a batch of events into the worker's transaction without
+# committing; they may return a function to call once the batch committed.
+
+def record_purchases(events):
+    """
+    Writes the purchase log rows of a batch of purchase events in one bulk
+    insert and adds them to the sales aggregates.
+    """
+    from src.models import db, PurchaseLogModel, record_sales
+    purchases = [(event['user_id'], product_id, quantity,
+                  datetime.datetime.utcfromtimestamp(event['at']))
+                 for event in events for product_id, quantity in event['lines']]
+    db.session.bulk_insert_mappings(PurchaseLogModel, [
+        {'user_id': user_id, 'product_id': product_id, 'purchase_quantity': quantity,
+         'datetime': at}
+        for user_id, product_id, quantity, at in purchases
+    ])
+    record_sales(purchases)
+
+
+def apply_likes(events):
+    """
+    Sums a batch of like events per product and applies them in one UPDATE.
+    """
+    from src.cache import product_cache
+    from src.models import db, ProductModel
+    deltas = {}
+    for event in events:
+        deltas[event['product_id']] = deltas.get(event['product_id'], 0) + event['count']
+    # same row order in every batch, so concurrent batches cannot deadlock
+    ProductModel.add_likes(collections.OrderedDict(sorted(deltas.items())), db.session)
+    return lambda: product_cache.invalidate(*deltas)
+
+
+HANDLERS = {
+    PURCHASE: record_purchases,
+    LIKE: apply_likes,
+}
+
+
+class Worker(ConsumerMixin):
+    """
+    Consumes analytics events in batches.
+
+    Messages are collected until `batch_size` arrived or the oldest one has
+    waited `batch_timeout` seconds. The batch is then handed to one of
+    `concurrency` handler threads, each event type being written by its
+    handler in one bulk statement. Channels are not thread safe, so batches
+    are settled on the consuming thread, in delivery order: on AMQP a
+    successful batch is acknowledged with a single multi-ack of its last
+    delivery tag, a failing batch is requeued.
+
+    The broker stops delivering once `prefetch_count` messages are unacked,
+    so keep it at least batch_size * (concurrency + 1) to keep every
+    handler thread busy while the next batch fills.
+
+    A failing batch is requeued once. When it fails again after that
+    redelivery, its events are retried one at a time: the ones that still
+    fail are moved to `dead_letter_queue` and the rest are acknowledged,
+    so one poison message cannot stall the queue. Messages without an
+    event id are dead-lettered as they arrive. Redeliveries are told by
+    the broker's redelivered flag, and by the ids this worker requeued
+    itself, since virtual transports do not set the flag.
+    """
+
+    def __init__(self, connection, flask_app, queues=(ANALYTICS_QUEUE,), prefetch_count=1000,
+                 batch_size=500, batch_timeout=1.0, concurrency=1, handlers=None,
+                 dead_letter_queue=DEAD_LETTER_QUEUE):
+        self.connection = connection
+        self.app = flask_app
+        self.queues = list(queues)
+        self.dead_letter_queue = dead_letter_queue
+        self.prefetch_count = prefetch_count
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.concurrency = concurrency
+        self.handlers = handlers or HANDLERS
+        self.acknowledged = 0
+        self._batch = []
+        self._batch_started = None
+        self._inflight = collections.deque()
+        self._executor = None
+        self._dead_letters = None
+        # ids of the events this worker requeued, oldest first
+        self._requeued = collections.OrderedDict()
+        self._multi_ack = False
+        if prefetch_count and prefetch_count < batch_size * (concurrency + 1):
+            log.warning('prefetch_count %d is below batch_size * (concurrency + 1), batches '
+                        'will mostly be cut by the timeout', prefetch_count)
+        inflight.set_function(lambda: len(self._inflight))
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=self.queues, callbacks=[self.on_message], accept=['json'],
+                         on_decode_error=self.on_decode_error,
+                         prefetch_count=self.prefetch_count)]
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # virtual transports (memory://, redis://) ignore the multiple flag
+        self._multi_ack = connection.transport.driver_type == 'amqp'
+        self.dead_letter_queue(channel).declare()
+        self._dead_letters = Producer(channel, exchange=self.dead_letter_queue.exchange,
+                                      routing_key=self.dead_letter_queue.routing_key)
+        if self.concurrency > 1 and self._executor is None:
+            self._executor = ThreadPoolExecutor(self.concurrency)
+
+    def on_consume_end(self, connection, channel):
+        # consumers are cancelled but the channel is still open: finish what was delivered
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def on_message(self, body, message):
+        if not isinstance(body, dict) or not body.get('id'):
+            self.dead_letter(message, 'no event id')
+            return
+        if not self._batch:
+            self._batch_started = time.time()
+        self._batch.append((body, message))
+        if len(self._batch) >= self.batch_size:
+            self.dispatch()
+
+    def on_iteration(self):
+        if self._batch and time.time() - self._batch_started >= self.batch_timeout:
+            self.dispatch()
+        self.settle()
+
+    def redelivered(self, body, message):
+        return bool(message.delivery_info.get('redelivered')) or body['id'] in self._requeued
+
+    def on_decode_error(self, message, error):
+        self.dead_letter(message, 'undecodable: {}'.format(error))
+
+    def dead_letter(self, message, reason):
+        """
+        Moves a message to the dead letter queue with its original routing
+        key and the reason in its headers; must run on the consuming thread.
+        """
+        log.error('Dead-lettering %s message %s: %s', message.delivery_info.get('routing_key'),
+                  message.delivery_tag, reason)
+        self._dead_letters.publish(
+            message.body, content_type=message.content_type,
+            content_encoding=message.content_encoding, delivery_mode=2,
+            headers={'x-original-routing-key': message.delivery_info.get('routing_key'),
+                     'x-dead-letter-reason': reason})
+        message.ack()
+        messages_total.inc(labels=('dead_lettered',))
+
+    def stop(self, *args):
+        """
+        Stops consuming; batches already delivered are written and settled
+        before the connection closes. Usable as a signal handler.
+        """
+        log.info('Stopping, draining %d buffered and %d in-flight batches',
+                 1 if self._batch else 0, len(self._inflight))
+        self.should_stop = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def handle(self, events):
+        """
+        Runs the handlers of one batch in a single transaction, skipping
+        events whose id was already processed; delivery is at least once.
+        :param events: {routing key: [event body]}
+        :return: True if the batch was written
+        """
+        from src.models import db, ProcessedEvent
+        with self.app.app_context():
+            try:
+                seen = ProcessedEvent.seen(body['id'] for bodies in events.values()
+                                           for body in bodies)
+                skipped = 0
+                after_commit = []
+                now = datetime.datetime.utcnow()
+                for routing_key, bodies in events.items():
+                    fresh = []
+                    for body in bodies:
+                        if body['id'] in seen:
+                            skipped += 1
+                            continue
+                        seen.add(body['id'])
+                        fresh.append(body)
+                    if not fresh:
+                        continue
+                    db.session.bulk_insert_mappings(ProcessedEvent, [
+                        {'event_id': body['id'], 'processed_on': now} for body in fresh])
+                    handler = self.handlers.get(routing_key)
+                    if handler is None:
+                        log.warning('Dropping %d %s events without a handler', len(fresh),
+                                    routing_key)
+                        continue
+                    callback = handler(fresh)
+                    if callback is not None:
+                        after_commit.append(callback)
+                db.session.commit()
+            except Exception:
+                log.exception('Writing a batch of %d events failed',
+                              sum(len(bodies) for bodies in events.values()))
+                db.session.rollback()
+                return False
+        for callback in after_commit:
+            callback()
+        if skipped:
+            duplicates.inc(skipped)
+        return True
+
+    def process(self, events):
+        """
+        Writes a batch; when it fails after a redelivery, writes its events
+        one at a time to find the ones that keep failing.
+        :param events: [(routing key, body, redelivered)] in delivery order
+        :return: set of the indexes of the events that were not written
+        """
+        grouped = {}
+        for routing_key, body, _ in events:
+            grouped.setdefault(routing_key, []).append(body)
+        if self.handle(grouped):
+            return set()
+        if len(events) == 1 or not any(redelivered for _, _, redelivered in events):
+            return set(range(len(events)))
+        # events written before are skipped by the processed event ids
+        return {i for i, (routing_key, body, _) in enumerate(events)
+                if not self.handle({routing_key: [body]})}
+
+    def dispatch(self):
+        """
+        Hands the pending batch to a handler thread, or runs it inline when
+        concurrency is 1. Blocks while every handler thread is busy.
+        """
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        events = [(message.delivery_info.get('routing_key'), body,
+                   self.redelivered(body, message))
+                  for body, message in batch]
+        started = time.perf_counter()
+        if self._executor is None:
+            self._settle(batch, self.process(events), started)
+            return
+        while len(self._inflight) >= self.concurrency:
+            self._inflight[0][0].result()
+            self.settle()
+        self._inflight.append((self._executor.submit(self.process, events), batch, started))
+
+    def settle(self, wait=False):
+        """
+        Acks or requeues finished batches in delivery order.
+        :param wait: block until every in-flight batch is finished
+        :return: number of messages settled
+        """
+        settled = 0
+        while self._inflight and (wait or self._inflight[0][0].done()):
+            future, batch, started = self._inflight.popleft()
+            settled += self._settle(batch, future.result(), started)
+        return settled
+
+    def _settle(self, batch, failed, started):
+        if not failed:
+            if self._multi_ack:
+                batch[-1][1].ack(multiple=True)
+            else:
+                for _, message in batch:
+                    message.ack()
+            self.acknowledged += len(batch)
+            messages_total.inc(len(batch), ('acked',))
+        else:
+            for i, (body, message) in enumerate(batch):
+                redelivered = self.redelivered(body, message)
+                self._requeued.pop(body['id'], None)
+                if i not in failed:
+                    message.ack()
+                    self.acknowledged += 1
+                    messages_total.inc(labels=('acked',))
+                elif redelivered:
+                    self.dead_letter(message, 'failed again after a redelivery')
+                else:
+                    message.requeue()
+                    self._requeued[body['id']] = True
+                    messages_total.inc(labels=('requeued',))
+            while len(self._requeued) > REQUEUED_IDS:
+                self._requeued.popitem(last=False)
+        elapsed = time.perf_counter() - started
+        batch_seconds.observe(elapsed)
+        batch_messages.observe(len(batch))
+        if elapsed > 0:
+            throughput.set(len(batch) / elapsed)
+        return len(batch)
+
+    def flush(self):
+        """
+        Dispatches the pending batch and waits for every in-flight batch.
+        :return: number of messages settled
+        """
+        self.dispatch()
+        return self.settle(wait=True)
+
+    def drain(self, timeout=0.1):
+        """
+        Consumes until the queues stay empty for `timeout` seconds, then
+        writes what is left; used with the memory:// transport in tests
+        and benchmarks.
+        :return: number of messages acknowledged
+        """
+        before = self.acknowledged
+        with self.consumer_context() as (connection, channel, consumers):
+            while True:
+                self.on_iteration()
+                try:
+                    connection.drain_events(timeout=timeout)
+                except socket.timeout:
+                    break
+        return self.acknowledged - before